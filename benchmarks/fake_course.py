@@ -0,0 +1,219 @@
+"""Synthetic course with the markup PageParser expects, served locally."""
+import asyncio
+import json
+from threading import Thread
+
+from aiohttp import web
+
+COURSE_NAME = "Benchmark Course"
+
+
+def payload(name: str, size: int) -> bytes:
+    """size bytes, different for every name so the asset store can't
+    dedupe them"""
+    seed = name.encode() + b"\n"
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+class FakeCourse:
+    """Pages, assets, attachments and HLS videos of a generated course.
+
+    Lesson 1 of a module is the module page, like on the real site. The
+    breadcrumbs start with root, the folder the crawler saves into.
+    """
+
+    def __init__(
+        self,
+        root,
+        modules=2,
+        lessons=5,
+        assets=4,
+        asset_kb=32,
+        file_kb=256,
+        segments=4,
+        segment_kb=128,
+        videos=True,
+    ):
+        self.root = str(root).rstrip("/")
+        self.modules = modules
+        self.lessons = lessons
+        self.assets = assets
+        self.asset_size = asset_kb * 1024
+        self.file_size = file_kb * 1024
+        self.segments = segments
+        self.segment_size = segment_kb * 1024
+        self.videos = videos
+        self.base_url = ""
+
+    @property
+    def module_names(self) -> list:
+        return [f"Wave {module:02}" for module in range(1, self.modules + 1)]
+
+    @property
+    def lesson_count(self) -> int:
+        return self.modules * self.lessons
+
+    def lesson_url(self, module: int, lesson: int) -> str:
+        if lesson == 1:
+            return f"{self.base_url}/m/{module}/"
+        return f"{self.base_url}/m/{module}/l/{lesson}"
+
+    def home_page(self) -> str:
+        items = "".join(
+            f"""<li class="cat_menu"><a href="{self.lesson_url(module, 1)}">
+            {name}</a></li>"""
+            for module, name in enumerate(self.module_names, start=1)
+        )
+        return f"<html><body><ul>{items}</ul></body></html>"
+
+    def lesson_page(self, module: int, lesson: int) -> str:
+        module_name = self.module_names[module - 1]
+        listing = "".join(
+            f'<a href="{self.lesson_url(module, other)}">Lesson {other}</a>'
+            for other in range(1, self.lessons + 1)
+        )
+        # Half the images are shared by every lesson, like logos and icons
+        images = "".join(
+            f'<img src="{self.base_url}/assets/'
+            f'{"shared" if index % 2 else f"{module}-{lesson}"}-{index}.png">'
+            for index in range(self.assets)
+        )
+        video = ""
+        if self.videos:
+            video_json = json.dumps(
+                {
+                    "contentUrl": f"{self.base_url}/video/{module}/{lesson}"
+                    "/index.m3u8"
+                }
+            )
+            video = (
+                '<div class="video"></div>'
+                f'<script class="w-json-ld">{video_json}</script>'
+            )
+        return f"""<html><head>
+        <link rel="stylesheet" href="{self.base_url}/assets/course.css">
+        </head><body>
+        <div class="breadcrumbs">{self.root}/{COURSE_NAME} / {module_name}
+        / Lesson {lesson}</div>
+        <div class="category-listing"><h3 class="title">{module_name}</h3>
+        {listing}</div>
+        <div class="lesson"><p>Text of lesson {lesson} of {module_name}.</p>
+        {images}</div>
+        {video}
+        <div class="download_cont"><a
+        href="{self.base_url}/files/{module}-{lesson}.pdf">
+        <span>Workbook</span></a></div>
+        <div class="assessment-wrapper"><iframe
+        src="{self.base_url}/assessment/{module}/{lesson}?embed=1"></iframe>
+        </div>
+        <script>console.log("tracking")</script>
+        </body></html>"""
+
+    def assessment_page(self, module: int, lesson: int) -> str:
+        return f"""<html><body><form><p>Assessment {module}-{lesson}</p>
+        <script src="{self.base_url}/assets/quiz.js"></script>
+        </form></body></html>"""
+
+    def playlist(self, module: int, lesson: int) -> str:
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:10"]
+        for segment in range(self.segments):
+            lines += ["#EXTINF:10.0,", f"seg{segment}.ts"]
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines)
+
+
+class CourseServer:
+    """Serves a FakeCourse from an aiohttp server on a background thread
+    and counts the bytes it sends"""
+
+    def __init__(self, course: FakeCourse, host="127.0.0.1"):
+        self.course = course
+        self.host = host
+        self.bytes_sent = 0
+        self.requests = 0
+        self.loop = asyncio.new_event_loop()
+        self.runner = None
+
+    @property
+    def url(self) -> str:
+        return self.course.base_url
+
+    def start(self):
+        Thread(target=self.loop.run_forever, daemon=True).start()
+        port = asyncio.run_coroutine_threadsafe(
+            self._start(), self.loop
+        ).result()
+        self.course.base_url = f"http://{self.host}:{port}"
+        return self
+
+    async def _start(self) -> int:
+        app = web.Application()
+        app.router.add_get("/", self.home)
+        app.router.add_get("/m/{module}/", self.lesson)
+        app.router.add_get("/m/{module}/l/{lesson}", self.lesson)
+        app.router.add_get("/assessment/{module}/{lesson}", self.assessment)
+        app.router.add_get("/assets/{name}", self.asset)
+        app.router.add_get("/files/{name}", self.file)
+        app.router.add_get(
+            "/video/{module}/{lesson}/index.m3u8", self.playlist
+        )
+        app.router.add_get("/video/{module}/{lesson}/{segment}", self.segment)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, 0)
+        await site.start()
+        return self.runner.addresses[0][1]
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(
+            self.runner.cleanup(), self.loop
+        ).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def respond(self, body, content_type="text/html") -> web.Response:
+        if isinstance(body, str):
+            body = body.encode()
+        self.requests += 1
+        self.bytes_sent += len(body)
+        return web.Response(body=body, content_type=content_type)
+
+    @staticmethod
+    def ints(request, *names) -> list:
+        return [int(request.match_info[name]) for name in names]
+
+    async def home(self, request):
+        return self.respond(self.course.home_page())
+
+    async def lesson(self, request):
+        module = int(request.match_info["module"])
+        lesson = int(request.match_info.get("lesson", 1))
+        return self.respond(self.course.lesson_page(module, lesson))
+
+    async def assessment(self, request):
+        module, lesson = self.ints(request, "module", "lesson")
+        return self.respond(self.course.assessment_page(module, lesson))
+
+    async def asset(self, request):
+        name = request.match_info["name"]
+        return self.respond(
+            payload(name, self.course.asset_size),
+            "application/octet-stream",
+        )
+
+    async def file(self, request):
+        name = request.match_info["name"]
+        return self.respond(
+            payload(name, self.course.file_size), "application/pdf"
+        )
+
+    async def playlist(self, request):
+        module, lesson = self.ints(request, "module", "lesson")
+        return self.respond(
+            self.course.playlist(module, lesson),
+            "application/vnd.apple.mpegurl",
+        )
+
+    async def segment(self, request):
+        return self.respond(
+            payload(request.path, self.course.segment_size), "video/mp2t"
+        )
@@ -0,0 +1,114 @@
+"""Stand-in for the Chrome WebDriver, so PageLoader runs without a browser."""
+import base64
+import time
+from urllib.parse import urlparse
+from urllib.request import url2pathname, urlopen
+
+from bs4 import BeautifulSoup
+from selenium.common.exceptions import (
+    NoSuchElementException,
+    StaleElementReferenceException,
+)
+from selenium.webdriver.common.by import By
+
+from page_loader import PageLoader
+
+# 1x1 transparent png
+PNG = base64.b64encode(
+    bytes.fromhex(
+        "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+        "1f15c4890000000d49444154789c6360000002000001e221bc33000000"
+        "0049454e44ae426082"
+    )
+).decode()
+PDF = base64.b64encode(b"%PDF-1.4\n%%EOF\n").decode()
+
+
+class FakeElement:
+    """Element of a FakeDriver page, stale once the driver loads another"""
+
+    def __init__(self, driver, page: int):
+        self.driver = driver
+        self.page = page
+
+    def is_enabled(self) -> bool:
+        if self.driver.pages != self.page:
+            raise StaleElementReferenceException("page changed")
+        return True
+
+
+class FakeDriver:
+    """Implements the part of the WebDriver API PageLoader uses. Pages are
+    fetched with urllib, file:// urls are read from disk, and
+    render_delay stands in for the time Chrome takes to render a page"""
+
+    def __init__(self, render_delay=0.0):
+        self.render_delay = render_delay
+        self.session_id = "fake"
+        self.capabilities = {"goog:chromeOptions": {}}
+        self.page_source = ""
+        self.current_url = "about:blank"
+        # Pages loaded, to tell elements of an older page
+        self.pages = 0
+
+    def get(self, url: str):
+        if url.startswith("file://"):
+            with open(url2pathname(urlparse(url).path)) as f:
+                self.page_source = f.read()
+        else:
+            with urlopen(url) as resp:
+                self.page_source = resp.read().decode()
+        self.current_url = url
+        self.pages += 1
+        if self.render_delay:
+            time.sleep(self.render_delay)
+
+    def execute_cdp_cmd(self, cmd: str, params: dict) -> dict:
+        if cmd == "Page.getLayoutMetrics":
+            return {"contentSize": {"width": 1, "height": 1}}
+        if cmd == "Page.captureScreenshot":
+            return {"data": PNG}
+        if cmd == "Page.printToPDF":
+            return {"data": PDF}
+        return {}
+
+    def execute_script(self, script: str):
+        if script == "return document.readyState":
+            return "complete"
+        return None
+
+    def find_element(self, by: str, value: str) -> FakeElement:
+        # A tag name is a css selector too
+        if by not in [By.CSS_SELECTOR, By.TAG_NAME]:
+            raise NotImplementedError(by)
+        soup = BeautifulSoup(
+            self.page_source or "<html></html>", "html.parser"
+        )
+        if soup.select_one(value):
+            return FakeElement(self, self.pages)
+        raise NoSuchElementException(value)
+
+    def get_cookies(self) -> list:
+        return []
+
+    def quit(self):
+        pass
+
+
+class FakePageLoader(PageLoader):
+    """PageLoader on a FakeDriver, for PageLoaderPool(loader_factory=...).
+    Keeps the time every page load started, in the order they happened"""
+
+    render_delay = 0.0
+    load_started: list = []
+
+    def start_selenium_driver(self, cookie_file="cookies.json"):
+        self.pages_loaded = 0
+        self.driver = FakeDriver(self.render_delay)
+
+    def load_page(self, page_url, waits=None) -> str | None:
+        FakePageLoader.load_started.append(time.perf_counter())
+        return super().load_page(page_url, waits)
+
+    def send_devtools(self, cmd, params={}):
+        return self.driver.execute_cdp_cmd(cmd, params)
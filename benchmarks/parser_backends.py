@@ -0,0 +1,106 @@
+"""Times PageParser.extract with each backend on saved lesson pages.
+
+Point it at a downloaded course to measure on real pages, the saved html
+of every lesson is used. Without a folder it runs on generated lessons.
+The records of every backend are checked against html.parser, so a
+backend that is faster but reads something else is caught.
+
+    python benchmarks/parser_backends.py "Fluency Academy - Inglês"
+    python benchmarks/parser_backends.py --pages 200 --repeat 5
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parents[1] / "src"))
+
+from fake_course import FakeCourse  # noqa: E402
+from run_benchmarks import percentiles  # noqa: E402
+
+from page_parser import (  # noqa: E402
+    EXTRACT_BACKENDS,
+    LessonRecord,
+    PageParser,
+    get_extract_backend,
+)
+
+
+def saved_pages(folder) -> list:
+    """Html the crawler saved for the lessons, not the rewritten copies"""
+    return [
+        html_path.read_text(encoding="utf-8", errors="replace")
+        for html_path in sorted(Path(folder).rglob("*.html"))
+        if "-giow" not in html_path.name
+    ]
+
+
+def generated_pages(count: int) -> list:
+    course = FakeCourse("/tmp", modules=1, lessons=count, assets=20)
+    course.base_url = "https://cursos.fluencyacademy.io"
+    return [course.lesson_page(1, lesson) for lesson in range(1, count + 1)]
+
+
+def record_values(record: LessonRecord) -> tuple:
+    return tuple(getattr(record, name) for name in LessonRecord.__slots__)
+
+
+def bench_backend(backend: str, pages: list, repeat: int) -> tuple:
+    """Seconds of every extract, and the records of the last round"""
+    seconds = []
+    records = []
+    for _ in range(repeat):
+        records = []
+        for html in pages:
+            start = time.perf_counter()
+            records.append(PageParser(html, backend).extract())
+            seconds.append(time.perf_counter() - start)
+    return seconds, records
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Times PageParser.extract with each backend"
+    )
+    arg_parser.add_argument(
+        "folder", nargs="?", help="downloaded course with saved lessons"
+    )
+    arg_parser.add_argument(
+        "--pages", type=int, default=100, help="generated lessons"
+    )
+    arg_parser.add_argument(
+        "--repeat", type=int, default=3, help="times every page is parsed"
+    )
+    args = arg_parser.parse_args()
+
+    pages = saved_pages(args.folder) if args.folder else []
+    if not pages:
+        if args.folder:
+            print(f"No saved lessons in {args.folder}, using generated ones")
+        pages = generated_pages(args.pages)
+
+    backends = []
+    for name in EXTRACT_BACKENDS:
+        if get_extract_backend(name) == name:
+            backends.append(name)
+
+    expected = None
+    header = ["backend", "pages/s", "p50", "p90", "p99", "same"]
+    print(("{:<14}" + "{:>9}" * 5).format(*header))
+    for backend in backends:
+        seconds, records = bench_backend(backend, pages, args.repeat)
+        values = [record_values(record) for record in records]
+        if expected is None:
+            expected = values
+        latency = percentiles(seconds)
+        print(
+            ("{:<14}" + "{:>9}" * 5).format(
+                backend,
+                round(len(seconds) / sum(seconds), 1),
+                latency["p50"],
+                latency["p90"],
+                latency["p99"],
+                "yes" if values == expected else "no",
+            )
+        )
+    print("Latencies in milliseconds")
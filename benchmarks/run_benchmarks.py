@@ -0,0 +1,358 @@
+"""Offline benchmarks of the crawl, the Downloader and the page rewrite.
+
+Everything runs against a generated course served from localhost and a
+fake WebDriver, so the numbers only depend on this code and this machine.
+Save a run with --json and check a later one against it with --compare,
+which exits with 1 when a stage got slower than --tolerance allows.
+
+    python benchmarks/run_benchmarks.py --modules 3 --lessons 10
+    python benchmarks/run_benchmarks.py --json baseline.json
+    python benchmarks/run_benchmarks.py --compare baseline.json
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from urllib.request import urlopen
+
+sys.path.insert(0, str(Path(__file__).absolute().parents[1] / "src"))
+
+from fake_course import COURSE_NAME, CourseServer, FakeCourse  # noqa: E402
+from fake_driver import FakePageLoader  # noqa: E402
+
+from asset_store import AssetPlan, AssetStore  # noqa: E402
+from crawl_state import CrawlState  # noqa: E402
+from crawler import CrawlOptions, crawl, generate_queue  # noqa: E402
+from downloader import Downloader  # noqa: E402
+from hls import HlsDownload  # noqa: E402
+from make_page_local import (  # noqa: E402
+    filter_and_download_page,
+    get_all_custom_html_files,
+)
+from page_capture import CaptureOptions  # noqa: E402
+from page_loader import PAGE_LOAD_STRATEGIES, PageLoaderPool  # noqa: E402
+from page_parser import PageParser  # noqa: E402
+from profiling import Profiler  # noqa: E402
+
+MB = 1024 * 1024
+# Throughput figures checked by --compare
+THROUGHPUTS = ["items_per_sec", "mb_per_sec"]
+
+
+def percentiles(seconds: list) -> dict:
+    """p50, p90 and p99 in milliseconds"""
+    if not seconds:
+        return {}
+    seconds = sorted(seconds)
+
+    def at(percent):
+        index = min(len(seconds) - 1, int(percent / 100 * len(seconds)))
+        return round(seconds[index] * 1000, 2)
+
+    return {"p50": at(50), "p90": at(90), "p99": at(99)}
+
+
+def stage_result(items, elapsed, sent, latencies) -> dict:
+    return {
+        "items": items,
+        "seconds": round(elapsed, 3),
+        "items_per_sec": round(items / elapsed, 2),
+        "mb_per_sec": round(sent / MB / elapsed, 2),
+        "latency_ms": percentiles(latencies),
+    }
+
+
+def bench_crawl(course, server, workdir, args) -> dict:
+    """Crawls the whole course with FakePageLoaders. Latency is the time
+    from one page load to the next, the time spent on each lesson"""
+    with urlopen(server.url) as resp:
+        parser = PageParser(resp.read().decode())
+    queue = generate_queue(parser, course.module_names)
+    crawl_state = CrawlState(str(workdir / "crawl_state.db"))
+    crawl_state.add_modules(queue)
+    FakePageLoader.render_delay = args.render_delay
+    FakePageLoader.load_started = []
+    page_loader_pool = PageLoaderPool(
+        size=2,
+        loader_factory=FakePageLoader,
+        load_strategy=args.load_strategy,
+    )
+    options = CrawlOptions(
+        capture=CaptureOptions(
+            image_format="none" if args.no_captures else "png",
+            pdf=not args.no_captures,
+        )
+    )
+
+    sent = server.bytes_sent
+    start = time.perf_counter()
+    crawl(queue, crawl_state, page_loader_pool, options)
+    elapsed = time.perf_counter() - start
+    page_loader_pool.close()
+    crawl_state.close()
+
+    starts = FakePageLoader.load_started
+    latencies = [after - before for before, after in zip(starts, starts[1:])]
+    return stage_result(
+        course.lesson_count, elapsed, server.bytes_sent - sent, latencies
+    )
+
+
+def bench_downloader(server, workdir, args) -> dict:
+    """Downloads args.files attachments at once, latency is from submit to
+    done, so it includes the wait for a transfer slot"""
+    downloader = Downloader()
+    folder = workdir / "downloads"
+    folder.mkdir()
+    latencies = []
+
+    def timed(future, submitted):
+        future.add_done_callback(
+            lambda _: latencies.append(time.perf_counter() - submitted)
+        )
+        return future
+
+    sent = server.bytes_sent
+    start = time.perf_counter()
+    futures = [
+        timed(
+            downloader.submit_file(
+                f"{server.url}/files/bench-{index}.pdf",
+                str(folder / f"bench-{index}.pdf"),
+            ),
+            time.perf_counter(),
+        )
+        for index in range(args.files)
+    ]
+    for future in futures:
+        future.result()
+    elapsed = time.perf_counter() - start
+    return stage_result(
+        args.files, elapsed, server.bytes_sent - sent, latencies
+    )
+
+
+async def fetch_segments(playlist_url: str, mp4_path: Path) -> list:
+    hls = HlsDownload(
+        Downloader.session, Downloader.scheduler, playlist_url, mp4_path
+    )
+    playlist = await hls.fetch_playlist(playlist_url)
+
+    async def timed(url):
+        start = time.perf_counter()
+        await hls.fetch_segment(url)
+        return time.perf_counter() - start
+
+    return await asyncio.gather(*[timed(url) for url in playlist["segments"]])
+
+
+def bench_hls(course, server, workdir) -> dict:
+    """Fetches the segments of a video the way HlsDownload does, without
+    the ffmpeg remux"""
+    downloader = Downloader()
+    playlist_url = f"{server.url}/video/1/1/index.m3u8"
+    sent = server.bytes_sent
+    start = time.perf_counter()
+    latencies = downloader.submit(
+        fetch_segments(playlist_url, workdir / "video.mp4")
+    ).result()
+    elapsed = time.perf_counter() - start
+    return stage_result(
+        course.segments, elapsed, server.bytes_sent - sent, latencies
+    )
+
+
+def bench_localize(server, workdir) -> dict:
+    """Rewrites the crawled pages, latency is filter_and_download_page of
+    one page, the throughput includes waiting for the assets"""
+    project = workdir / COURSE_NAME
+    asset_store = AssetStore(project)
+    asset_plan = AssetPlan(asset_store)
+    html_paths = get_all_custom_html_files(project)
+    latencies = []
+
+    sent = server.bytes_sent
+    start = time.perf_counter()
+    for html_path in html_paths:
+        page_start = time.perf_counter()
+        filter_and_download_page(html_path, asset_plan)
+        latencies.append(time.perf_counter() - page_start)
+    asset_plan.execute()
+    elapsed = time.perf_counter() - start
+    asset_store.close()
+    return stage_result(
+        len(html_paths), elapsed, server.bytes_sent - sent, latencies
+    )
+
+
+def run(args) -> dict:
+    workdir = Path(tempfile.mkdtemp(prefix="facademy-bench-"))
+    previous_dir = os.getcwd()
+    # The Downloader reads these from the working directory
+    profile_dir = args.profile and os.path.abspath(args.profile)
+    os.chdir(workdir)
+    (workdir / "cookies.json").write_text("[]")
+    (workdir / "user_agent.txt").write_text("facademy-dl benchmark")
+
+    videos = not args.no_video and shutil.which("ffmpeg") is not None
+    if not videos and not args.no_video:
+        print("ffmpeg not found, the crawl runs without videos")
+    course = FakeCourse(
+        workdir,
+        modules=args.modules,
+        lessons=args.lessons,
+        assets=args.assets,
+        asset_kb=args.asset_kb,
+        file_kb=args.file_kb,
+        segments=args.segments,
+        segment_kb=args.segment_kb,
+        videos=videos,
+    )
+    server = CourseServer(course).start()
+
+    results = {}
+    profiler = Profiler(profile_dir)
+    quiet = contextlib.ExitStack()
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+        quiet.enter_context(contextlib.redirect_stdout(io.StringIO()))
+        quiet.enter_context(contextlib.redirect_stderr(io.StringIO()))
+    try:
+        with quiet:
+            with profiler.stage("crawl"):
+                results["crawl"] = bench_crawl(course, server, workdir, args)
+            with profiler.stage("downloader"):
+                results["downloader"] = bench_downloader(server, workdir, args)
+            with profiler.stage("hls"):
+                results["hls"] = bench_hls(course, server, workdir)
+            with profiler.stage("localize_pages"):
+                results["filter_and_download_page"] = bench_localize(
+                    server, workdir
+                )
+    finally:
+        Downloader.close()
+        server.stop()
+        os.chdir(previous_dir)
+        if args.keep:
+            print(f"Output kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def print_results(results: dict):
+    header = ["stage", "items", "sec", "items/s", "MB/s", "p50", "p90", "p99"]
+    print(("{:<26}" + "{:>9}" * 7).format(*header))
+    for stage, result in results.items():
+        latency = result["latency_ms"]
+        print(
+            ("{:<26}" + "{:>9}" * 7).format(
+                stage,
+                result["items"],
+                result["seconds"],
+                result["items_per_sec"],
+                result["mb_per_sec"],
+                latency.get("p50", "-"),
+                latency.get("p90", "-"),
+                latency.get("p99", "-"),
+            )
+        )
+    print("Latencies in milliseconds")
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Throughputs that dropped more than tolerance below the baseline"""
+    regressions = []
+    for stage, result in results.items():
+        for metric in THROUGHPUTS:
+            before = baseline.get(stage, {}).get(metric)
+            if not before:
+                continue
+            change = (result[metric] - before) / before
+            print(
+                f"{stage} {metric}: {before} -> {result[metric]} "
+                f"({change:+.0%})"
+            )
+            if change < -tolerance:
+                regressions.append(f"{stage} {metric}")
+    return regressions
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Offline benchmarks against a generated course"
+    )
+    arg_parser.add_argument("--modules", type=int, default=2)
+    arg_parser.add_argument("--lessons", type=int, default=10)
+    arg_parser.add_argument(
+        "--assets", type=int, default=6, help="images per lesson"
+    )
+    arg_parser.add_argument("--asset-kb", type=int, default=32)
+    arg_parser.add_argument(
+        "--files", type=int, default=50, help="attachments downloaded"
+    )
+    arg_parser.add_argument("--file-kb", type=int, default=256)
+    arg_parser.add_argument(
+        "--segments", type=int, default=20, help="HLS segments per video"
+    )
+    arg_parser.add_argument("--segment-kb", type=int, default=256)
+    arg_parser.add_argument(
+        "--render-delay",
+        type=float,
+        default=0.0,
+        help="seconds the fake driver takes per page, like Chrome would",
+    )
+    arg_parser.add_argument(
+        "--load-strategy",
+        default="normal",
+        choices=PAGE_LOAD_STRATEGIES,
+        help="page load strategy of the fake drivers",
+    )
+    arg_parser.add_argument(
+        "--no-captures",
+        action="store_true",
+        help="no screenshot and pdf",
+    )
+    arg_parser.add_argument(
+        "--no-video", action="store_true", help="crawl without videos"
+    )
+    arg_parser.add_argument(
+        "--profile", help="save cProfile and tracemalloc reports here"
+    )
+    arg_parser.add_argument("--json", help="save the results to this file")
+    arg_parser.add_argument(
+        "--compare", help="results of a previous run to compare with"
+    )
+    arg_parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="throughput drop that counts as a regression",
+    )
+    arg_parser.add_argument(
+        "--keep", action="store_true", help="keep the generated files"
+    )
+    arg_parser.add_argument(
+        "--verbose", action="store_true", help="show the crawler output"
+    )
+    args = arg_parser.parse_args()
+
+    results = run(args)
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
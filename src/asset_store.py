@@ -0,0 +1,226 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+from collections import defaultdict
+from concurrent.futures import Future
+from pathlib import Path
+from threading import Lock
+from urllib.parse import unquote, urlparse
+
+from tqdm import tqdm
+
+from downloader import Downloader, forget_validators
+from misc import set_logging_handlers
+from retry_policy import RetryPolicy, host_of
+from transfer_scheduler import ASSET
+
+STORE_FOLDER = ".assets"
+# Downloads of an asset that failed altogether, on top of the retries the
+# Downloader does for each
+ASSET_RETRY = RetryPolicy(tries=3, base_delay=2, max_delay=30)
+
+logger = set_logging_handlers("make_page_local.log")
+
+
+def url_digest(url: str) -> str:
+    return hashlib.sha1(url.encode()).hexdigest()
+
+
+def fix_font_awesome(content: bytes) -> bytes:
+    # The fonts are not downloaded, point them to the CDN instead
+    return content.replace(
+        b"../fonts/",
+        b"https://maxcdn.bootstrapcdn.com/font-awesome/4.5.0/",
+    )
+
+
+# Rewrites applied to an asset before it goes into the store, by file name
+TRANSFORMS = {"font-awesome.min.css": fix_font_awesome}
+
+
+class AssetStore:
+    """Project wide, content addressed copy of the page assets.
+
+    Every asset is kept once under .assets/objects, named by the sha256 of
+    its content, and an index maps each url to its blob. Lessons get
+    hardlinks to the blobs, so an asset that is already in the index never
+    has to be downloaded again.
+    """
+
+    def __init__(self, project_path):
+        self.root = Path(project_path) / STORE_FOLDER
+        self.objects = self.root / "objects"
+        self.tmp = self.root / "tmp"
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.tmp.mkdir(parents=True, exist_ok=True)
+        self.lock = Lock()
+        self.conn = sqlite3.connect(
+            self.root / "index.db",
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS urls (
+                url TEXT PRIMARY KEY,
+                digest TEXT,
+                suffix TEXT
+            )"""
+        )
+
+    def blob_path(self, digest: str, suffix: str) -> Path:
+        return self.objects / digest[:2] / (digest + suffix)
+
+    def lookup(self, url: str) -> Path | None:
+        """Blob of a url we already have, None if it must be downloaded"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT digest, suffix FROM urls WHERE url = ?", (url,)
+            ).fetchone()
+        if not row:
+            return None
+        blob = self.blob_path(*row)
+        if not blob.exists():
+            return None
+        return blob
+
+    def tmp_path(self, url: str) -> Path:
+        """Where the downloader should put a url before it is ingested"""
+        return self.tmp / url_digest(url)
+
+    def ingest(self, url: str, downloaded: Path) -> Path | None:
+        """Moves a downloaded file into the store and indexes its url"""
+        downloaded = Path(downloaded)
+        if not downloaded.exists():
+            return None
+        forget_validators(downloaded)
+        name = unquote(Path(urlparse(url).path).name)
+        content = downloaded.read_bytes()
+        if name in TRANSFORMS:
+            content = TRANSFORMS[name](content)
+            downloaded.write_bytes(content)
+        digest = hashlib.sha256(content).hexdigest()
+        blob = self.blob_path(digest, Path(name).suffix)
+        if blob.exists():
+            downloaded.unlink()
+        else:
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(downloaded, blob)
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO urls VALUES (?, ?, ?)",
+                (url, digest, blob.suffix),
+            )
+        return blob
+
+    def link(self, url: str, dest: Path) -> bool:
+        """Makes the asset of url available at dest inside a lesson"""
+        blob = self.lookup(url)
+        if not blob:
+            return False
+        dest = Path(dest)
+        if dest.exists():
+            if os.path.samefile(dest, blob):
+                return True
+            dest.unlink()
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(blob, dest)
+        except OSError:
+            # Hardlinks are not available everywhere (other drive, FAT...)
+            shutil.copyfile(blob, dest)
+        return True
+
+    def close(self):
+        self.conn.close()
+
+
+class AssetPlan:
+    """Deduplicated downloads for all the pages of a project.
+
+    Pages add the assets they reference while they are being rewritten;
+    unknown urls start downloading right away on the shared Downloader, so
+    transfers overlap with the parsing of the next pages. execute waits for
+    them, stores them and links every asset into the lessons that use it.
+    link_page does the same for the assets of a single page, so pages can
+    be finished one at a time while others are still being added.
+    """
+
+    def __init__(self, asset_store: AssetStore, retry=ASSET_RETRY):
+        self.asset_store = asset_store
+        self.retry = retry
+        self.downloader = Downloader()
+        self.links: dict = defaultdict(set)
+        self.downloads: dict = {}
+        self.lock = Lock()
+
+    def add(self, url: str, dest: Path):
+        with self.lock:
+            self.links[url].add(Path(dest))
+            if url in self.downloads or self.asset_store.lookup(url):
+                return
+            self.downloads[url] = self.submit(url)
+
+    def submit(self, url: str) -> Future:
+        return self.downloader.submit_file(
+            url, str(self.asset_store.tmp_path(url)), ASSET
+        )
+
+    def store(self, url: str):
+        """Waits for the download of url and puts it in the store"""
+        future = self.downloads.get(url)
+        if not future:
+            return
+        for attempt in self.retry.attempts_sync(host_of(url)):
+            if attempt:
+                with self.lock:
+                    # Someone else may have retried it already
+                    if self.downloads.get(url) is future:
+                        self.downloads[url] = self.submit(url)
+                    future = self.downloads.get(url)
+                if not future:
+                    return
+            try:
+                # False: the server refused it, asking again won't help
+                future.result()
+            except Exception as e:
+                # Out of tries for now, the host may be back later
+                logger.error(f"Error downloading {url} {e}")
+                logger.error(f"Attempt {attempt}")
+                continue
+            break
+        with self.lock:
+            if self.downloads.get(url) is not future:
+                return
+            self.asset_store.ingest(url, self.asset_store.tmp_path(url))
+            del self.downloads[url]
+
+    def link_page(self, assets: list) -> bool:
+        """Stores and links the (url, dest) assets of one page, False if
+        some of them are not available"""
+        complete = True
+        for url, dest in assets:
+            self.store(url)
+            with self.lock:
+                self.links[url].discard(Path(dest))
+            if not self.asset_store.link(url, dest):
+                logger.warning(f"Asset not available: {url}")
+                complete = False
+        return complete
+
+    def has_all(self, assets: list) -> bool:
+        """Whether every (url, dest) asset is in the store"""
+        return all(self.asset_store.lookup(url) for url, _ in assets)
+
+    def execute(self):
+        print(f"Waiting for {len(self.downloads)} asset downloads...")
+        for url in tqdm(list(self.downloads)):
+            self.store(url)
+
+        print("Linking assets into the lessons...")
+        for url, dests in self.links.items():
+            for dest in dests:
+                if not self.asset_store.link(url, dest):
+                    logger.warning(f"Asset not available: {url}")
+        self.links = defaultdict(set)
@@ -0,0 +1,259 @@
+import asyncio
+import json
+from asyncio import Semaphore, gather, wait_for
+from itertools import count
+
+from aiohttp import WSMsgType
+from aiohttp.client import ClientSession
+
+from metrics import BLOCKED_REQUESTS, CAPTURE_SECONDS, PAGE_LOAD_SECONDS
+from misc import set_logging_handlers
+from page_loader import full_page_clip
+from request_blocking import BLOCKED_URLS, fetch_patterns
+
+MAX_TABS = 4
+PAGE_TIMEOUT = 60
+# Seconds Chrome has to answer a command, captures of long pages included
+COMMAND_TIMEOUT = 60
+
+logger = set_logging_handlers("logs.log")
+
+
+class CDPError(Exception):
+    pass
+
+
+class CDPConnection:
+    """Minimal asyncio client for the browser level DevTools websocket.
+
+    Commands for a tab are sent with the sessionId we get from attaching to
+    it (flat mode), so a single websocket drives all the tabs at once.
+    """
+
+    def __init__(self, debugger_address: str):
+        self.debugger_address = debugger_address
+        self._ids = count(1)
+        self._pending: dict = {}
+        self._listeners: dict = {}
+        self._handlers: dict = {}
+        self._closed = False
+
+    async def __aenter__(self):
+        self.session = ClientSession()
+        async with self.session.get(
+            f"http://{self.debugger_address}/json/version"
+        ) as resp:
+            ws_url = (await resp.json())["webSocketDebuggerUrl"]
+        self.ws = await self.session.ws_connect(ws_url, max_msg_size=0)
+        self._reader = asyncio.create_task(self._read_messages())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._reader.cancel()
+        await self.ws.close()
+        await self.session.close()
+
+    async def _read_messages(self):
+        try:
+            async for msg in self.ws:
+                if msg.type != WSMsgType.TEXT:
+                    # Closing or broken, the loop ends with the socket
+                    continue
+                self._dispatch(json.loads(msg.data))
+        finally:
+            self._fail_waiters(CDPError("DevTools connection closed"))
+
+    def _fail_waiters(self, error: CDPError):
+        """Nothing will answer once the reader stopped, wake everyone"""
+        self._closed = True
+        waiters = list(self._pending.values())
+        for futures in self._listeners.values():
+            waiters.extend(futures)
+        self._pending.clear()
+        self._listeners.clear()
+        for future in waiters:
+            if not future.done():
+                future.set_exception(error)
+
+    def _dispatch(self, data: dict):
+        if "id" in data:
+            future = self._pending.pop(data["id"], None)
+            if not future or future.done():
+                return
+            if "error" in data:
+                future.set_exception(CDPError(data["error"]))
+            else:
+                future.set_result(data.get("result", {}))
+            return
+        key = (data.get("sessionId"), data.get("method"))
+        handler = self._handlers.get(key)
+        if handler:
+            handler(data.get("params", {}))
+        for future in self._listeners.pop(key, []):
+            if not future.done():
+                future.set_result(data.get("params", {}))
+
+    async def send(self, method: str, params=None, session_id=None):
+        message = {"id": next(self._ids), "method": method}
+        message["params"] = params or {}
+        if session_id:
+            message["sessionId"] = session_id
+        if self._closed:
+            raise CDPError("DevTools connection closed")
+        future = asyncio.get_running_loop().create_future()
+        self._pending[message["id"]] = future
+        try:
+            await self.ws.send_str(json.dumps(message))
+            return await wait_for(future, timeout=COMMAND_TIMEOUT)
+        finally:
+            self._pending.pop(message["id"], None)
+
+    def on(self, method: str, handler, session_id=None):
+        """Calls handler with the params of every such event, until off.
+        It runs in the reader, so it must not block"""
+        self._handlers[(session_id, method)] = handler
+
+    def off(self, method: str, session_id=None):
+        self._handlers.pop((session_id, method), None)
+
+    def wait_for_event(self, method: str, session_id=None):
+        """Future for the next event, register it before triggering it"""
+        future = asyncio.get_running_loop().create_future()
+        if self._closed:
+            future.set_exception(CDPError("DevTools connection closed"))
+            return future
+        self._listeners.setdefault((session_id, method), []).append(future)
+        return future
+
+
+class TabPage:
+    """What we keep from a lesson loaded outside of the driver, in a tab or
+    over plain HTTP"""
+
+    def __init__(self, url, html, screenshot=None, pdf=None):
+        # Captures are kept base64 encoded, as CDP sends them
+        self.url = url
+        self.html = html
+        self.screenshot = screenshot
+        self.pdf = pdf
+
+
+async def fail_request(cdp: CDPConnection, session_id: str, params: dict):
+    BLOCKED_REQUESTS.inc(type=params.get("resourceType", "Other"))
+    try:
+        await cdp.send(
+            "Fetch.failRequest",
+            {
+                "requestId": params["requestId"],
+                "errorReason": "BlockedByClient",
+            },
+            session_id,
+        )
+    except CDPError:
+        # The tab is already gone
+        pass
+
+
+async def block_requests(cdp: CDPConnection, session_id: str):
+    """Drops the heavy and third party requests of the tab: the blocked
+    urls, and whatever image, font or media Fetch pauses"""
+    await cdp.send("Network.enable", session_id=session_id)
+    await cdp.send(
+        "Network.setBlockedURLs", {"urls": BLOCKED_URLS}, session_id
+    )
+    cdp.on(
+        "Fetch.requestPaused",
+        lambda params: asyncio.create_task(
+            fail_request(cdp, session_id, params)
+        ),
+        session_id,
+    )
+    await cdp.send("Fetch.enable", {"patterns": fetch_patterns()}, session_id)
+
+
+async def load_in_tab(cdp: CDPConnection, url: str, capture=None, block=False):
+    target = await cdp.send(
+        "Target.createTarget", {"url": "about:blank", "background": True}
+    )
+    target_id = target["targetId"]
+    try:
+        attached = await cdp.send(
+            "Target.attachToTarget", {"targetId": target_id, "flatten": True}
+        )
+        session_id = attached["sessionId"]
+        await cdp.send("Page.enable", session_id=session_id)
+        if block:
+            await block_requests(cdp, session_id)
+
+        with PAGE_LOAD_SECONDS.time(loader="tab"):
+            loaded = cdp.wait_for_event("Page.loadEventFired", session_id)
+            await cdp.send("Page.navigate", {"url": url}, session_id)
+            await wait_for(loaded, timeout=PAGE_TIMEOUT)
+
+            result = await cdp.send(
+                "Runtime.evaluate",
+                {
+                    "expression": "document.documentElement.outerHTML",
+                    "returnByValue": True,
+                },
+                session_id,
+            )
+        page = TabPage(url, result["result"]["value"])
+        if capture and capture.screenshot:
+            with CAPTURE_SECONDS.time(kind="screenshot"):
+                page.screenshot = await capture_screenshot(
+                    cdp, session_id, capture.screenshot_params()
+                )
+        # Deferred pdfs are rendered later from the saved html
+        if capture and capture.pdf and not capture.defer_pdf:
+            with CAPTURE_SECONDS.time(kind="pdf"):
+                page.pdf = await print_to_pdf(cdp, session_id)
+        return page
+    finally:
+        if block:
+            cdp.off("Fetch.requestPaused", session_id)
+        await cdp.send("Target.closeTarget", {"targetId": target_id})
+
+
+async def capture_screenshot(
+    cdp: CDPConnection, session_id: str, params: dict
+) -> str:
+    """Base64 encoded screenshot of the whole page"""
+    metrics = await cdp.send("Page.getLayoutMetrics", session_id=session_id)
+    size = metrics.get("cssContentSize", metrics["contentSize"])
+    params = dict(params, clip=full_page_clip(size))
+    result = await cdp.send("Page.captureScreenshot", params, session_id)
+    return result["data"]
+
+
+async def print_to_pdf(cdp: CDPConnection, session_id: str) -> str:
+    await cdp.send(
+        "Emulation.setEmulatedMedia", {"media": "screen"}, session_id
+    )
+    result = await cdp.send(
+        "Page.printToPDF",
+        {"paperHeight": 92, "paperWidth": 8, "printBackground": True},
+        session_id,
+    )
+    return result["data"]
+
+
+async def fetch_pages(
+    debugger_address, urls, max_tabs=MAX_TABS, capture=None, block=False
+):
+    """Loads the urls in up to max_tabs tabs of the same Chrome at once,
+    without the requests of request_blocking when block is set.
+    Pages that failed to load are returned as None"""
+    sem = Semaphore(max_tabs)
+
+    async with CDPConnection(debugger_address) as cdp:
+
+        async def fetch_one(url):
+            async with sem:
+                try:
+                    return await load_in_tab(cdp, url, capture, block)
+                except Exception as e:
+                    logger.warning(f"Failed to load {url} in a tab: {e}")
+                    return None
+
+        return await gather(*[fetch_one(url) for url in urls])
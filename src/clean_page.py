@@ -1,9 +1,19 @@
-import sys
+import argparse
+from concurrent.futures import as_completed
 from pathlib import Path
 
 from bs4 import BeautifulSoup
 from tqdm import tqdm
 
+from misc import get_html_parser, process_pool
+from processing_manifest import ProcessingManifest
+
+# Bump when clean_html_file changes, so every page is cleaned again
+CLEAN_VERSION = 1
+
+# Files sanitize_file_names renames
+FILE_EXTENSIONS = {".html", ".css", ".png", ".mp3", ".pdf", ".zip", ".mp4"}
+
 
 def sanitize_string(string):
     return (
@@ -54,11 +64,14 @@ def get_valid_files(files):
 
 def sanitize_file_names(path, apply=False):
     print("Sanitizing file names")
-    files_to_edit = []
     folder_path = Path(path)
     print("Getting all files")
-    for ext in ["html", "css", "png", "mp3", "pdf", "zip", "mp4"]:
-        files_to_edit.extend(folder_path.glob(f"**/*.{ext}"))
+    # One walk of the tree for all the extensions
+    files_to_edit = [
+        file
+        for file in folder_path.rglob("*")
+        if file.suffix in FILE_EXTENSIONS and file.is_file()
+    ]
 
     for file in tqdm(files_to_edit):
         path_as_str = str(file)
@@ -72,45 +85,76 @@ def sanitize_file_names(path, apply=False):
             file.rename(new_name)
 
 
-def remove_scripts_and_sanitize_mp4_inside_html(path):
-    print("Changing video in html, removing scripts, removing broken images")
-    files_to_edit = []
-    folder_path = Path(path)
-
-    print("Getting all htmls")
-    for ext in ["html"]:
-        files_to_edit.extend(folder_path.glob(f"**/*-giow.{ext}"))
+def clean_html_file(file, parser="html.parser"):
+    file = Path(file)
+    with file.open("r") as f:
+        soup = BeautifulSoup(f.read(), parser)
+        video = soup.find("source")
+        # Sanitize video string
+        if video:
+            if video.has_attr("src"):
+                video["src"] = sanitize_string(video["src"])
 
-    for file in tqdm(files_to_edit):
-        with file.open("r") as f:
-            soup = BeautifulSoup(f.read(), "html.parser")
-            video = soup.find("source")
-            # Sanitize video string
-            if video:
-                if video.has_attr("src"):
-                    video["src"] = sanitize_string(video["src"])
+    # Remove broken images
+    imgs = soup.find_all("img", {"src": "img/img"})
+    for img in imgs:
+        img.decompose()
 
-        # Remove broken images
-        imgs = soup.find_all("img", {"src": "img/img"})
-        for img in imgs:
-            img.decompose()
+    # Remove scripts from pages that don't need them
+    if "assessment" not in str(file):
+        for script in soup("script"):
+            script.decompose()
 
-        # Remove scripts from pages that don't need them
-        if "assessment" not in str(file):
-            for script in soup("script"):
-                script.decompose()
+    with file.open("w") as f:
+        f.write(str(soup))
 
-        with file.open("w") as f:
-            f.write(str(soup))
 
+def remove_scripts_and_sanitize_mp4_inside_html(
+    path, workers=1, parser="html.parser"
+):
+    print("Changing video in html, removing scripts, removing broken images")
+    manifest = ProcessingManifest(path, "clean", CLEAN_VERSION)
 
-def clean_pages(path):
+    print("Getting all htmls")
+    # Pages are cleaned in place, only the ones written since the last
+    # clean are left
+    files_to_edit = [
+        file
+        for file in Path(path).glob("**/*-giow.html")
+        if not manifest.is_current(file, file)
+    ]
+    print(f"{len(files_to_edit)} new or modified pages to clean")
+
+    if workers > 1:
+        with process_pool(workers) as pool:
+            futures = {
+                pool.submit(clean_html_file, file, parser): file
+                for file in files_to_edit
+            }
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                try:
+                    future.result()
+                    manifest.record(futures[future], futures[future])
+                except Exception as e:
+                    print(f"Failed to clean {futures[future]}: {e}")
+    else:
+        for file in tqdm(files_to_edit):
+            clean_html_file(file, parser)
+            manifest.record(file, file)
+    manifest.close()
+
+
+def clean_pages(path, workers=1, parser=None):
+    parser = get_html_parser(parser or "html.parser")
     sanitize_folder_names(path, apply=True)
     sanitize_file_names(path, apply=True)
-    remove_scripts_and_sanitize_mp4_inside_html(path)
+    remove_scripts_and_sanitize_mp4_inside_html(path, workers, parser)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 2:
-        path = sys.argv[1]
-        clean_pages(path)
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("path")
+    arg_parser.add_argument("--workers", type=int, default=1)
+    arg_parser.add_argument("--parser", default="html.parser")
+    args = arg_parser.parse_args()
+    clean_pages(args.path, workers=args.workers, parser=args.parser)
@@ -0,0 +1,184 @@
+import re
+from collections import Counter
+
+from bs4 import Tag
+
+
+class Rule:
+    """Removes the tags matching all of the given conditions, only the first
+    one of the page when first is set"""
+
+    def __init__(
+        self,
+        name,
+        tags=None,
+        attrs=None,
+        class_contains=None,
+        block_words=None,
+        first=False,
+    ):
+        self.name = name
+        self.tags = set(tags) if tags else None
+        self.attrs = attrs or {}
+        self.class_contains = class_contains
+        self.first = first
+        self.block_pattern = None
+        if block_words:
+            self.block_pattern = re.compile(
+                "|".join(re.escape(word) for word in block_words),
+                re.IGNORECASE,
+            )
+
+    def matches(self, tag) -> bool:
+        """Checks everything but the block words, they depend on the
+        children and are looked up by RuleSet"""
+        if self.tags and tag.name not in self.tags:
+            return False
+        for attr, value in self.attrs.items():
+            if attr == "class":
+                if value not in tag.get("class", []):
+                    return False
+            elif tag.get(attr) != value:
+                return False
+        if self.class_contains:
+            if self.class_contains not in " ".join(tag.get("class", [])):
+                return False
+        return True
+
+    def blocks(self, text: str) -> bool:
+        return bool(self.block_pattern.search(text))
+
+
+def start_tag_text(tag) -> str:
+    """Name and attributes of the tag, the part of its markup that is not
+    in the children"""
+    parts = [tag.name]
+    for key, value in tag.attrs.items():
+        parts.append(key)
+        parts.append(" ".join(value) if isinstance(value, list) else value)
+    return " ".join(parts)
+
+
+class RuleSet:
+    """Applies the rules as if each one ran over the page in turn, in two
+    walks over the tags instead of one per rule.
+
+    Block words are looked for in what is left of the tag's markup once the
+    rules before have run, found children first so no tag is serialized.
+    Those rules are expected to remove all their matches, not only the
+    first one.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+
+    def apply(self, soup) -> Counter:
+        """Removes the matching tags, returns how many each rule removed"""
+        tags = soup.find_all(True)
+        blocked: dict = {}
+        for index, rule in enumerate(self.rules):
+            if rule.block_pattern:
+                blocked[index] = self.blocked(index, tags, blocked)
+
+        hits: Counter = Counter()
+        fired = set()
+        removed = []
+        # Index of the rule removing the tag or one of its parents, the
+        # rules after that one never see the tag
+        gone = {}
+        for tag in tags:
+            before = gone.get(id(tag.parent), len(self.rules))
+            for index in range(before):
+                if index in fired or not self.removes(index, tag, blocked):
+                    continue
+                if self.rules[index].first:
+                    fired.add(index)
+                hits[self.rules[index].name] += 1
+                gone[id(tag)] = index
+                if before == len(self.rules):
+                    removed.append(tag)
+                break
+            else:
+                if before < len(self.rules):
+                    gone[id(tag)] = before
+        for tag in removed:
+            tag.decompose()
+        return hits
+
+    def removes(self, index, tag, blocked) -> bool:
+        rule = self.rules[index]
+        if not rule.matches(tag):
+            return False
+        return not rule.block_pattern or blocked[index][id(tag)]
+
+    def blocked(self, index, tags, blocked) -> dict:
+        """Whether each tag's markup has the block words of the rule, the
+        children removed by the rules before left out"""
+        rule = self.rules[index]
+        found: dict = {}
+        for tag in reversed(tags):
+            hit = rule.blocks(start_tag_text(tag))
+            for child in tag.contents:
+                if hit:
+                    break
+                if not isinstance(child, Tag):
+                    hit = rule.blocks(str(child))
+                elif found[id(child)]:
+                    hit = not any(
+                        self.removes(earlier, child, blocked)
+                        for earlier in range(index)
+                    )
+            found[id(tag)] = hit
+        return found
+
+
+CLEANUP_RULES = RuleSet(
+    [
+        Rule("google_analytics", tags=["noscript"]),
+        Rule("octa", tags=["div"], class_contains="octa"),
+        Rule(
+            "telemetry_scripts",
+            tags=["script", "a", "input", "meta"],
+            block_words=[
+                "user",
+                "analyt",
+                "google",
+                "octa",
+                "chat",
+                "survey",
+                "track",
+                "metric",
+                "token",
+            ],
+        ),
+        Rule(
+            "user_area",
+            tags=["div"],
+            attrs={"class": "social_area"},
+            first=True,
+        ),
+        Rule(
+            "after_video",
+            tags=["div"],
+            attrs={"class": "btn_vid_after"},
+            first=True,
+        ),
+        Rule(
+            "audio_js", tags=["div"], attrs={"class": "post-audio"}, first=True
+        ),
+        Rule(
+            "unit_downloads",
+            tags=["div"],
+            attrs={"class": "sidebar"},
+            first=True,
+        ),
+        Rule(
+            "survey", tags=["div"], attrs={"id": "survicate-box"}, first=True
+        ),
+        Rule(
+            "add_to_deck", tags=["a"], attrs={"class": "add_deck"}, first=True
+        ),
+        Rule("walk_and_talk", tags=["body"], attrs={"class": "containEmbed"}),
+        Rule("mail", tags=["input"], attrs={"id": "assessment_result_email"}),
+    ]
+)
@@ -0,0 +1,178 @@
+import json
+import sqlite3
+import sys
+import time
+from collections import deque
+from threading import Lock
+
+from misc import file_path
+
+DONE = "done"
+FAILED = "failed"
+PENDING = "pending"
+
+
+class CrawlState:
+    """Crawl progress kept in SQLite (WAL mode).
+
+    Every lesson and module is recorded with a single row write as soon as
+    it finishes, so a checkpoint costs the same at the end of a course as at
+    the beginning and a crash can't leave a half written state behind.
+    Supports `in` and `add` so it can stand in for the old visited links set.
+    """
+
+    def __init__(self, db_file="crawl_state.db"):
+        self.conn = sqlite3.connect(
+            file_path(db_file), isolation_level=None, check_same_thread=False
+        )
+        self.lock = Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS modules (
+                url TEXT PRIMARY KEY,
+                position INTEGER,
+                status TEXT,
+                updated_at REAL
+            )"""
+        )
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS lessons (
+                url TEXT PRIMARY KEY,
+                module_url TEXT,
+                status TEXT,
+                updated_at REAL
+            )"""
+        )
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS fingerprints (
+                url TEXT PRIMARY KEY,
+                fingerprint TEXT,
+                updated_at REAL
+            )"""
+        )
+
+    def _execute(self, query, params=()):
+        with self.lock:
+            return self.conn.execute(query, params).fetchall()
+
+    def has_modules(self) -> bool:
+        return bool(self._execute("SELECT 1 FROM modules LIMIT 1"))
+
+    def add_modules(self, queue):
+        with self.lock:
+            with self.conn:
+                self.conn.execute("BEGIN")
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO modules VALUES (?, ?, ?, ?)",
+                    [
+                        (url, position, PENDING, time.time())
+                        for position, url in enumerate(queue)
+                    ],
+                )
+
+    def update_modules(self, queue):
+        """Adds the modules of queue that are new and puts every module of
+        queue in its order, keeping what was done"""
+        with self.lock:
+            with self.conn:
+                self.conn.execute("BEGIN")
+                self.conn.executemany(
+                    """INSERT INTO modules VALUES (?, ?, ?, ?)
+                    ON CONFLICT(url) DO UPDATE SET position = excluded.position""",
+                    [
+                        (url, position, PENDING, time.time())
+                        for position, url in enumerate(queue)
+                    ],
+                )
+
+    def pending_modules(self) -> deque:
+        rows = self._execute(
+            "SELECT url FROM modules WHERE status != ? ORDER BY position",
+            (DONE,),
+        )
+        return deque(url for url, in rows)
+
+    def all_modules(self) -> deque:
+        rows = self._execute("SELECT url FROM modules ORDER BY position")
+        return deque(url for url, in rows)
+
+    def mark_module_done(self, url):
+        self._execute(
+            "UPDATE modules SET status = ?, updated_at = ? WHERE url = ?",
+            (DONE, time.time(), url),
+        )
+
+    def mark_lesson(self, url, status=DONE, module_url=None):
+        self._execute(
+            "INSERT OR REPLACE INTO lessons VALUES (?, ?, ?, ?)",
+            (url, module_url, status, time.time()),
+        )
+
+    def add(self, url):
+        self.mark_lesson(url)
+
+    def module_lessons(self, module_url, status=DONE) -> list:
+        """Lessons of the module recorded with that status"""
+        rows = self._execute(
+            """SELECT url FROM lessons WHERE module_url = ? AND status = ?
+            ORDER BY url""",
+            (module_url, status),
+        )
+        return [url for url, in rows]
+
+    def __contains__(self, url) -> bool:
+        return bool(
+            self._execute(
+                "SELECT 1 FROM lessons WHERE url = ? AND status = ?",
+                (url, DONE),
+            )
+            or self._execute(
+                "SELECT 1 FROM modules WHERE url = ? AND status = ?",
+                (url, DONE),
+            )
+        )
+
+    def get_fingerprint(self, url) -> dict | None:
+        """Content hashes of the page the last time it was saved"""
+        rows = self._execute(
+            "SELECT fingerprint FROM fingerprints WHERE url = ?", (url,)
+        )
+        if not rows:
+            return None
+        return json.loads(rows[0][0])
+
+    def save_fingerprint(self, url, fingerprint: dict):
+        self._execute(
+            "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?)",
+            (url, json.dumps(fingerprint), time.time()),
+        )
+
+    def import_visited_links(self, visited_links):
+        """Migrates the visited links of an old pickle checkpoint"""
+        with self.lock:
+            with self.conn:
+                self.conn.execute("BEGIN")
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO lessons VALUES (?, NULL, ?, ?)",
+                    [(url, DONE, time.time()) for url in visited_links],
+                )
+
+    def progress(self) -> dict:
+        progress = {}
+        for table in ["modules", "lessons"]:
+            rows = self._execute(
+                f"SELECT status, COUNT(*) FROM {table} GROUP BY status"
+            )
+            progress[table] = dict(rows)
+        return progress
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    db_file = sys.argv[1] if len(sys.argv) == 2 else "crawl_state.db"
+    state = CrawlState(db_file)
+    for table, statuses in state.progress().items():
+        print(f"{table}: {statuses}")
@@ -1,44 +1,66 @@
 from asyncio import run
 from collections import deque
+from concurrent.futures import Future
 from pathlib import Path
+from threading import Lock
 from urllib.parse import urlparse
 
 from tqdm import tqdm
 
+from cdp_tabs import TabPage, fetch_pages
+from crawl_state import FAILED, CrawlState
 from downloader import Downloader
+from http_page_loader import HttpPageLoader
 from misc import (
     file_path,
     load_queue,
     load_visited_links,
     sanitize_string,
-    save_queue,
-    save_visited_links,
     set_logging_handlers,
 )
-from page_loader import PageLoader
+from page_capture import CaptureOptions, CaptureQueue
 from page_parser import PageParser
+from profiling import NO_PROFILER
+from request_blocking import BLOCKED_URLS
+from transfer_scheduler import ATTACHMENT
 
 logger = set_logging_handlers("logs.log")
 
+# What save_lesson saves, the captures go with the html
+ARTIFACTS = frozenset(["html", "files", "video", "assessment"])
 
-def get_queue(parser, modules_to_crawl):
+
+def get_queue(
+    parser, modules_to_crawl, state_file="crawl_state.db", sync=False
+):
+    """Modules left to crawl, every module with sync"""
     print("Getting queue...")
-    # Generate and save the queue if it doesnt exist
-    modules_queue = "modules_queue.pkl"
-    print(file_path(modules_queue))
-    if not Path(file_path(modules_queue)).exists():
-        print("Generating queue...")
-        queue = generate_queue(parser, modules_to_crawl)
-        save_queue(queue, modules_queue)
-        visited_links = set(["https://cursos.fluencyacademy.io/"])
-        save_visited_links(visited_links, "visited_links.pkl")
-        return queue, visited_links
+    crawl_state = CrawlState(state_file)
+    if sync and crawl_state.has_modules():
+        print("Adding the modules new in the menu to the queue...")
+        crawl_state.update_modules(generate_queue(parser, modules_to_crawl))
+        return crawl_state.all_modules(), crawl_state
     # Load previously created queue
-    else:
+    if crawl_state.has_modules():
         print("Loading previously created queue...")
-        queue = load_queue(modules_queue)
-        visited_links = load_visited_links("visited_links.pkl")
-        return queue, visited_links
+        return crawl_state.pending_modules(), crawl_state
+
+    # Carry over the progress of an old pickle checkpoint
+    modules_queue = "modules_queue.pkl"
+    if Path(file_path(modules_queue)).exists():
+        print("Importing queue from previous pickle checkpoint...")
+        crawl_state.add_modules(load_queue(modules_queue))
+        crawl_state.import_visited_links(
+            load_visited_links("visited_links.pkl")
+        )
+        return crawl_state.pending_modules(), crawl_state
+
+    # Generate and save the queue if it doesnt exist
+    print("Generating queue...")
+    queue = generate_queue(parser, modules_to_crawl)
+    crawl_state.add_modules(queue)
+    crawl_state.add("https://cursos.fluencyacademy.io/")
+    return queue, crawl_state
 
 
 def generate_queue(parser, modules_to_crawl):
@@ -85,94 +107,433 @@ def enumerate_path_to_save(lesson_count, path):
     return Path(path)
 
 
-def crawl(queue, visited_links):
+def lesson_folder(record, lesson_count) -> Path:
+    return enumerate_path_to_save(lesson_count, sanitize_string(record.path))
+
+
+def lesson_fingerprint(parser, lesson_count) -> dict:
+    """Content hashes of the lesson, with the folder it is saved in"""
+    fingerprint = parser.fingerprint()
+    fingerprint["folder"] = str(lesson_folder(parser.extract(), lesson_count))
+    return fingerprint
+
+
+class CrawlOptions:
+    """How pages are loaded and what is saved for each lesson"""
+
+    def __init__(
+        self,
+        max_tabs=1,
+        capture=None,
+        http_pages=False,
+        sync=False,
+        pipeline=None,
+        parser_backend="html.parser",
+        profiler=None,
+        block_resources=False,
+    ):
+        # Lessons of a module loaded at the same time in tabs of one Chrome
+        self.max_tabs = max_tabs
+        # Screenshot and pdf saved for every lesson
+        self.capture = capture or CaptureOptions()
+        # Get pages over plain HTTP when there is nothing to capture,
+        # Chrome is only used when the page is missing what we parse
+        self.http_pages = http_pages
+        # Visit every lesson again and redo only what changed since the
+        # last crawl
+        self.sync = sync
+        # LessonPipeline that gets every lesson folder once it is done
+        self.pipeline = pipeline
+        # What PageParser.extract parses lessons with, see EXTRACT_BACKENDS
+        self.parser_backend = parser_backend
+        # Profiles the crawl of every module, see profiling.Profiler
+        self.profiler = profiler or NO_PROFILER
+        # Don't load images, fonts, media and trackers when no capture
+        # needs the page as it looks
+        self.block_resources = block_resources
+
+
+def crawl(queue, crawl_state, page_loader_pool, options=None):
     """First load the first page in the module, parse it, follow links in the left bar"""
+    options = options or CrawlOptions()
     print("Crawling...")
-    while tqdm(queue):
-        module_to_crawl = queue[0]  # do not pop yet
-        page_loader = PageLoader()
-        # Load Page
-        print("Loading first page to get the submodules...")
-        page_html = page_loader.load_page(module_to_crawl)
-        if not page_html:
-            logger.warning(f"Request to page failed: {module_to_crawl}")
-            break
-
-        parser = PageParser(page_html)
-        if not parser:
-            logger.warning(f"Could not parse page: {page_html}")
-            break
-
-        # Extract info
-        title = sanitize_string(parser.get_lesson_title())
-        path = sanitize_string(parser.get_lesson_path())
-        files = parser.find_post_downloads()
-        video_url = parser.find_video()
-        assessment = parser.find_assessment()
-
-        _, section_lessons = parser.find_section_lessons()
-
-        lesson_count = 1
-        path = enumerate_path_to_save(lesson_count, path)
-        show_lesson_info(title, path, files, video_url, assessment)
-
-        # Save page
-        create_lesson_path(path)
-        save_page_html(page_loader, title, path)
-        save_screenshot(page_loader, title, path)
-        download_video(title, path, video_url)
-        download_files(path, files)
-        download_assessment(page_loader, path, assessment)
+    if options.block_resources and not block_requests(options):
+        print("Screenshots and inline pdfs need the whole page, not blocking")
+    if options.http_pages and not use_http_pages(options):
+        print("Screenshots and inline pdfs need Chrome, not using HTTP pages")
+    captures = CaptureQueue(options.capture, page_loader_pool)
+    pending_videos = []
+    try:
+        while tqdm(queue):
+            module_to_crawl = queue[0]  # do not pop yet
+            # Take a warm driver from the pool instead of starting a new Chrome
+            stage = options.profiler.stage(f"crawl {module_to_crawl}")
+            with page_loader_pool.loader() as page_loader, stage:
+                videos = crawl_module(
+                    page_loader,
+                    module_to_crawl,
+                    crawl_state,
+                    options,
+                    captures,
+                )
+            if videos is None:
+                break
 
-        # 1: is to ignore the first one that we crawled
-        for lesson_url in tqdm(section_lessons[1:]):
-            if lesson_url in visited_links:
-                lesson_count += 1
-                print(f"Skipping already visited link {lesson_url}")
-                continue
+            # Finally pop module url from the queue, it is saved as done once
+            # its videos finished downloading in the background
+            pending_videos.extend(videos)
+            pending_videos.append(
+                when_done(
+                    videos, crawl_state.mark_module_done, queue.popleft()
+                )
+            )
+    finally:
+        captures.close()
+        # Their lessons are only marked done and sent to the pipeline after
+        # the download, that is done too once these are. After a failed
+        # attempt too, before the crawl is tried again
+        wait_for_videos(pending_videos)
+
+
+def wait_for_videos(pending_videos):
+    print(f"Waiting for {len(pending_videos)} videos to finish...")
+    failed = [video for video in tqdm(pending_videos) if video.exception()]
+    if failed:
+        print("Some videos failed, their lessons are crawled again next run")
+
+
+def crawl_module(page_loader, module_to_crawl, crawl_state, options, captures):
+    """Returns the video downloads started for the module, as futures that
+    finish once the lesson of each video is done, None if the module could
+    not be loaded"""
+    page_loader.set_blocked_urls(
+        BLOCKED_URLS if block_requests(options) else []
+    )
+    # Load Page
+    print("Loading first page to get the submodules...")
+    page_html, page = load_lesson_page(page_loader, module_to_crawl, options)
+    if not page_html:
+        logger.warning(f"Request to page failed: {module_to_crawl}")
+        return None
+
+    parser = PageParser(page_html, options.parser_backend)
+    if not parser:
+        logger.warning(f"Could not parse page: {page_html}")
+        return None
+
+    _, section_lessons = parser.find_section_lessons()
+    videos = []
+    fingerprint = lesson_fingerprint(parser, 1)
+    artifacts = artifacts_to_save(
+        crawl_state, module_to_crawl, fingerprint, options
+    )
+    video, lesson_dir = save_lesson(
+        page_loader, parser, 1, captures, page, artifacts
+    )
+    if video:
+        videos.append(video)
+
+    def first_page_done():
+        crawl_state.save_fingerprint(module_to_crawl, fingerprint)
+        send_to_pipeline(options, lesson_dir)
+
+    videos = [when_done(videos, first_page_done)]
+
+    # 1: is to ignore the first one that we crawled
+    lessons = section_lessons[1:]
+    if options.max_tabs > 1 and not use_http_pages(options):
+        crawl_lessons_in_tabs(
+            page_loader,
+            module_to_crawl,
+            lessons,
+            crawl_state,
+            options,
+            captures,
+            videos,
+        )
+    else:
+        crawl_lessons(
+            page_loader,
+            module_to_crawl,
+            lessons,
+            crawl_state,
+            options,
+            captures,
+            videos,
+        )
+    return videos
+
+
+def crawl_lessons(
+    page_loader, module_url, lessons, crawl_state, options, captures, videos
+):
+    for lesson_count, lesson_url in enumerate(tqdm(lessons), start=2):
+        if not options.sync and lesson_url in crawl_state:
+            print(f"Skipping already visited link {lesson_url}")
+            continue
+
+        lesson_html, page = load_lesson_page(page_loader, lesson_url, options)
+        if not lesson_html:
+            logger.warning(f"Request to page failed: {lesson_url}")
+            crawl_state.mark_lesson(lesson_url, FAILED, module_url)
+            continue
 
-            lesson_html = page_loader.load_page(lesson_url)
+        parser = PageParser(lesson_html, options.parser_backend)
+        if not parser:
+            logger.warning(f"Could not parse page: {lesson_html}")
+            continue
+
+        fingerprint = lesson_fingerprint(parser, lesson_count)
+        artifacts = artifacts_to_save(
+            crawl_state, lesson_url, fingerprint, options
+        )
+        saved = save_lesson(
+            page_loader, parser, lesson_count, captures, page, artifacts
+        )
+        save_lesson_state(
+            crawl_state,
+            module_url,
+            lesson_url,
+            fingerprint,
+            saved,
+            videos,
+            options,
+        )
+
+
+def crawl_lessons_in_tabs(
+    page_loader, module_url, lessons, crawl_state, options, captures, videos
+):
+    """Loads the lessons max_tabs at a time in tabs of the same Chrome,
+    then saves them in order"""
+    max_tabs = options.max_tabs
+    to_visit = [
+        (lesson_count, lesson_url)
+        for lesson_count, lesson_url in enumerate(lessons, start=2)
+        if options.sync or lesson_url not in crawl_state
+    ]
+    for start in tqdm(range(0, len(to_visit), max_tabs)):
+        batch = to_visit[start : start + max_tabs]
+        # Tabs wear Chrome out like the pages of the driver do
+        page_loader.check_health()
+        page_loader.pages_loaded += len(batch)
+        pages = run(
+            fetch_pages(
+                page_loader.debugger_address,
+                [lesson_url for _, lesson_url in batch],
+                max_tabs,
+                capture=options.capture,
+                block=block_requests(options),
+            )
+        )
+        for (lesson_count, lesson_url), page in zip(batch, pages):
+            if page:
+                lesson_html = page.html
+            else:
+                # Try again on the driver itself
+                lesson_html = page_loader.load_page(lesson_url)
             if not lesson_html:
-                logger.warning(f"Request to page failed: {module_to_crawl}")
+                logger.warning(f"Request to page failed: {lesson_url}")
+                crawl_state.mark_lesson(lesson_url, FAILED, module_url)
                 continue
 
-            parser = PageParser(lesson_html)
+            parser = PageParser(lesson_html, options.parser_backend)
             if not parser:
                 logger.warning(f"Could not parse page: {lesson_html}")
                 continue
 
-            title = sanitize_string(parser.get_lesson_title())
-            path = sanitize_string(parser.get_lesson_path())
-            files = parser.find_post_downloads()
-            video_url = parser.find_video()
-            assessment = parser.find_assessment()
-
-            lesson_count += 1
-            path = enumerate_path_to_save(lesson_count, path)
-
-            show_lesson_info(title, path, files, video_url, assessment)
-            create_lesson_path(path)
-            save_page_html(page_loader, title, path)
-            save_screenshot(page_loader, title, path)
+            fingerprint = lesson_fingerprint(parser, lesson_count)
+            artifacts = artifacts_to_save(
+                crawl_state, lesson_url, fingerprint, options
+            )
+            saved = save_lesson(
+                page_loader, parser, lesson_count, captures, page, artifacts
+            )
+            save_lesson_state(
+                crawl_state,
+                module_url,
+                lesson_url,
+                fingerprint,
+                saved,
+                videos,
+                options,
+            )
+
+
+def artifacts_to_save(crawl_state, url, fingerprint, options):
+    """What has to be saved for the lesson, in sync mode only the parts
+    whose content changed since the last crawl. A lesson that moved to
+    another folder, renumbered by a lesson added before it too, is saved
+    again in full"""
+    if not options.sync:
+        return ARTIFACTS
+    previous = crawl_state.get_fingerprint(url)
+    if not previous:
+        return ARTIFACTS
+    if (
+        previous.get("folder") != fingerprint["folder"]
+        or previous["breadcrumbs"] != fingerprint["breadcrumbs"]
+    ):
+        move_lesson_folder(previous.get("folder"), fingerprint["folder"])
+        return ARTIFACTS
+    changed = {
+        part for part in fingerprint if fingerprint[part] != previous[part]
+    }
+    artifacts = changed & ARTIFACTS
+    if "body" in changed:
+        artifacts.add("html")
+    return artifacts
+
+
+def move_lesson_folder(old_folder, new_folder):
+    """Moves what was saved for a lesson to its new folder, so the video is
+    not downloaded again and no stale folder is left behind"""
+    if not old_folder or old_folder == new_folder:
+        return
+    old_path = Path(file_path(old_folder))
+    new_path = Path(file_path(new_folder))
+    if not old_path.is_dir() or new_path.exists():
+        return
+    print(f"Lesson moved, from {old_folder} to {new_folder}")
+    new_path.parent.mkdir(parents=True, exist_ok=True)
+    old_path.rename(new_path)
+
+
+def save_lesson_state(
+    crawl_state, module_url, lesson_url, fingerprint, saved, videos, options
+):
+    video, lesson_dir = saved
+
+    def lesson_done():
+        crawl_state.save_fingerprint(lesson_url, fingerprint)
+        crawl_state.mark_lesson(lesson_url, module_url=module_url)
+        send_to_pipeline(options, lesson_dir)
+
+    # A lesson is only done once its video is downloaded, when the
+    # download fails it is left for the next run
+    if video:
+        videos.append(when_done([video], lesson_done))
+    else:
+        lesson_done()
 
-            download_video(title, path, video_url)
-            download_files(path, files)
-            download_assessment(page_loader, path, assessment)
 
-            # Save the state
-            visited_links.add(lesson_url)
-            save_visited_links(visited_links, "visited_links.pkl")
+def send_to_pipeline(options, lesson_dir):
+    if options.pipeline and lesson_dir:
+        options.pipeline.add(lesson_dir)
 
-        # Kill our pageloader so it doesnt use too much RAM
-        page_loader.driver.close()
-        page_loader.driver.quit()
 
-        # Finally pop module url from the queue
-        visited_links.add(queue.popleft())
+def when_done(futures, callback, *args) -> Future:
+    """Calls callback(*args) once all the futures are finished, unless one
+    of them failed. Returns a future that finishes after the callback ran,
+    the futures themselves may finish before, and fails like they did"""
+    done: Future = Future()
 
-        # Save the state
-        save_queue(queue, "modules_queue.pkl")
-        save_visited_links(visited_links, "visited_links.pkl")
+    def finish():
+        error = next((f.exception() for f in futures if f.exception()), None)
+        if error:
+            logger.warning(f"Not running {callback.__name__}: {error}")
+            done.set_exception(error)
+            return
+        try:
+            callback(*args)
+        except Exception as e:
+            logger.error(f"{callback.__name__} failed: {e}")
+        done.set_result(None)
+
+    if not futures:
+        finish()
+        return done
+    remaining = [len(futures)]
+    lock = Lock()
+
+    def on_done(_):
+        with lock:
+            remaining[0] -= 1
+            finished = remaining[0] == 0
+        if finished:
+            finish()
+
+    for future in futures:
+        future.add_done_callback(on_done)
+    return done
+
+
+def block_requests(options) -> bool:
+    return options.block_resources and not options.capture.needs_live_page
+
+
+def use_http_pages(options):
+    # Screenshots and inline pdfs need the page rendered in Chrome
+    return options.http_pages and not options.capture.needs_live_page
+
+
+def load_lesson_page(page_loader, url, options):
+    """Returns the html of the lesson, and a TabPage with it when it did
+    not come from the driver"""
+    if use_http_pages(options):
+        html = HttpPageLoader().load_page(url)
+        if (
+            html
+            and PageParser(html, options.parser_backend).has_lesson_elements()
+        ):
+            return html, TabPage(url, html)
+        print(f"Page incomplete over HTTP, loading it in Chrome: {url}")
+    return page_loader.load_page(url), None
+
+
+def save_lesson(
+    page_loader,
+    parser,
+    lesson_count,
+    captures,
+    tab_page=None,
+    artifacts=None,
+):
+    """Saves the page, its captures and downloads everything in it.
+    tab_page holds the html and captures when the lesson was not loaded in
+    the driver (tabs, HTTP), otherwise they are taken from the driver.
+    artifacts limits what is saved (see ARTIFACTS), for a re-sync.
+    Returns the video download running in the background, if any, and the
+    lesson folder (None when nothing was saved)"""
+    artifacts = ARTIFACTS if artifacts is None else artifacts
+    record = parser.extract()
+    title = sanitize_string(record.title)
+    files = record.files
+    video_url = record.video
+    assessment = record.assessment
+
+    path = lesson_folder(record, lesson_count)
+    if not artifacts:
+        print(f"Unchanged, skipping: {path}")
+        return None, None
+    show_lesson_info(title, path, files, video_url, assessment)
+
+    # Save page
+    create_lesson_path(path)
+    if "html" in artifacts:
+        if tab_page:
+            save_tab_page(tab_page, title, path, captures)
+        else:
+            save_page_html(page_loader, title, path)
+            captures.save_screenshot(page_loader, str(path / title))
+        if not (tab_page and tab_page.pdf):
+            html_file = file_path(str(path / title)) + ".html"
+            page_url = (
+                tab_page.url if tab_page else page_loader.driver.current_url
+            )
+            captures.save_pdf(
+                page_loader, str(path / title), html_file, page_url
+            )
+    video = None
+    if "video" in artifacts:
+        video = download_video(
+            title, path, video_url, replace=artifacts is not ARTIFACTS
+        )
+    if "files" in artifacts:
+        download_files(path, files)
+    if "assessment" in artifacts:
+        download_assessment(page_loader, path, assessment)
+    return video, Path(file_path(str(path)))
 
 
 def download_assessment(page_loader, path, assessment):
@@ -181,6 +542,7 @@ def download_assessment(page_loader, path, assessment):
         try:
             print("Loading Assessment Page...")
             page_loader.driver.get(assessment)
+            page_loader.wait_until_complete()
             assess_path = path / "assessment"
             assess_path.mkdir(parents=True, exist_ok=True)
             page_loader.save_html(assess_path / "assessment_page")
@@ -204,45 +566,34 @@ def download_files(path, files):
             # Add to download list
             download_list.add((file_url, str(full_path)))
         print("Downloading files...")
-        downloader = Downloader()
-        run(downloader.download_list_of_files(download_list))
+        Downloader().download_files(download_list, ATTACHMENT)
 
 
-def download_video(title, path, video_url):
+def download_video(title, path, video_url, replace=False):
     if video_url:
         print(f"Downloading Video: {path}")
         file_path = path / (title + ".mp4")
+        if replace:
+            # The lesson has a new video
+            file_path.unlink(missing_ok=True)
         if not file_path.exists():  # Download only if it didnt previously
-            tries = 3
-            for attempt in range(tries):
-                try:
-                    Downloader.download_video_mp4(video_url, path, title)
-                except Exception as e:
-                    logger.warning(f"Download failed for video: {video_url}")
-                    logger.warning(f"Error: {str(e)}")
-                    if attempt < tries - 1:
-                        continue
-                break
+            # Downloads in the background while we crawl the next lessons
+            return Downloader().submit_video(video_url, path, title)
         else:
             print("Video Already Exists, skipping...")
+    return None
 
 
-def save_screenshot_as_pdf(page_loader, path, title):
-    page_loader.send_devtools(
-        "Emulation.setEmulatedMedia", {"media": "screen"}
-    )
-    pdf_options = {
-        "paperHeight": 92,
-        "paperWidth": 8,
-        "printBackground": True,
-    }
-    page_loader.save_as_pdf(str(path / title) + ".pdf", pdf_options)
-
-
-def save_screenshot(page_loader, title, path):
-    print(f"Saving screenshot: {path/title}.png")
-    page_loader.save_screenshot(str(path / title))
-    page_loader.save_screenshot_as_pdf(str(path / title))
+def save_tab_page(tab_page, title, path, captures):
+    print(f"Saving Html: {path/title}.html")
+    with open(file_path(str(path / title)) + ".html", "w") as f:
+        f.write(tab_page.html)
+    if tab_page.screenshot:
+        image_format = captures.options.image_format
+        print(f"Saving screenshot: {path/title}.{image_format}")
+        captures.write(f"{path/title}.{image_format}", tab_page.screenshot)
+    if tab_page.pdf:
+        captures.write(f"{path/title}.pdf", tab_page.pdf)
 
 
 def save_page_html(page_loader, title, path):
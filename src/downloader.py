@@ -1,16 +1,59 @@
 import asyncio
+import atexit
+import hashlib
 import json
-from asyncio import Semaphore, gather, wait_for
+import os
+import time
+from asyncio import gather
+from concurrent.futures import Future
+from pathlib import Path
+from threading import Lock, Thread
 
 import aiofile
 import m3u8_To_MP4
+from aiohttp import ClientTimeout, TCPConnector
 from aiohttp.client import ClientSession
-from aiohttp.client_exceptions import InvalidURL
+from aiohttp.client_exceptions import ClientError, InvalidURL
 
+from hls import EncryptedStreamError, HlsDownload, UnsupportedPlaylistError
+from metrics import (
+    DOWNLOAD_RETRIES,
+    DOWNLOAD_TIMEOUTS,
+    DOWNLOADED_BYTES,
+    asset_type,
+)
+from misc import file_path as local_path
 from misc import set_logging_handlers
+from retry_policy import (
+    RetryPolicy,
+    host_of,
+    is_host_failure,
+    retry_after_seconds,
+)
+from transfer_scheduler import ASSET, VIDEO, TransferScheduler
 
-MAX_TASKS = 5
-MAX_TIME = 60
+# Transfers at the same time, each host also has its own adaptive limit
+MAX_TASKS = 16
+# Bytes/sec ceiling for all the transfers together, None for no limit,
+# main.py sets Downloader.max_bytes_per_sec with --max-bytes-per-sec
+MAX_BYTES_PER_SEC = None
+# A transfer that got no bytes for that many seconds has stalled
+STALL_TIMEOUT = 30
+CONNECT_TIMEOUT = 30
+# Slowest transfer we put up with, measured over MIN_RATE_WINDOW seconds,
+# slower ones are dropped and resumed with a new connection
+MIN_BYTES_PER_SEC = 16 * 1024
+MIN_RATE_WINDOW = 20
+MAX_CONNECTIONS = 20
+MAX_CONNECTIONS_PER_HOST = 16
+KEEPALIVE_TIMEOUT = 30
+DNS_CACHE_TTL = 300
+# The headers we got for every download, kept out of the lesson folders
+VALIDATORS_FOLDER = local_path(".http_validators")
+# Retries of a single file, of a whole video and of a page got over HTTP
+DOWNLOAD_RETRY = RetryPolicy(tries=3, base_delay=1, max_delay=30)
+VIDEO_RETRY = RetryPolicy(tries=3, base_delay=5, max_delay=60)
+PAGE_RETRY = RetryPolicy(tries=3, base_delay=1, max_delay=30)
 
 logger = set_logging_handlers("logs.log")
 
@@ -22,9 +65,139 @@ def get_cookie_string(json_obj: list):
     return "".join(cookie_string)
 
 
+def validators_path(file_path) -> Path:
+    """File with the headers we got for a download, named after its path"""
+    key = str(Path(file_path).absolute())
+    digest = hashlib.sha1(key.encode()).hexdigest()
+    return Path(VALIDATORS_FOLDER) / f"{digest}.json"
+
+
+def load_validators(file_path) -> dict:
+    try:
+        return json.loads(validators_path(file_path).read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def save_validators(file_path, resp, size=None):
+    validators = {
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+        "size": size,
+    }
+    path = validators_path(file_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(validators))
+
+
+def forget_validators(file_path):
+    """For a download that was moved away, its headers are of no use"""
+    validators_path(file_path).unlink(missing_ok=True)
+
+
+def request_headers(file_path, part_path) -> dict:
+    """Conditional headers for a file we have, Range for a partial one"""
+    headers = {}
+    if Path(file_path).exists():
+        validators = load_validators(file_path)
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+    elif part_path.exists() and part_path.stat().st_size:
+        headers["Range"] = f"bytes={part_path.stat().st_size}-"
+        # The range must count the bytes we saved, not compressed ones
+        headers["Accept-Encoding"] = "identity"
+        # Only resume if it is still the same file on the server
+        validators = load_validators(part_path)
+        if_range = validators.get("etag") or validators.get("last_modified")
+        if if_range:
+            headers["If-Range"] = if_range
+    return headers
+
+
+def is_compressed(resp) -> bool:
+    """Content-Length then counts the compressed bytes, not the ones we
+    save after aiohttp decoded them"""
+    return resp.headers.get("Content-Encoding", "identity") != "identity"
+
+
+def is_unchanged(file_path, resp) -> bool:
+    """Fallback when the server has no validators: same size, same file"""
+    if resp.status != 200 or not Path(file_path).exists():
+        return False
+    if is_compressed(resp):
+        return False
+    if resp.headers.get("ETag") or resp.headers.get("Last-Modified"):
+        if load_validators(file_path):
+            return False
+    return resp.content_length == Path(file_path).stat().st_size
+
+
+def content_range_total(resp) -> int | None:
+    # Content-Range: bytes */12345
+    total = resp.headers.get("Content-Range", "").split("/")[-1]
+    return int(total) if total.isdigit() else None
+
+
+class DownloadError(Exception):
+    """A download still failing after all its tries"""
+
+
+class SlowTransferError(asyncio.TimeoutError):
+    """The transfer is still moving, but slower than MIN_BYTES_PER_SEC"""
+
+
+class TransferRate:
+    """Bytes/sec of a transfer over windows of MIN_RATE_WINDOW seconds,
+    not counting the time our own bytes/sec ceiling held it back"""
+
+    def __init__(self, min_rate=MIN_BYTES_PER_SEC, window=MIN_RATE_WINDOW):
+        self.min_rate = min_rate
+        self.window = window
+        self.start = time.monotonic()
+        self.bytes = 0
+        self.throttled = 0.0
+
+    def update(self, size: int, throttled=0.0):
+        self.bytes += size
+        self.throttled += throttled
+        elapsed = time.monotonic() - self.start - self.throttled
+        if elapsed < self.window:
+            return
+        rate = self.bytes / elapsed
+        if rate < self.min_rate:
+            raise SlowTransferError(f"{rate:.0f} bytes/sec")
+        self.start = time.monotonic()
+        self.bytes = 0
+        self.throttled = 0.0
+
+
+def finish_download(file_path, part_path, resp):
+    os.replace(part_path, file_path)
+    validators_path(part_path).unlink(missing_ok=True)
+    save_validators(file_path, resp, Path(file_path).stat().st_size)
+
+
 class Downloader:
+    """Long lived download service.
+
+    All the downloads of the run go through one aiohttp session, running on
+    an event loop in a background thread, so TCP/TLS connections and DNS
+    lookups are reused between batches. Sync callers use download_files,
+    async callers (on any loop) await adownload_files.
+    """
+
     cookie_string = None
     user_agent = None
+    loop = None
+    session = None
+    scheduler = None
+    max_bytes_per_sec = MAX_BYTES_PER_SEC
+    # Videos being downloaded, by mp4 path
+    videos: dict = {}
+    _start_lock = Lock()
+    _videos_lock = Lock()
 
     def __init__(
         self, cookie_file="cookies.json", user_agent_file="user_agent.txt"
@@ -34,83 +207,314 @@ class Downloader:
             Downloader.cookie_string = get_cookie_string(j)
         if not Downloader.user_agent:
             Downloader.user_agent = open(user_agent_file, "r").read()
+        Downloader.start()
 
     @classmethod
-    async def download_list_of_files(file_list):
-        tasks = []
-        sem = Semaphore(MAX_TASKS)
+    def start(cls):
+        with cls._start_lock:
+            if cls.loop:
+                return
+            loop = asyncio.new_event_loop()
+            Thread(
+                target=loop.run_forever, name="downloader", daemon=True
+            ).start()
+            asyncio.run_coroutine_threadsafe(
+                cls._open_session(), loop
+            ).result()
+            cls.loop = loop
+            atexit.register(cls.close)
 
+    @classmethod
+    async def _open_session(cls):
+        connector = TCPConnector(
+            limit=MAX_CONNECTIONS,
+            limit_per_host=MAX_CONNECTIONS_PER_HOST,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=DNS_CACHE_TTL,
+        )
         headers = {
-            "cookie": Downloader.cookie_string,
-            "user-agent": Downloader.user_agent,
+            "cookie": cls.cookie_string,
+            "user-agent": cls.user_agent,
         }
+        # No deadline for a whole transfer, only for one that stopped moving
+        timeout = ClientTimeout(
+            total=None, sock_connect=CONNECT_TIMEOUT, sock_read=STALL_TIMEOUT
+        )
+        cls.session = ClientSession(
+            connector=connector, headers=headers, timeout=timeout
+        )
+        cls.scheduler = TransferScheduler(MAX_TASKS, cls.max_bytes_per_sec)
 
-        async with ClientSession(headers=headers) as sess:
-            for file_url, file_path in file_list:
-                tasks.append(
-                    # Wait max 60 seconds for each download
-                    wait_for(
-                        Downloader.download_one(
-                            file_url, sess, sem, file_path
-                        ),
-                        timeout=MAX_TIME,
-                    )
-                )
+    @classmethod
+    def close(cls):
+        with cls._start_lock:
+            if not cls.loop:
+                return
+            asyncio.run_coroutine_threadsafe(
+                cls.session.close(), cls.loop
+            ).result()
+            cls.loop.call_soon_threadsafe(cls.loop.stop)
+            cls.loop = None
+            cls.session = None
+
+    def submit(self, coro) -> Future:
+        """Schedules a coroutine on the downloader loop"""
+        return asyncio.run_coroutine_threadsafe(coro, Downloader.loop)
 
-            return await gather(*tasks)
+    def download_files(self, file_list, priority=ASSET):
+        """Downloads (url, file_path) pairs, blocking until they finish"""
+        return self.submit(
+            self.download_list_of_files(file_list, priority)
+        ).result()
+
+    async def adownload_files(self, file_list, priority=ASSET):
+        """Same as download_files, to be awaited from any event loop"""
+        return await asyncio.wrap_future(
+            self.submit(self.download_list_of_files(file_list, priority))
+        )
 
     @classmethod
-    async def download_one(url, session, semaphore, file_path):
-        tries = 3
-        for attempt in range(tries):
+    async def fetch_text(cls, url) -> str | None:
+        """Runs on the downloader loop, GETs a page with our cookies"""
+        host = host_of(url)
+        async for _ in PAGE_RETRY.attempts(host):
             try:
-                # Try to make an async request to page
-                async with semaphore:
-                    async with session.get(url) as resp:
-                        # The response was not what we expected
-                        if not resp.ok:
-                            logger.warning(
-                                f"URL: {url}\nFILE:{file_path}\nInvalid status code: {resp.status}"
-                            )
-                            # Try again if possible
-                            if attempt < tries - 1:
-                                continue
-                        # If response was successful
-                        else:
-                            # Try to download the file in chunks
-                            try:
-                                async with aiofile.async_open(
-                                    file_path, "wb+"
-                                ) as afp:
-                                    async for chunk in resp.content.iter_chunked(
-                                        1024 * 512
-                                    ):  # 500 KB
-                                        await afp.write(chunk)
-                            # If there was an error downloading the file
-                            except asyncio.TimeoutError:
-                                logger.warning(
-                                    f"A timeout ocurred while downloading '{file_path}' from {url}"
-                                )
-                                # Try again if possible
-                                if attempt < tries - 1:
-                                    continue
-                            except Exception as e:
-                                logger.warning(
-                                    f"Failed to download file: {file_path}\n{e}"
-                                )
-                                if attempt < tries - 1:
-                                    continue
-                            break
-            # The request failed
-            except InvalidURL:
-                logger.warning(f"Invalid URL: {url}\n FILE:{file_path}")
-                # No point in trying, the URL is invalid
-                break
-            except Exception as e:
-                logger.warning(f"Failed to download file: {file_path}\n{e}")
-                if attempt < tries - 1:
+                async with cls.session.get(url) as resp:
+                    if is_host_failure(resp.status):
+                        PAGE_RETRY.record_failure(
+                            host, retry_after_seconds(resp)
+                        )
+                        continue
+                    PAGE_RETRY.record_success(host)
+                    if not resp.ok:
+                        logger.warning(
+                            f"URL: {url}\nInvalid status code: {resp.status}"
+                        )
+                        return None
+                    return await resp.text()
+            except (ClientError, asyncio.TimeoutError) as e:
+                PAGE_RETRY.record_failure(host)
+                logger.warning(f"Failed to get page: {url}\n{e}")
+        return None
+
+    @classmethod
+    async def download_list_of_files(cls, file_list, priority=ASSET):
+        """Runs on the downloader loop, use download_files instead. Gives
+        the result of download_one of each file, or its DownloadError"""
+        tasks = []
+        for file_url, file_path in file_list:
+            tasks.append(cls.download_file(file_url, file_path, priority))
+
+        return await gather(*tasks, return_exceptions=True)
+
+    @classmethod
+    async def download_file(cls, url, file_path, priority=ASSET):
+        """Runs on the downloader loop, use submit_file instead"""
+        return await cls.download_one(url, cls.session, file_path, priority)
+
+    def submit_file(self, url, file_path, priority=ASSET) -> Future:
+        """Starts downloading a single file in the background"""
+        return self.submit(self.download_file(url, file_path, priority))
+
+    def submit_video(self, video_url, mp4_file_dir, mp4_file_name) -> Future:
+        """Starts downloading a video in the background, in the video lane.
+        A video already on its way, from a crawl attempt that failed, is not
+        started again, both would write the same .part file"""
+        mp4_path = str(Path(mp4_file_dir) / (mp4_file_name + ".mp4"))
+        with Downloader._videos_lock:
+            future = Downloader.videos.get(mp4_path)
+            if future:
+                return future
+            future = self.submit(
+                self.download_video(video_url, mp4_file_dir, mp4_file_name)
+            )
+            Downloader.videos[mp4_path] = future
+
+        def forget(_):
+            with Downloader._videos_lock:
+                Downloader.videos.pop(mp4_path, None)
+
+        future.add_done_callback(forget)
+        return future
+
+    @classmethod
+    async def download_video(cls, video_url, mp4_file_dir, mp4_file_name):
+        """Runs on the downloader loop, use submit_video instead. Raises
+        DownloadError once the tries are used up, so the lesson is not
+        marked done without its video"""
+        async with cls.scheduler.slot(VIDEO):
+            # The segments record how the host is doing, not the video
+            async for attempt in VIDEO_RETRY.attempts(host_of(video_url)):
+                if attempt:
+                    DOWNLOAD_RETRIES.inc(type="video")
+                try:
+                    await cls.fetch_video(
+                        video_url, mp4_file_dir, mp4_file_name
+                    )
+                except EncryptedStreamError as e:
+                    # Trying again won't help
+                    raise DownloadError(f"DRM protected: {video_url}") from e
+                except Exception as e:
+                    logger.warning(f"Download failed for video: {video_url}")
+                    logger.warning(f"Error: {str(e)}")
                     continue
-            break
+                return
+        raise DownloadError(f"Out of tries: {video_url}")
+
+    @classmethod
+    async def fetch_video(cls, video_url, mp4_file_dir, mp4_file_name):
+        mp4_path = Path(mp4_file_dir) / (mp4_file_name + ".mp4")
+        try:
+            await HlsDownload(
+                cls.session, cls.scheduler, video_url, mp4_path
+            ).run()
+        except UnsupportedPlaylistError as e:
+            logger.warning(f"Using m3u8_To_MP4 for {video_url}: {e}")
+            # m3u8_To_MP4 blocks, keep it off the loop
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                cls.download_video_mp4,
+                video_url,
+                mp4_file_dir,
+                mp4_file_name,
+            )
+            if not mp4_path.exists():
+                raise DownloadError(f"m3u8_To_MP4 saved nothing: {video_url}")
+
+    @classmethod
+    async def download_one(cls, url, session, file_path, priority=ASSET):
+        """Downloads into file_path.part and renames it when complete.
+
+        An interrupted download resumes from the .part file with a Range
+        request, and a file we already have is only downloaded again when
+        the server says it changed (ETag, Last-Modified, Content-Length).
+        Every try waits for its own transfer slot, so the backoff between
+        tries doesn't hold one.
+
+        Returns whether file_path holds the file, False when the server
+        refused it (404...). Raises DownloadError once the tries or the
+        retry budget of the host are used up.
+        """
+        kind = asset_type(url)
+        host = host_of(url)
+        async for attempt in DOWNLOAD_RETRY.attempts(host):
+            if attempt:
+                DOWNLOAD_RETRIES.inc(type=kind)
+            async with cls.scheduler.slot(priority, host):
+                if await cls.try_download(url, session, file_path):
+                    return Path(file_path).exists()
+        raise DownloadError(f"Out of tries: {url}")
+
+    @staticmethod
+    async def try_download(url, session, file_path) -> bool:
+        """One try of download_one. True when it is over, done or not,
+        False when it is worth trying again"""
+        part_path = Path(str(file_path) + ".part")
+        kind = asset_type(url)
+        host = host_of(url)
+        scheduler = Downloader.scheduler
+        try:
+            headers = request_headers(file_path, part_path)
+            sent = time.monotonic()
+            # Try to make an async request to page
+            async with session.get(url, headers=headers) as resp:
+                latency = time.monotonic() - sent
+                if is_host_failure(resp.status):
+                    scheduler.record_overload(host)
+                    DOWNLOAD_RETRY.record_failure(
+                        host, retry_after_seconds(resp)
+                    )
+                else:
+                    # Whatever it answered, the host is fine
+                    DOWNLOAD_RETRY.record_success(host)
+                if resp.status == 304 or is_unchanged(file_path, resp):
+                    scheduler.record_response(host, latency)
+                    print(f"Unchanged, skipping: {file_path}")
+                    return True
+                if resp.status == 416 and part_path.exists():
+                    # The range starts at the end, the .part is complete
+                    if content_range_total(resp) == part_path.stat().st_size:
+                        finish_download(file_path, part_path, resp)
+                        return True
+                    part_path.unlink()
+                    return False
+                # The response was not what we expected
+                if not resp.ok:
+                    logger.warning(
+                        f"URL: {url}\nFILE:{file_path}\nInvalid status code: {resp.status}"
+                    )
+                    # Asking again only helps if the host is the problem
+                    if is_host_failure(resp.status) or resp.status == 408:
+                        return False
+                    return True
+                # 206 continues the .part, anything else starts over
+                resuming = resp.status == 206
+                offset = part_path.stat().st_size if resuming else 0
+                save_validators(part_path, resp)
+                rate = TransferRate()
+                # Try to download the file in chunks
+                try:
+                    async with aiofile.async_open(
+                        part_path, "ab" if resuming else "wb"
+                    ) as afp:
+                        async for chunk in resp.content.iter_chunked(
+                            1024 * 512
+                        ):  # 500 KB
+                            await afp.write(chunk)
+                            DOWNLOADED_BYTES.inc(len(chunk), type=kind)
+                            throttle_start = time.monotonic()
+                            await scheduler.throttle(len(chunk))
+                            rate.update(
+                                len(chunk),
+                                time.monotonic() - throttle_start,
+                            )
+                # If the transfer stalled or is too slow
+                except asyncio.TimeoutError as e:
+                    DOWNLOAD_TIMEOUTS.inc(type=kind)
+                    scheduler.record_overload(host)
+                    DOWNLOAD_RETRY.record_failure(host)
+                    logger.warning(
+                        f"A timeout ocurred while downloading '{file_path}' from {url} {e}"
+                    )
+                    # Try again if possible, from where we stopped
+                    return False
+                except Exception as e:
+                    logger.warning(
+                        f"Failed to download file: {file_path}\n{e}"
+                    )
+                    return False
+
+                expected = resp.content_length
+                size = part_path.stat().st_size
+                if (
+                    expected is not None
+                    and not is_compressed(resp)
+                    and size != offset + expected
+                ):
+                    logger.warning(
+                        f"Incomplete download ({size} bytes): {file_path}"
+                    )
+                    return False
+                finish_download(file_path, part_path, resp)
+                scheduler.record_response(host, latency)
+        # The request failed
+        except InvalidURL:
+            logger.warning(f"Invalid URL: {url}\n FILE:{file_path}")
+            # No point in trying, the URL is invalid
+            return True
+        # No answer in time
+        except asyncio.TimeoutError:
+            DOWNLOAD_TIMEOUTS.inc(type=kind)
+            scheduler.record_overload(host)
+            DOWNLOAD_RETRY.record_failure(host)
+            logger.warning(f"No response in time: {url}")
+            return False
+        except Exception as e:
+            # Could not connect, or the connection broke
+            DOWNLOAD_RETRY.record_failure(host)
+            logger.warning(f"Failed to download file: {file_path}\n{e}")
+            return False
+        return True
 
     @staticmethod
     def download_video_mp4(video_url, mp4_file_dir, mp4_file_name):
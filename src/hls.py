@@ -0,0 +1,255 @@
+import asyncio
+import json
+import os
+import time
+from pathlib import Path
+from urllib.parse import urljoin
+
+from aiohttp.client_exceptions import ClientResponseError
+
+from metrics import DOWNLOAD_RETRIES, DOWNLOADED_BYTES
+from misc import set_logging_handlers
+from retry_policy import (
+    RetryPolicy,
+    host_of,
+    is_host_failure,
+    retry_after_seconds,
+)
+from transfer_scheduler import SEGMENT
+
+# Segments downloaded ahead of the one being written
+SEGMENT_WINDOW = 16
+SEGMENT_RETRY = RetryPolicy(tries=5, base_delay=2, max_delay=30)
+
+logger = set_logging_handlers("logs.log")
+
+
+class EncryptedStreamError(Exception):
+    """The stream is DRM protected, we can't download those"""
+
+
+class UnsupportedPlaylistError(Exception):
+    pass
+
+
+def parse_attributes(line: str) -> dict:
+    # #EXT-X-KEY:METHOD=AES-128,URI="key.php" -> {"METHOD": ..., "URI": ...}
+    attributes = {}
+    _, _, attribute_list = line.partition(":")
+    for part in attribute_list.split(","):
+        key, _, value = part.partition("=")
+        attributes[key.strip()] = value.strip().strip('"')
+    return attributes
+
+
+def check_key(key: dict, base_url: str):
+    """AES-128 with a plain key is left to m3u8_To_MP4, which decrypts it,
+    anything else is DRM"""
+    method = key.get("METHOD", "NONE")
+    if method == "NONE":
+        return
+    if method == "AES-128" and key.get("KEYFORMAT", "identity") == "identity":
+        raise UnsupportedPlaylistError(f"AES-128: {base_url}")
+    raise EncryptedStreamError(base_url)
+
+
+def parse_playlist(text: str, base_url: str) -> dict:
+    """Variants of a master playlist or segments of a media playlist"""
+    playlist: dict = {"variants": [], "segments": [], "init": None}
+    bandwidth = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith(("#EXT-X-KEY", "#EXT-X-SESSION-KEY")):
+            check_key(parse_attributes(line), base_url)
+        elif line.startswith("#EXT-X-BYTERANGE"):
+            raise UnsupportedPlaylistError(f"Byte ranges: {base_url}")
+        elif line.startswith("#EXT-X-MAP"):
+            playlist["init"] = urljoin(base_url, parse_attributes(line)["URI"])
+        elif line.startswith("#EXT-X-STREAM-INF"):
+            bandwidth = int(parse_attributes(line).get("BANDWIDTH", 0))
+        elif not line.startswith("#"):
+            url = urljoin(base_url, line)
+            if bandwidth is not None:
+                playlist["variants"].append((bandwidth, url))
+                bandwidth = None
+            else:
+                playlist["segments"].append(url)
+    return playlist
+
+
+class HlsDownload:
+    """Downloads an unencrypted HLS stream into an mp4.
+
+    Segments are fetched concurrently through the shared session, each in
+    its own SEGMENT slot of the scheduler for its host, and appended in
+    order to a single <name>.hls.part file, which is remuxed
+    with ffmpeg at the end. The sizes of the segments already written are
+    kept in <name>.hls.json, so an interrupted video resumes after the
+    last segment written.
+    """
+
+    def __init__(self, session, scheduler, playlist_url, mp4_path):
+        self.session = session
+        self.scheduler = scheduler
+        self.playlist_url = playlist_url
+        self.mp4_path = Path(mp4_path)
+        self.part_path = self.mp4_path.with_suffix(".hls.part")
+        self.state_path = self.mp4_path.with_suffix(".hls.json")
+
+    async def fetch_playlist(self, url: str) -> dict:
+        async with self.session.get(url) as resp:
+            resp.raise_for_status()
+            playlist = parse_playlist(await resp.text(), str(resp.url))
+        if playlist["variants"]:
+            # Master playlist, go with the best quality
+            _, best = max(playlist["variants"])
+            return await self.fetch_playlist(best)
+        return playlist
+
+    async def fetch_segment(self, url: str) -> bytes:
+        host = host_of(url)
+        error = None
+        async for attempt in SEGMENT_RETRY.attempts(host):
+            if attempt:
+                DOWNLOAD_RETRIES.inc(type="video")
+            try:
+                async with self.scheduler.slot(SEGMENT, host):
+                    return await self.try_segment(url, host)
+            except ClientResponseError as e:
+                error = e
+                logger.warning(f"Failed to download segment {url}: {e}")
+                # The host answered, asking again only helps if it is
+                # the host's fault
+                if not is_host_failure(e.status):
+                    break
+            except Exception as e:
+                error = e
+                SEGMENT_RETRY.record_failure(host)
+                logger.warning(f"Failed to download segment {url}: {e}")
+        raise error or RuntimeError(f"Out of retries for {url}")
+
+    async def try_segment(self, url: str, host: str) -> bytes:
+        chunks = []
+        sent = time.monotonic()
+        async with self.session.get(url) as resp:
+            latency = time.monotonic() - sent
+            if is_host_failure(resp.status):
+                self.scheduler.record_overload(host)
+                SEGMENT_RETRY.record_failure(host, retry_after_seconds(resp))
+            resp.raise_for_status()
+            async for chunk in resp.content.iter_chunked(1024 * 512):
+                chunks.append(chunk)
+                DOWNLOADED_BYTES.inc(len(chunk), type="video")
+                await self.scheduler.throttle(len(chunk))
+        SEGMENT_RETRY.record_success(host)
+        self.scheduler.record_response(host, latency)
+        return b"".join(chunks)
+
+    def load_written(self, playlist_url: str) -> list:
+        """Sizes of the segments already in the .part file"""
+        try:
+            state = json.loads(self.state_path.read_text())
+        except (OSError, ValueError):
+            return []
+        if state.get("playlist") != playlist_url:
+            return []
+        written = state["written"]
+        # Drop whatever was appended after the last saved segment
+        if not self.part_path.exists():
+            return []
+        if self.part_path.stat().st_size < sum(written):
+            return []
+        os.truncate(self.part_path, sum(written))
+        return written
+
+    def save_written(self, playlist_url: str, written: list):
+        self.state_path.write_text(
+            json.dumps({"playlist": playlist_url, "written": written})
+        )
+
+    async def run(self):
+        playlist = await self.fetch_playlist(self.playlist_url)
+        segments = playlist["segments"]
+        if playlist["init"]:
+            segments = [playlist["init"]] + segments
+        if not segments:
+            raise UnsupportedPlaylistError(f"No segments: {self.playlist_url}")
+
+        written = self.load_written(self.playlist_url)
+        if written:
+            print(f"Resuming video at segment {len(written)}/{len(segments)}")
+        else:
+            self.part_path.write_bytes(b"")
+
+        ready: dict = {}
+        window = asyncio.Condition()
+        next_to_write = len(written)
+
+        async def fetch(index):
+            # Don't get too far ahead of the writer
+            async with window:
+                await window.wait_for(
+                    lambda: index < next_to_write + SEGMENT_WINDOW
+                )
+            try:
+                data = await self.fetch_segment(segments[index])
+            except Exception:
+                # Wake the writer up so it sees the failure
+                async with window:
+                    window.notify_all()
+                raise
+            async with window:
+                ready[index] = data
+                window.notify_all()
+
+        tasks = [
+            asyncio.create_task(fetch(index))
+            for index in range(len(written), len(segments))
+        ]
+        try:
+            with open(self.part_path, "ab") as part_file:
+                while next_to_write < len(segments):
+                    async with window:
+                        await window.wait_for(
+                            lambda: next_to_write in ready
+                            or any(t.done() and t.exception() for t in tasks)
+                        )
+                    failed = [t for t in tasks if t.done() and t.exception()]
+                    if failed:
+                        raise failed[0].exception()
+                    data = ready.pop(next_to_write)
+                    part_file.write(data)
+                    # On disk before it is marked as written
+                    part_file.flush()
+                    os.fsync(part_file.fileno())
+                    written.append(len(data))
+                    self.save_written(self.playlist_url, written)
+                    async with window:
+                        next_to_write += 1
+                        window.notify_all()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        await self.remux()
+        self.part_path.unlink()
+        self.state_path.unlink()
+
+    async def remux(self):
+        tmp_path = self.mp4_path.with_suffix(".tmp.mp4")
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg",
+            "-y",
+            "-loglevel",
+            "error",
+            "-i",
+            str(self.part_path),
+            "-c",
+            "copy",
+            str(tmp_path),
+        )
+        if await process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to remux {self.part_path}")
+        os.replace(tmp_path, self.mp4_path)
@@ -0,0 +1,25 @@
+from downloader import Downloader
+from metrics import PAGE_LOAD_SECONDS
+
+
+class HttpPageLoader:
+    """Loads pages with a plain GET instead of a Chrome navigation.
+
+    Uses the Downloader session, so the cookies from cookies.json and the
+    user agent from user_agent.txt are sent like in the browser. Only works
+    for pages whose markup is rendered by the server.
+    """
+
+    def __init__(self):
+        self.downloader = Downloader()
+
+    def load_page(self, page_url) -> str | None:
+        try:
+            with PAGE_LOAD_SECONDS.time(loader="http"):
+                return self.downloader.submit(
+                    self.downloader.fetch_text(page_url)
+                ).result()
+        except Exception as e:
+            print(f"Something failed while loading the page: {page_url}")
+            print(e)
+            return None
@@ -0,0 +1,153 @@
+from pathlib import Path
+from queue import Queue, SimpleQueue
+from threading import Thread
+
+from asset_store import AssetPlan, AssetStore
+from clean_page import CLEAN_VERSION, clean_html_file
+from make_page_local import (
+    LOCALIZE_VERSION,
+    custom_html_path,
+    localize_page,
+    page_context,
+)
+from metrics import REWRITE_SECONDS
+from misc import get_html_parser, process_pool, set_logging_handlers
+from processing_manifest import ProcessingManifest
+
+# Localized pages waiting to be cleaned
+STAGE_QUEUE_SIZE = 16
+STOP = None
+
+logger = set_logging_handlers("logs.log")
+
+
+def lesson_pages(lesson_dir) -> list:
+    """Html pages saved for a lesson, its assessment included"""
+    return [
+        html_path
+        for html_path in Path(lesson_dir).rglob("*.html")
+        if "-giow" not in html_path.name
+    ]
+
+
+class LessonPipeline:
+    """Makes every lesson local and clean as soon as the crawler saved it,
+    instead of after the whole course is crawled.
+
+    Lessons are added once they are done, video included, and go through
+    two stages with their own workers: localize rewrites the pages and
+    starts their asset downloads, clean links the assets of a page once
+    they are downloaded and cleans it. The bounded queue between the two
+    holds localize back when clean falls behind. add never blocks, it is
+    called from the crawl and the Downloader threads.
+
+    Both stages record what they did in the processing manifests, so the
+    whole-tree passes after the crawl only pick up what is left.
+    """
+
+    def __init__(self, project_folder, workers=1, parser=None):
+        self.parser = get_html_parser(parser or "html.parser")
+        self.asset_store = AssetStore(project_folder)
+        self.asset_plan = AssetPlan(self.asset_store)
+        self.localize_manifest = ProcessingManifest(
+            project_folder, "localize", LOCALIZE_VERSION
+        )
+        self.clean_manifest = ProcessingManifest(
+            project_folder, "clean", CLEAN_VERSION
+        )
+        self.lessons: SimpleQueue = SimpleQueue()
+        self.pages: Queue = Queue(STAGE_QUEUE_SIZE)
+        # Parsing is CPU bound, with more than one worker it runs in
+        # processes
+        self.localize_pool = process_pool(workers) if workers > 1 else None
+        self.clean_pool = process_pool(workers) if workers > 1 else None
+        self.closed = False
+        self.localize_workers = self.start_workers(
+            self.localize_stage, workers
+        )
+        self.clean_workers = self.start_workers(self.clean_stage, workers)
+
+    @staticmethod
+    def start_workers(stage, workers: int) -> list:
+        threads = [Thread(target=stage, daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    @staticmethod
+    def run(pool, func, *args):
+        if pool:
+            return pool.submit(func, *args).result()
+        return func(*args)
+
+    def add(self, lesson_dir):
+        # A video of an abandoned crawl attempt can still finish after the
+        # close, its lesson is left to the pass over the whole tree
+        if self.closed:
+            return
+        self.lessons.put(Path(lesson_dir))
+
+    def localize_stage(self):
+        while True:
+            lesson_dir = self.lessons.get()
+            if lesson_dir is STOP:
+                break
+            for html_path in lesson_pages(lesson_dir):
+                try:
+                    self.localize(html_path)
+                except Exception as e:
+                    logger.error(f"Failed to edit {html_path}: {e}")
+
+    def localize(self, html_path: Path):
+        if self.localize_manifest.is_current(
+            html_path, custom_html_path(html_path), page_context(html_path)
+        ):
+            return
+        assets, _, seconds = self.run(
+            self.localize_pool, localize_page, html_path, self.parser
+        )
+        REWRITE_SECONDS.observe(seconds)
+        for url, dest in assets:
+            self.asset_plan.add(url, dest)
+        self.pages.put((html_path, assets))
+
+    def clean_stage(self):
+        while True:
+            page = self.pages.get()
+            if page is STOP:
+                break
+            html_path, assets = page
+            try:
+                self.clean(html_path, assets)
+            except Exception as e:
+                logger.error(f"Failed to clean {html_path}: {e}")
+
+    def clean(self, html_path: Path, assets: list):
+        custom_html = custom_html_path(html_path)
+        # Left pending when an asset is missing, the pass after the crawl
+        # and the next runs try it again
+        if self.asset_plan.link_page(assets):
+            self.localize_manifest.record(
+                html_path, custom_html, page_context(html_path)
+            )
+        self.run(self.clean_pool, clean_html_file, custom_html, self.parser)
+        self.clean_manifest.record(custom_html, custom_html)
+        print(f"Lesson page ready: {custom_html}")
+
+    def close(self):
+        """Finishes the lessons already added and stops the workers"""
+        self.closed = True
+        for _ in self.localize_workers:
+            self.lessons.put(STOP)
+        for thread in self.localize_workers:
+            thread.join()
+        for _ in self.clean_workers:
+            self.pages.put(STOP)
+        for thread in self.clean_workers:
+            thread.join()
+        for pool in [self.localize_pool, self.clean_pool]:
+            if pool:
+                pool.shutdown()
+        self.localize_manifest.close()
+        self.clean_manifest.close()
+        self.asset_store.close()
@@ -1,55 +1,253 @@
+import argparse
 import sys
+import time
+
+from aiohttp import ClientError
+from selenium.common.exceptions import WebDriverException
+from urllib3.exceptions import HTTPError
 
 from clean_page import clean_pages
-from crawler import crawl, get_queue
+from crawler import CrawlOptions, crawl, get_queue
+from downloader import MAX_BYTES_PER_SEC, Downloader
+from lesson_pipeline import LessonPipeline
 from make_page_local import download_assets_and_edit_htmls
-from page_loader import PageLoader
-from page_parser import PageParser
+from metrics import MetricsReporter
+from misc import file_path
+from page_capture import IMAGE_FORMATS, CaptureOptions
+from page_loader import MENU_WAITS, PAGE_LOAD_STRATEGIES, PageLoaderPool
+from page_parser import EXTRACT_BACKENDS, PageParser, get_extract_backend
+from profiling import Profiler
+from retry_policy import RetryPolicy, host_of
+
+# How many warm Chrome instances to keep around during the crawl, the
+# second one renders the deferred pdfs while the first keeps crawling
+PAGE_LOADER_POOL_SIZE = 2
+# Restarts of the crawl after an error, it carries on from the saved state
+CRAWL_RETRY = RetryPolicy(tries=10, base_delay=10, max_delay=300)
+# Errors that mean the site or Chrome failed us, others are bugs and stop
+# the crawl. urllib3's are the ones of a lost chromedriver
+NETWORK_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    ClientError,
+    HTTPError,
+    WebDriverException,
+)
 
 if __name__ == "__main__":
-    page_loader = PageLoader()
-    bem_vindo_page = ""
-    print(f"Loading first page: {bem_vindo_page}")
-    page_html = page_loader.load_page(bem_vindo_page)
-    if not page_html:
-        print("Failed to load page...")
-        sys.exit(1)
-
-    print("Parsing first page...")
-    parser = PageParser(page_html)
-
-    # This are the webpages that have the same structure
-    # and that we want to crawl
-    modules_to_crawl = [
-        "Bem-Vindo",
-        "Bem-vindo",
-        "Welcome",
-        "Benvenuti",
-        "¡Bienvenido!",
-        "Bienvenue",
-        "Minicurso",
-        "Wave 01",
-        "Wave 02",
-        "Onda 1",
-        "Onda 2",
-        "Onda 01",
-        "Onda 02",
-        "Morceau 01",
-        "Morceau 02",
-        "파도 2",
-        "Extra",
-        "Extras",  # If they have any
-    ]
-
-    queue, visited_links = get_queue(parser, modules_to_crawl)
-    page_loader.driver.close()
-    project_folder = PageParser(page_html).get_project_folder()
-    while True:
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="processes used to rewrite and clean the pages",
+    )
+    arg_parser.add_argument(
+        "--parser",
+        default="html.parser",
+        help="BeautifulSoup parser for the rewrite, e.g. lxml",
+    )
+    arg_parser.add_argument(
+        "--extract-backend",
+        default="html.parser",
+        choices=EXTRACT_BACKENDS,
+        help="parser used to read the lessons while crawling",
+    )
+    arg_parser.add_argument(
+        "--screenshot-format",
+        default="png",
+        choices=IMAGE_FORMATS + ["none"],
+        help="format of the screenshot of every lesson",
+    )
+    arg_parser.add_argument(
+        "--screenshot-quality",
+        type=int,
+        default=80,
+        help="quality of jpeg and webp screenshots",
+    )
+    arg_parser.add_argument(
+        "--no-pdf", action="store_true", help="don't save a pdf of lessons"
+    )
+    arg_parser.add_argument(
+        "--inline-pdf",
+        action="store_true",
+        help="render pdfs while crawling instead of from the saved html",
+    )
+    arg_parser.add_argument(
+        "--tabs",
+        type=int,
+        default=1,
+        help="lessons of a module loaded at the same time in tabs of one "
+        "Chrome",
+    )
+    arg_parser.add_argument(
+        "--http-pages",
+        action="store_true",
+        help="load lessons over HTTP, Chrome only when needed",
+    )
+    arg_parser.add_argument(
+        "--load-strategy",
+        default="normal",
+        choices=PAGE_LOAD_STRATEGIES,
+        help="when Chrome hands over a page, eager and none then wait only "
+        "for the elements the crawler reads",
+    )
+    arg_parser.add_argument(
+        "--block-resources",
+        action="store_true",
+        help="don't load images, fonts, media and trackers while crawling, "
+        "unless screenshots or inline pdfs need them",
+    )
+    arg_parser.add_argument(
+        "--max-bytes-per-sec",
+        type=int,
+        default=MAX_BYTES_PER_SEC,
+        help="bandwidth ceiling for all the downloads together",
+    )
+    arg_parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="visit every lesson again, redo only what changed",
+    )
+    arg_parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="make every lesson local and clean as soon as it is crawled",
+    )
+    arg_parser.add_argument(
+        "--metrics-interval",
+        type=int,
+        default=30,
+        help="seconds between two metrics reports",
+    )
+    arg_parser.add_argument(
+        "--metrics-file",
+        default=file_path("metrics.jsonl"),
+        help="JSON lines file the metrics are appended to",
+    )
+    arg_parser.add_argument(
+        "--prom-file",
+        default=file_path("facademy_dl.prom"),
+        help="Prometheus text file for the node_exporter textfile collector",
+    )
+    arg_parser.add_argument(
+        "--profile",
+        nargs="?",
+        const=file_path(f"profiles/{time.strftime('%Y%m%d-%H%M%S')}"),
+        help="save cProfile and tracemalloc reports of every stage here",
+    )
+    args = arg_parser.parse_args()
+    # Before the first Downloader starts its scheduler
+    Downloader.max_bytes_per_sec = args.max_bytes_per_sec
+    profiler = Profiler(args.profile)
+    metrics_reporter = MetricsReporter(
+        args.metrics_file, args.prom_file, args.metrics_interval
+    ).start()
+
+    # The final report is written even when the run stops on an error
+    try:
+        page_loader_pool = PageLoaderPool(
+            size=PAGE_LOADER_POOL_SIZE, load_strategy=args.load_strategy
+        )
+        pipeline = None
         try:
-            crawl(queue, visited_links)
-            break
-        except Exception as e:
-            print(f"Error while crawling, trying again... {e}")
-            pass
-    download_assets_and_edit_htmls(project_folder)
-    clean_pages(project_folder)
+            bem_vindo_page = ""
+            print(f"Loading first page: {bem_vindo_page}")
+            with page_loader_pool.loader() as page_loader:
+                page_html = page_loader.load_page(bem_vindo_page, MENU_WAITS)
+            if not page_html:
+                print("Failed to load page...")
+                sys.exit(1)
+
+            print("Parsing first page...")
+            parser = PageParser(page_html)
+
+            # This are the webpages that have the same structure
+            # and that we want to crawl
+            modules_to_crawl = [
+                "Bem-Vindo",
+                "Bem-vindo",
+                "Welcome",
+                "Benvenuti",
+                "¡Bienvenido!",
+                "Bienvenue",
+                "Minicurso",
+                "Wave 01",
+                "Wave 02",
+                "Onda 1",
+                "Onda 2",
+                "Onda 01",
+                "Onda 02",
+                "Morceau 01",
+                "Morceau 02",
+                "파도 2",
+                "Extra",
+                "Extras",  # If they have any
+            ]
+
+            with profiler.stage("get_queue"):
+                queue, crawl_state = get_queue(
+                    parser, modules_to_crawl, sync=args.sync
+                )
+            project_folder = PageParser(page_html).get_project_folder()
+            if args.pipeline:
+                pipeline = LessonPipeline(
+                    project_folder, workers=args.workers, parser=args.parser
+                )
+            # A key of its own, failed downloads from the same host don't use up
+            # the retries of the crawl or open its circuit
+            crawl_host = host_of(bem_vindo_page) or host_of(
+                PageParser.BASE_URL
+            )
+            crawl_key = f"crawl {crawl_host}"
+            for _ in CRAWL_RETRY.attempts_sync(crawl_key):
+                try:
+                    crawl(
+                        queue,
+                        crawl_state,
+                        page_loader_pool,
+                        CrawlOptions(
+                            max_tabs=args.tabs,
+                            capture=CaptureOptions(
+                                image_format=args.screenshot_format,
+                                quality=args.screenshot_quality,
+                                pdf=not args.no_pdf,
+                                defer_pdf=not args.inline_pdf,
+                            ),
+                            http_pages=args.http_pages,
+                            sync=args.sync,
+                            pipeline=pipeline,
+                            parser_backend=get_extract_backend(
+                                args.extract_backend
+                            ),
+                            profiler=profiler,
+                            block_resources=args.block_resources,
+                        ),
+                    )
+                    CRAWL_RETRY.record_success(crawl_key)
+                    break
+                except NETWORK_ERRORS as e:
+                    print(f"Error while crawling, trying again... {e}")
+                    CRAWL_RETRY.record_failure(crawl_key)
+            else:
+                print(
+                    "Giving up on the crawl, finishing the lessons saved so far"
+                )
+        finally:
+            # Also when the crawl stops on a bug, Chrome is not left running
+            page_loader_pool.close()
+            if pipeline:
+                pipeline.close()
+        # With the pipeline these only pick up the pages it didn't finish
+        with profiler.stage("localize_pages"):
+            download_assets_and_edit_htmls(
+                project_folder, workers=args.workers, parser=args.parser
+            )
+        with profiler.stage("clean_pages"):
+            clean_pages(
+                project_folder, workers=args.workers, parser=args.parser
+            )
+    finally:
+        metrics_reporter.stop()
+    if profiler.enabled:
+        print(f"Profiles saved in {profiler.run_dir}")
@@ -1,91 +1,28 @@
-import sys
-from asyncio import run
+import argparse
+import time
+from collections import Counter
+from concurrent.futures import as_completed
 from pathlib import Path
 from urllib.parse import unquote, urlparse
 
 from bs4 import BeautifulSoup
 from tqdm import tqdm
 
-from downloader import Downloader
-from misc import set_logging_handlers
-
-logger = set_logging_handlers("make_page_local.log")
-
-
-def remove_google_analytics(soup):
-    for noscript in soup("noscript"):
-        noscript.extract()
-
-
-def remove_video(soup):
-    video = soup.find("div", {"class": "video"})
-    video.extract()
-
-
-def remove_telemetry(soup):
-    remove_google_analytics(soup)
-    for s in soup.select('div[class*="octa"]'):
-        s.extract()
-    remove_telemetry_scripts(soup)
-
-
-# Remove telemetry
-def remove_telemetry_scripts(soup):
-    for script in soup("noscript"):
-        script.extract()
-
-    scripts = soup(["script", "a", "input", "meta"])
-    block_words = [
-        "user",
-        "analyt",
-        "google",
-        "octa",
-        "chat",
-        "survey",
-        "track",
-        "metric",
-        "token",
-    ]
-    for script in scripts:
-        script_as_str = str(script).lower()
-        if any(substring in script_as_str for substring in block_words):
-            script.decompose()
+from asset_store import AssetPlan, AssetStore, url_digest
+from cleanup_rules import CLEANUP_RULES
+from metrics import REWRITE_SECONDS
+from misc import (
+    get_html_parser,
+    process_pool,
+    sanitize_string,
+    set_logging_handlers,
+)
+from processing_manifest import ProcessingManifest
 
+# Bump when the pages come out different, so they are all redone
+LOCALIZE_VERSION = 1
 
-def remove_user_area(soup):
-    user_area = soup.find("div", {"class": "social_area"})
-    if user_area:
-        user_area.decompose()
-
-
-def remove_after_video(soup):
-    video_after = soup.find("div", {"class": "btn_vid_after"})
-    if video_after:
-        video_after.decompose()
-
-
-def remove_audio_js(soup):
-    audio_js = soup.find("div", {"class": "post-audio"})
-    if audio_js:
-        audio_js.decompose()
-
-
-def remove_unit_downloads(soup):
-    unit_downloads = soup.find("div", {"class": "sidebar"})
-    if unit_downloads:
-        unit_downloads.decompose()
-
-
-def remove_survey(soup):
-    survey = soup.find("div", {"id": "survicate-box"})
-    if survey:
-        survey.decompose()
-
-
-def remove_add_to_deck(soup):
-    deck = soup.find("a", {"class": "add_deck"})
-    if deck:
-        deck.decompose()
+logger = set_logging_handlers("make_page_local.log")
 
 
 def remove_broken_img(soup):
@@ -94,25 +31,12 @@ def remove_broken_img(soup):
         img.decompose()
 
 
-def remove_walk_and_talk(soup):
-    body = soup.find_all("body", {"class": "containEmbed"})
-    if not body:
-        return False
-    for b in body:
-        b.decompose()
-
-
-def remove_mail_from_html(soup):
-    mails = soup.find_all("input", {"id": "assessment_result_email"})
-    if not mails:
-        return
-    for mail in mails:
-        mail.decompose()
-
-
 def create_folder_asset(path, url):
     url_parsed = urlparse(url)
-    file_path = path / unquote(Path(url_parsed.path).name)
+    # Prefix with the url digest so different urls with the same name
+    # don't overwrite each other
+    name = sanitize_string(unquote(Path(url_parsed.path).name))
+    file_path = path / f"{url_digest(url)[:10]}-{name}"
     # Create folder for assets
     path.mkdir(parents=True, exist_ok=True)
     return file_path
@@ -128,7 +52,8 @@ def replace_asset(soup_tag, attr, new_attr_value):
 
 
 def fix_link(url):
-    if "https:" not in url:
+    # Protocol relative links, //cdn.example.com/...
+    if not urlparse(url).scheme:
         url = "https:" + url
     return url
 
@@ -140,6 +65,7 @@ def make_assets_local(
     link_attr,
     asset_type,
     decompose,
+    asset_plan,
     attr_to_look_for=None,
 ):
     tags = []
@@ -148,8 +74,6 @@ def make_assets_local(
     else:
         tags = soup.find_all(tag_to_look_for)
 
-    download_list = set()
-
     for tag in tags:
         if tag.has_attr(link_attr):
             if tag[link_attr].startswith("data:image"):
@@ -159,25 +83,13 @@ def make_assets_local(
             url = fix_link(tag[link_attr])
             asset_folder = Path(html_path).parent / asset_type
             file_path = create_folder_asset(asset_folder, url)
-            # Add to download list
-            download_list.add((url, file_path))
+            asset_plan.add(url, file_path)
             # Replace on HTML
             file_path = Path(asset_type) / Path(file_path).name
             replace_asset(tag, link_attr, file_path)
         else:
             if decompose:
                 tag.decompose()
-    tries = 3
-    for attempt in range(tries):
-        try:
-            downloader = Downloader()
-            run(downloader.download_list_of_files(download_list))
-        except Exception as e:
-            logger.error(f"Error downloading {download_list} {e}")
-            logger.error(f"Attempt {attempt}")
-            if attempt < tries - 1:
-                continue
-        break
 
 
 def append_new_video(soup, new_video):
@@ -207,18 +119,13 @@ def find_mp4_video(path):
     return None
 
 
-def filter_and_download_page(abs_path):
+def filter_and_download_page(abs_path, asset_plan, parser="html.parser"):
+    """Rewrites the page to use local assets, which are added to the plan.
+    They are only in the lesson folder after asset_plan.execute().
+    Returns how many tags each cleanup rule removed"""
     with open(abs_path, "r") as f:
-        soup = BeautifulSoup(f.read(), "html.parser")
-    remove_telemetry(soup)
-    remove_user_area(soup)
-    remove_after_video(soup)
-    remove_audio_js(soup)
-    remove_unit_downloads(soup)
-    remove_survey(soup)
-    remove_add_to_deck(soup)
-    remove_walk_and_talk(soup)
-    remove_mail_from_html(soup)
+        soup = BeautifulSoup(f.read(), parser)
+    hits = CLEANUP_RULES.apply(soup)
 
     make_assets_local(
         soup,
@@ -228,6 +135,7 @@ def filter_and_download_page(abs_path):
         link_attr="href",
         asset_type="css",
         decompose=False,
+        asset_plan=asset_plan,
     )
     # Only download scripts when needed (for assessments)
     if "assessment" in str(abs_path):
@@ -238,6 +146,7 @@ def filter_and_download_page(abs_path):
             link_attr="src",
             asset_type="js",
             decompose=True,
+            asset_plan=asset_plan,
         )
     else:
         # If not needed, remove the script tags from html
@@ -252,6 +161,7 @@ def filter_and_download_page(abs_path):
         link_attr="src",
         asset_type="img",
         decompose=True,
+        asset_plan=asset_plan,
     )
 
     append_new_video(soup, find_mp4_video(abs_path))
@@ -264,24 +174,22 @@ def filter_and_download_page(abs_path):
                 iframe["src"] = "assessment/assessment_page-giow.html"
                 iframe["style"] = "height: 550px"
 
-    font_file = Path(abs_path).parent / "css" / "font-awesome.min.css"
-    if font_file.exists():
-        with font_file.open("r+") as f:
-            content = f.read()
-            content = content.replace(
-                "../fonts/",
-                "https://maxcdn.bootstrapcdn.com/font-awesome/4.5.0/",
-            )
-            f.seek(0)
-            f.write(content)
-            f.truncate()
-
     remove_broken_img(soup)
-    abs_path = Path(abs_path)
-    new_name = abs_path.stem + "-giow" + abs_path.suffix
 
-    with open(abs_path.parent / new_name, "w") as f:
+    with open(custom_html_path(abs_path), "w") as f:
         f.write(str(soup))
+    return hits
+
+
+def custom_html_path(abs_path) -> Path:
+    abs_path = Path(abs_path)
+    return abs_path.parent / (abs_path.stem + "-giow" + abs_path.suffix)
+
+
+def page_context(abs_path) -> str:
+    """What the rewritten page depends on besides its html"""
+    assessment = (Path(abs_path).parent / "assessment").exists()
+    return f"video={find_mp4_video(abs_path)} assessment={assessment}"
 
 
 def get_all_custom_html_files(project_path):
@@ -294,14 +202,92 @@ def get_all_custom_html_files(project_path):
     return html_paths
 
 
-def download_assets_and_edit_htmls(project_path):
-    html_paths = get_all_custom_html_files(project_path)
-    for html_path in tqdm(html_paths):
-        filter_and_download_page(html_path)
+class CollectedAssets:
+    """Stands in for the AssetPlan inside worker processes, the assets are
+    sent back to the parent which owns the plan"""
 
+    def __init__(self):
+        self.items = []
 
-if __name__ == "__main__":
+    def add(self, url, dest):
+        self.items.append((url, dest))
 
-    if len(sys.argv) == 2:
-        project_path = sys.argv[1]
-        download_assets_and_edit_htmls(project_path)
+
+def localize_page(abs_path, parser="html.parser"):
+    """Returns the assets of the page, the cleanup rule hits and how long
+    the rewrite took, which is timed here as it may run in a worker"""
+    start = time.perf_counter()
+    assets = CollectedAssets()
+    hits = filter_and_download_page(abs_path, assets, parser)
+    return assets.items, hits, time.perf_counter() - start
+
+
+def download_assets_and_edit_htmls(project_path, workers=1, parser=None):
+    parser = get_html_parser(parser or "html.parser")
+    manifest = ProcessingManifest(project_path, "localize", LOCALIZE_VERSION)
+    html_paths = [
+        html_path
+        for html_path in get_all_custom_html_files(project_path)
+        if not manifest.is_current(
+            html_path, custom_html_path(html_path), page_context(html_path)
+        )
+    ]
+    print(f"{len(html_paths)} new or modified pages to make local")
+    asset_store = AssetStore(project_path)
+    asset_plan = AssetPlan(asset_store)
+    rule_hits: Counter = Counter()
+    done_pages = []
+
+    def add_page(html_path, assets, hits, seconds):
+        REWRITE_SECONDS.observe(seconds)
+        for url, dest in assets:
+            asset_plan.add(url, dest)
+        done_pages.append((html_path, assets))
+        rule_hits.update(hits)
+
+    # First rewrite every page while the assets download in the background
+    if workers > 1:
+        with process_pool(workers) as pool:
+            futures = {
+                pool.submit(localize_page, html_path, parser): html_path
+                for html_path in html_paths
+            }
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                try:
+                    add_page(futures[future], *future.result())
+                except Exception as e:
+                    logger.error(f"Failed to edit {futures[future]}: {e}")
+    else:
+        for html_path in tqdm(html_paths):
+            try:
+                add_page(html_path, *localize_page(html_path, parser))
+            except Exception as e:
+                logger.error(f"Failed to edit {html_path}: {e}")
+    logger.info(f"Tags removed per cleanup rule: {dict(rule_hits)}")
+    # Then wait for the downloads and put them in place
+    asset_plan.execute()
+
+    # Pages missing an asset are made local again next run, to retry it
+    incomplete = 0
+    for html_path, assets in done_pages:
+        if not asset_plan.has_all(assets):
+            incomplete += 1
+            continue
+        manifest.record(
+            html_path, custom_html_path(html_path), page_context(html_path)
+        )
+    if incomplete:
+        print(f"{incomplete} pages are missing assets, retried next run")
+    asset_store.close()
+    manifest.close()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("project_path")
+    arg_parser.add_argument("--workers", type=int, default=1)
+    arg_parser.add_argument("--parser", default="html.parser")
+    args = arg_parser.parse_args()
+    download_assets_and_edit_htmls(
+        args.project_path, workers=args.workers, parser=args.parser
+    )
@@ -0,0 +1,237 @@
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Event, Lock, Thread
+
+PREFIX = "facademy_"
+# Upper bounds in seconds, the last bucket is +Inf
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Downloaded bytes are split by these, by the suffix of the url
+ASSET_TYPES = {
+    "css": (".css",),
+    "js": (".js",),
+    "image": (".png", ".jpg", ".jpeg", ".gif", ".svg", ".webp", ".ico"),
+    "font": (".woff", ".woff2", ".ttf", ".otf", ".eot"),
+    "video": (".mp4", ".ts", ".m4s", ".m3u8"),
+    "document": (".pdf", ".zip", ".mp3", ".doc", ".docx"),
+}
+
+
+def label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key: tuple, **extra) -> str:
+    pairs = list(key) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+def event_labels(key: tuple) -> str:
+    return ",".join(f"{name}={value}" for name, value in key) or "all"
+
+
+def asset_type(url: str) -> str:
+    """Kind of file a url points to, to split the bytes downloaded"""
+    path = url.split("?")[0].lower()
+    for kind, suffixes in ASSET_TYPES.items():
+        if path.endswith(suffixes):
+            return kind
+    return "other"
+
+
+class MetricCounter:
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values: dict = defaultdict(float)
+        self.lock = Lock()
+
+    def inc(self, amount=1, **labels):
+        with self.lock:
+            self.values[label_key(labels)] += amount
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                event_labels(key): value for key, value in self.values.items()
+            }
+
+    def prometheus(self) -> list:
+        lines = [
+            f"# HELP {PREFIX}{self.name} {self.description}",
+            f"# TYPE {PREFIX}{self.name} counter",
+        ]
+        with self.lock:
+            for key, value in self.values.items():
+                lines.append(
+                    f"{PREFIX}{self.name}{format_labels(key)} {value}"
+                )
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        # labels -> [count per bucket (+Inf last), sum, max]
+        self.values: dict = {}
+        self.lock = Lock()
+
+    def observe(self, value: float, **labels):
+        with self.lock:
+            key = label_key(labels)
+            if key not in self.values:
+                self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0.0]
+            counts, _, _ = entry = self.values[key]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            else:
+                counts[-1] += 1
+            entry[1] += value
+            entry[2] = max(entry[2], value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                event_labels(key): {
+                    "count": sum(counts),
+                    "sum": round(total, 6),
+                    "max": round(largest, 6),
+                }
+                for key, (counts, total, largest) in self.values.items()
+            }
+
+    def prometheus(self) -> list:
+        name = PREFIX + self.name
+        lines = [
+            f"# HELP {name} {self.description}",
+            f"# TYPE {name} histogram",
+        ]
+        with self.lock:
+            for key, (counts, total, _) in self.values.items():
+                cumulative = 0
+                bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, counts):
+                    cumulative += count
+                    labels = format_labels(key, le=bound)
+                    lines.append(f"{name}_bucket{labels} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(key)} {total}")
+                lines.append(f"{name}_count{format_labels(key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict = {}
+
+    def counter(self, name: str, description: str) -> MetricCounter:
+        return self.metrics.setdefault(name, MetricCounter(name, description))
+
+    def histogram(self, name: str, description: str) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, description))
+
+    def snapshot(self) -> dict:
+        return {
+            name: metric.snapshot() for name, metric in self.metrics.items()
+        }
+
+    def prometheus(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.prometheus())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+PAGE_LOAD_SECONDS = REGISTRY.histogram(
+    "page_load_seconds", "Time to load a page, by loader"
+)
+PARSE_SECONDS = REGISTRY.histogram(
+    "parse_seconds", "Time to parse a page and extract the lesson from it"
+)
+CAPTURE_SECONDS = REGISTRY.histogram(
+    "capture_seconds", "Time to take a screenshot or render a pdf"
+)
+REWRITE_SECONDS = REGISTRY.histogram(
+    "rewrite_seconds", "Time to rewrite a page to use local assets"
+)
+DOWNLOADED_BYTES = REGISTRY.counter(
+    "downloaded_bytes_total", "Bytes downloaded, by asset type"
+)
+DOWNLOAD_RETRIES = REGISTRY.counter(
+    "download_retries_total", "Downloads tried again, by asset type"
+)
+DOWNLOAD_TIMEOUTS = REGISTRY.counter(
+    "download_timeouts_total", "Downloads that ran out of time"
+)
+BLOCKED_REQUESTS = REGISTRY.counter(
+    "blocked_requests_total", "Requests dropped in crawl tabs, by type"
+)
+DRIVER_RESTARTS = REGISTRY.counter(
+    "driver_restarts_total", "Chrome restarts, by reason"
+)
+CIRCUIT_OPENS = REGISTRY.counter(
+    "circuit_opens_total", "Times a failing host was paused, by host"
+)
+
+
+class MetricsReporter:
+    """Writes the metrics every interval seconds while the run goes on.
+
+    Each report appends a JSON line with the totals so far to events_file
+    and replaces textfile with the Prometheus text format, for the
+    node_exporter textfile collector. stop writes a last report.
+    """
+
+    def __init__(
+        self,
+        events_file="metrics.jsonl",
+        textfile="facademy_dl.prom",
+        interval=30,
+        registry=REGISTRY,
+    ):
+        self.events_file = events_file
+        self.textfile = textfile
+        self.interval = interval
+        self.registry = registry
+        self.stopped = Event()
+        self.thread = Thread(target=self._run, name="metrics", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self):
+        event = {"time": time.time(), "metrics": self.registry.snapshot()}
+        with open(self.events_file, "a") as f:
+            f.write(json.dumps(event) + "\n")
+        # node_exporter must never read a half written file
+        tmp_file = self.textfile + ".tmp"
+        with open(tmp_file, "w") as f:
+            f.write(self.registry.prometheus())
+        os.replace(tmp_file, self.textfile)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.report()
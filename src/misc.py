@@ -1,7 +1,9 @@
 import logging
+import multiprocessing
 import pickle
 import sys
 from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 
@@ -32,6 +34,26 @@ def load_visited_links(visited_links_file: str) -> set:
         return visited
 
 
+def process_pool(workers: int) -> ProcessPoolExecutor:
+    """Worker processes started fresh instead of forked. The run has
+    threads (Downloader loop, Selenium, sqlite, metrics) and a fork copies
+    their locks as they are, a held one never gets released in the child"""
+    return ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def get_html_parser(name="html.parser"):
+    """BeautifulSoup parser to use, lxml is faster but optional"""
+    if name == "lxml":
+        try:
+            import lxml  # noqa: F401
+        except ImportError:
+            print("lxml is not installed, using html.parser")
+            return "html.parser"
+    return name
+
+
 def sanitize_string(string):
     return (
         string.replace("#", "")
@@ -46,6 +68,13 @@ def sanitize_string(string):
 def set_logging_handlers(output_filename):
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.INFO)
+    # Every module asks for the handlers, only add them once
+    if any(
+        isinstance(handler, logging.FileHandler)
+        and handler.baseFilename == str(Path(output_filename).absolute())
+        for handler in logger.handlers
+    ):
+        return logger
     formatter = logging.Formatter("%(asctime)s | %(levelname)s | %(message)s")
 
     stdout_handler = logging.StreamHandler(sys.stdout)
@@ -57,5 +86,8 @@ def set_logging_handlers(output_filename):
     file_handler.setFormatter(formatter)
 
     logger.addHandler(file_handler)
-    logger.addHandler(stdout_handler)
+    if not any(
+        type(handler) is logging.StreamHandler for handler in logger.handlers
+    ):
+        logger.addHandler(stdout_handler)
     return logger
@@ -0,0 +1,139 @@
+import base64
+import html
+import os
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from misc import set_logging_handlers
+
+IMAGE_FORMATS = ["png", "jpeg", "webp"]
+
+logger = set_logging_handlers("logs.log")
+
+
+class CaptureOptions:
+    """Which captures are saved for every lesson"""
+
+    def __init__(
+        self, image_format="png", quality=80, pdf=True, defer_pdf=True
+    ):
+        # png, jpeg, webp or None for no screenshot
+        self.image_format = image_format
+        # Only used by jpeg and webp
+        self.quality = quality
+        self.pdf = pdf
+        # Render the pdfs from the saved html after the page is left,
+        # instead of while the crawl waits
+        self.defer_pdf = defer_pdf
+
+    @property
+    def screenshot(self) -> bool:
+        return self.image_format in IMAGE_FORMATS
+
+    @property
+    def enabled(self) -> bool:
+        return self.screenshot or self.pdf
+
+    @property
+    def needs_live_page(self) -> bool:
+        """Whether captures are taken from the page the crawl loaded, which
+        then has to be rendered with everything in it"""
+        return self.screenshot or (self.pdf and not self.defer_pdf)
+
+    def screenshot_params(self) -> dict:
+        params = {"format": self.image_format, "captureBeyondViewport": True}
+        if self.image_format != "png":
+            params["quality"] = self.quality
+        return params
+
+
+def write_capture(file_path, data: str):
+    with open(file_path, "wb") as f:
+        f.write(base64.b64decode(data))
+
+
+def with_base_url(page_html: str, page_url: str) -> str:
+    """The page with its links resolved against page_url instead of the
+    folder it was saved in, //cdn and /static links included"""
+    base = f'<base href="{html.escape(page_url)}">'
+    head = re.search(r"<head\b[^>]*>", page_html, re.IGNORECASE)
+    if not head:
+        return base + page_html
+    return page_html[: head.end()] + base + page_html[head.end() :]
+
+
+class CaptureQueue:
+    """Takes the captures off the crawl's critical path.
+
+    Screenshots are taken with one CDP call while the page is loaded, then
+    decoded and written by a background thread. Deferred pdfs are rendered
+    from the saved html on a driver borrowed from the pool, so with a pool
+    of two or more they don't hold up navigation at all.
+    """
+
+    def __init__(self, options: CaptureOptions, page_loader_pool=None):
+        self.options = options
+        self.page_loader_pool = page_loader_pool
+        self.writer = ThreadPoolExecutor(1, "capture-writer")
+        self.renderer = ThreadPoolExecutor(1, "pdf-renderer")
+        self.pending: list = []
+
+    def save_screenshot(self, page_loader, file_stem: str):
+        if not self.options.screenshot:
+            return
+        file_path = f"{file_stem}.{self.options.image_format}"
+        print(f"Saving screenshot: {file_path}")
+        page_loader.wait_until_complete()
+        data = page_loader.capture_screenshot(self.options.screenshot_params())
+        if data:
+            self.write(file_path, data)
+
+    def write(self, file_path: str, data: str):
+        """Writes base64 capture data in the background"""
+        self.pending.append(self.writer.submit(write_capture, file_path, data))
+
+    def save_pdf(
+        self, page_loader, file_stem: str, html_file: str, page_url: str
+    ):
+        """page_url is where html_file was loaded from, for its links"""
+        if not self.options.pdf:
+            return
+        if self.options.defer_pdf and self.page_loader_pool:
+            self.pending.append(
+                self.renderer.submit(
+                    self.render_pdf, html_file, file_stem, page_url
+                )
+            )
+        else:
+            page_loader.wait_until_complete()
+            page_loader.save_screenshot_as_pdf(file_stem)
+
+    def render_pdf(self, html_file: str, file_stem: str, page_url: str):
+        page_html = Path(html_file).read_text(encoding="utf-8")
+        # A copy, the saved html is rewritten later by make_page_local
+        fd, render_file = tempfile.mkstemp(suffix=".html")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(with_base_url(page_html, page_url))
+            with self.page_loader_pool.loader() as page_loader:
+                # The pdf needs the images the crawl may have blocked
+                page_loader.set_blocked_urls([])
+                page_loader.driver.get(Path(render_file).as_uri())
+                page_loader.wait_until_complete()
+                page_loader.save_screenshot_as_pdf(file_stem)
+        except Exception as e:
+            logger.warning(f"Failed to render pdf {file_stem}: {e}")
+        finally:
+            os.remove(render_file)
+
+    def close(self):
+        """Waits for everything still in the queue"""
+        if self.pending:
+            print(f"Waiting for {len(self.pending)} captures...")
+        for future in self.pending:
+            future.result()
+        self.pending = []
+        self.writer.shutdown()
+        self.renderer.shutdown()
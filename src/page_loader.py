@@ -1,19 +1,86 @@
 import base64
 import json
 import pickle
+import time
+from contextlib import contextmanager
+from threading import Condition, Event, Thread
 
 from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.expected_conditions import (
+    presence_of_element_located,
+    staleness_of,
+)
+from selenium.webdriver.support.ui import WebDriverWait
 
+from metrics import CAPTURE_SECONDS, DRIVER_RESTARTS, PAGE_LOAD_SECONDS
 from misc import file_path
 
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+MB = 1024 * 1024
+# Chrome is restarted once it loaded that many pages, uses that much
+# memory (needs psutil) or got that slow on average
+MAX_PAGES_PER_DRIVER = 300
+MAX_CHROME_RSS_MB = 2048
+MAX_AVERAGE_LOAD_SECONDS = 30
+# Weight of the last page load in the average
+LOAD_TIME_WEIGHT = 0.2
+# A Chrome that takes longer to run a trivial script is hung
+PING_TIMEOUT = 10
+# When driver.get returns: "normal" once every subresource loaded, "eager"
+# once the DOM is ready, "none" as soon as the navigation started. With
+# eager and none the page is read once the elements it needs are in it
+PAGE_LOAD_STRATEGIES = ["normal", "eager", "none"]
+# (css selector, seconds) waited for in turn after driver.get, the lesson
+# listing is filled by scripts and may come later than the breadcrumbs
+LESSON_WAITS = [(".breadcrumbs", 15), (".category-listing", 10)]
+# The module menu of the first page
+MENU_WAITS = [("li.cat_menu", 20)]
+# Seconds for the previous page to go away after driver.get with "none"
+NAVIGATION_TIMEOUT = 30
+# Seconds for images and fonts to finish loading before a capture
+LOAD_COMPLETE_TIMEOUT = 30
+WAIT_POLL_SECONDS = 0.1
+
+
+def full_page_clip(size: dict) -> dict:
+    return {
+        "x": 0,
+        "y": 0,
+        "width": size["width"],
+        "height": size["height"],
+        "scale": 1,
+    }
+
 
 class PageLoader:
-    def __init__(self, cookie_file="cookies.json"):
+    """Chrome driven by Selenium, restarted when recycle_policy says it is
+    worn out. A page whose load broke Chrome is loaded again on the new
+    one, so callers only see the html. load_strategy is one of
+    PAGE_LOAD_STRATEGIES."""
+
+    def __init__(
+        self,
+        cookie_file="cookies.json",
+        recycle_policy=None,
+        load_strategy="normal",
+    ):
         self.cookie_file = cookie_file
+        self.recycle_policy = recycle_policy or RecyclePolicy()
+        self.load_strategy = load_strategy
+        self.pages_loaded = 0
+        self.average_load_seconds = None
+        self.blocked_urls: list = []
         self.start_selenium_driver(cookie_file)
 
     def start_selenium_driver(self, cookie_file="cookies.json"):
+        self.pages_loaded = 0
         user_agent = "user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/103.0.0.0 Safari/537.36"
         self.driver = self.load_chrome_driver(user_agent)
         self.set_cookies(cookie_file)
@@ -25,6 +92,7 @@ class PageLoader:
         opts.add_argument("--headless")
         opts.add_argument("--no-sandbox")
         opts.add_argument("--disable-dev-shm-usage")
+        opts.page_load_strategy = self.load_strategy
         return webdriver.Chrome(options=opts)
 
     def set_cookies(self, cookie_file: str):
@@ -47,40 +115,191 @@ class PageLoader:
         with open(file_path(cookies_file), "wb") as cookie_file:
             pickle.dump(self.driver.get_cookies(), cookie_file)
 
-    def load_page(self, page_url) -> str | None:
+    def load_page(self, page_url, waits=None) -> str | None:
+        """Html of the page, waits are the elements to wait for when the
+        load strategy is not normal, LESSON_WAITS by default"""
+        self.check_health()
+        waits = LESSON_WAITS if waits is None else waits
         html = None
         try:
-            self.driver.get(page_url)
-            html = self.driver.page_source
+            html = self.navigate(page_url, waits)
         except Exception as e:
             print(f"Something failed while loading the page: {page_url}")
             print(e)
-            if "page crash" in str(e):
-                print("Trying to restart the driver...")
-                self.start_selenium_driver(self.cookie_file)
-                print("Trying to request the page again...")
-                self.driver.get(page_url)
-                html = self.driver.page_source
+            if "page crash" in str(e) or not self.is_responsive():
+                try:
+                    self.restart("crash")
+                    print("Trying to request the page again...")
+                    html = self.navigate(page_url, waits)
+                except Exception as e:
+                    print(e)
+        return html
+
+    def navigate(self, page_url, waits=()) -> str:
+        self.pages_loaded += 1
+        start = time.perf_counter()
+        try:
+            old_page = None
+            if self.load_strategy == "none":
+                old_page = self.current_document()
+            self.driver.get(page_url)
+            if self.load_strategy != "normal":
+                self.wait_for_elements(page_url, waits, old_page)
+            return self.driver.page_source
         finally:
-            return html
+            seconds = time.perf_counter() - start
+            PAGE_LOAD_SECONDS.observe(seconds, loader="chrome")
+            if self.average_load_seconds is None:
+                self.average_load_seconds = seconds
+            else:
+                self.average_load_seconds += LOAD_TIME_WEIGHT * (
+                    seconds - self.average_load_seconds
+                )
 
-    def save_screenshot(self, screen_shot_path: str = "screenshot") -> None:
-        # Ref: https://stackoverflow.com/a/52572919/
-        original_size = self.driver.get_window_size()
-        required_width = self.driver.execute_script(
-            "return document.body.parentNode.scrollWidth"
-        )
-        required_height = self.driver.execute_script(
-            "return document.body.parentNode.scrollHeight"
-        )
-        self.driver.set_window_size(required_width, required_height)
-        self.driver.find_element_by_tag_name("body").screenshot(
-            screen_shot_path + ".png"
-        )  # avoids scrollbar
-        self.driver.set_window_size(
-            original_size["width"], original_size["height"]
+    def current_document(self):
+        """Root element of the page shown now, None if there is none"""
+        try:
+            return self.driver.find_element(By.TAG_NAME, "html")
+        except WebDriverException:
+            return None
+
+    def wait_until(self, condition, timeout: float):
+        return WebDriverWait(self.driver, timeout, WAIT_POLL_SECONDS).until(
+            condition
         )
 
+    def wait_for_elements(self, page_url, waits, old_page=None):
+        """Waits for each (css selector, seconds) of waits in turn, once
+        old_page is gone. At the first one missing the page is read as it
+        is, the parser then decides what to do with it"""
+        if old_page is not None:
+            self.wait_until(staleness_of(old_page), NAVIGATION_TIMEOUT)
+        for selector, timeout in waits:
+            try:
+                self.wait_until(
+                    presence_of_element_located((By.CSS_SELECTOR, selector)),
+                    timeout,
+                )
+            except TimeoutException:
+                print(f"No {selector} after {timeout}s in {page_url}")
+                return
+
+    def wait_until_complete(self, timeout=LOAD_COMPLETE_TIMEOUT):
+        """Waits for the page to finish loading, images and fonts too.
+        driver.get already did with the normal load strategy"""
+        if self.load_strategy == "normal":
+            return
+        try:
+            self.wait_until(
+                lambda driver: driver.execute_script(
+                    "return document.readyState"
+                )
+                == "complete",
+                timeout,
+            )
+        except TimeoutException:
+            print(f"Page still loading after {timeout}s, using it as it is")
+
+    def check_health(self):
+        """Restarts Chrome before the next page if it is worn out"""
+        reason = self.recycle_policy.reason(self)
+        if reason:
+            self.restart(reason)
+
+    def restart(self, reason: str):
+        print(f"Restarting Chrome ({reason})...")
+        DRIVER_RESTARTS.inc(reason=reason)
+        self.quit()
+        self.average_load_seconds = None
+        blocked_urls, self.blocked_urls = self.blocked_urls, []
+        self.start_selenium_driver(self.cookie_file)
+        self.set_blocked_urls(blocked_urls)
+
+    def set_blocked_urls(self, patterns: list):
+        """Requests to urls matching the patterns fail without going out,
+        an empty list loads everything again"""
+        if patterns == self.blocked_urls:
+            return
+        if patterns:
+            self.driver.execute_cdp_cmd("Network.enable", {})
+            self.driver.execute_cdp_cmd(
+                "Network.setBlockedURLs", {"urls": patterns}
+            )
+        else:
+            self.driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": []})
+            self.driver.execute_cdp_cmd("Network.disable", {})
+        self.blocked_urls = list(patterns)
+
+    def chrome_rss(self) -> int | None:
+        """Bytes of memory used by chromedriver and every Chrome process it
+        started, None without psutil"""
+        service = getattr(self.driver, "service", None)
+        if psutil is None or service is None or service.process is None:
+            return None
+        try:
+            driver_process = psutil.Process(service.process.pid)
+            processes = [driver_process] + driver_process.children(
+                recursive=True
+            )
+        except psutil.Error:
+            return None
+        rss = 0
+        for process in processes:
+            try:
+                rss += process.memory_info().rss
+            except psutil.Error:
+                # Exited since we listed it
+                pass
+        return rss
+
+    def is_responsive(self, timeout=PING_TIMEOUT) -> bool:
+        """Whether Chrome still runs a trivial script in time"""
+        answered = Event()
+
+        def ping():
+            try:
+                self.driver.execute_script("return 1")
+                answered.set()
+            except Exception:
+                pass
+
+        Thread(target=ping, name="chrome-ping", daemon=True).start()
+        return answered.wait(timeout)
+
+    @property
+    def debugger_address(self) -> str:
+        """host:port of the DevTools endpoint of this Chrome"""
+        return self.driver.capabilities["goog:chromeOptions"][
+            "debuggerAddress"
+        ]
+
+    def quit(self):
+        try:
+            self.driver.quit()
+        except Exception as e:
+            print(f"Failed to quit the driver: {e}")
+
+    def capture_screenshot(self, params=None) -> str | None:
+        """Base64 screenshot of the whole page, without resizing the window"""
+        metrics = self.send_devtools("Page.getLayoutMetrics")
+        if not metrics:
+            return None
+        size = metrics.get("cssContentSize", metrics["contentSize"])
+        params = dict(params or {"format": "png"})
+        params["captureBeyondViewport"] = True
+        params["clip"] = full_page_clip(size)
+        with CAPTURE_SECONDS.time(kind="screenshot"):
+            result = self.send_devtools("Page.captureScreenshot", params)
+        if result is None:
+            return None
+        return result["data"]
+
+    def save_screenshot(self, screen_shot_path: str = "screenshot") -> None:
+        data = self.capture_screenshot()
+        if data:
+            with open(screen_shot_path + ".png", "wb") as file:
+                file.write(base64.b64decode(data))
+
     def save_screenshot_as_pdf(self, file_path: str):
         self.send_devtools("Emulation.setEmulatedMedia", {"media": "screen"})
         pdf_options = {
@@ -88,7 +307,8 @@ class PageLoader:
             "paperWidth": 8,
             "printBackground": True,
         }
-        self.save_as_pdf(file_path + ".pdf", pdf_options)
+        with CAPTURE_SECONDS.time(kind="pdf"):
+            self.save_as_pdf(file_path + ".pdf", pdf_options)
 
     def send_devtools(self, cmd, params={}):
         resource = (
@@ -115,3 +335,124 @@ class PageLoader:
     def save_html(self, html_file_path: str = "out"):
         with open(file_path(html_file_path) + ".html", "w") as f:
             f.write(self.driver.page_source)
+
+
+class RecyclePolicy:
+    """Decides when a PageLoader's Chrome is worn out and should be
+    restarted: too many pages, too much memory or too slow. None turns a
+    limit off. Without psutil the memory is not checked."""
+
+    def __init__(
+        self,
+        max_pages=MAX_PAGES_PER_DRIVER,
+        max_rss_mb=MAX_CHROME_RSS_MB,
+        max_load_seconds=MAX_AVERAGE_LOAD_SECONDS,
+    ):
+        self.max_pages = max_pages
+        self.max_rss_mb = max_rss_mb
+        self.max_load_seconds = max_load_seconds
+        if max_rss_mb is not None and psutil is None:
+            print("psutil is not installed, Chrome memory is not watched")
+
+    def reason(self, page_loader: PageLoader) -> str | None:
+        """Why the loader should be restarted, None if it is fine"""
+        if (
+            self.max_pages is not None
+            and page_loader.pages_loaded >= self.max_pages
+        ):
+            return "pages"
+        if (
+            self.max_load_seconds is not None
+            and page_loader.average_load_seconds is not None
+            and page_loader.average_load_seconds > self.max_load_seconds
+        ):
+            return "slow"
+        if self.max_rss_mb is not None:
+            rss = page_loader.chrome_rss()
+            if rss is not None and rss > self.max_rss_mb * MB:
+                return "memory"
+        return None
+
+    def should_recycle(self, page_loader: PageLoader) -> bool:
+        return self.reason(page_loader) is not None
+
+
+class PageLoaderPool:
+    """Keeps warm PageLoaders around so each module doesn't pay for a
+    cold Chrome start and the cookie injection"""
+
+    def __init__(
+        self,
+        size=1,
+        recycle_policy=None,
+        loader_factory=PageLoader,
+        cookie_file="cookies.json",
+        load_strategy="normal",
+    ):
+        self.size = size
+        self.recycle_policy = recycle_policy or RecyclePolicy()
+        self.loader_factory = loader_factory
+        self.cookie_file = cookie_file
+        self.load_strategy = load_strategy
+        self._idle: list = []
+        self._created = 0
+        # Signalled when a loader is released or discarded
+        self._changed = Condition()
+
+    def acquire(self) -> PageLoader:
+        """Hands out an idle loader, starting a new one if the pool is not
+        full yet, otherwise waits for a loader to be released or discarded"""
+        with self._changed:
+            while not self._idle and self._created >= self.size:
+                self._changed.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._created += 1
+        try:
+            return self.loader_factory(
+                self.cookie_file, self.recycle_policy, self.load_strategy
+            )
+        except Exception:
+            self._forget()
+            raise
+
+    def release(self, page_loader: PageLoader):
+        if self.recycle_policy.should_recycle(page_loader):
+            print("Recycling driver...")
+            self.discard(page_loader)
+            return
+        with self._changed:
+            self._idle.append(page_loader)
+            self._changed.notify()
+
+    def discard(self, page_loader: PageLoader):
+        """Quits a loader that should not go back into the pool, a waiter
+        starts a new one in its place"""
+        try:
+            page_loader.quit()
+        finally:
+            self._forget()
+
+    def _forget(self):
+        with self._changed:
+            self._created -= 1
+            self._changed.notify()
+
+    @contextmanager
+    def loader(self):
+        page_loader = self.acquire()
+        try:
+            yield page_loader
+        except Exception:
+            # Don't hand a driver in an unknown state to the next module
+            self.discard(page_loader)
+            raise
+        self.release(page_loader)
+
+    def close(self):
+        while True:
+            with self._changed:
+                if not self._idle:
+                    break
+                page_loader = self._idle.pop()
+            self.discard(page_loader)
@@ -1,67 +1,287 @@
+import hashlib
 import json
 from collections import OrderedDict
 from urllib.parse import urljoin
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, NavigableString
+
+from metrics import PARSE_SECONDS
+from misc import get_html_parser
+
+# Backends PageParser.extract can use, selectolax is optional
+EXTRACT_BACKENDS = ["html.parser", "lxml", "selectolax"]
+# Text in these tags is not part of the lesson text
+HIDDEN_TAGS = ["script", "style", "noscript"]
+# Navigation around the lesson, the same on every lesson of a module. Its
+# text is left out of the lesson text, so adding a lesson to the listing
+# doesn't change the fingerprint of all the others
+NAVIGATION_CLASSES = {"breadcrumbs", "category-listing", "cat_menu", "sidebar"}
+
+
+def get_extract_backend(name="html.parser"):
+    if name == "selectolax":
+        try:
+            import selectolax  # noqa: F401
+        except ImportError:
+            print("selectolax is not installed, using html.parser")
+            return "html.parser"
+        return name
+    return get_html_parser(name)
+
+
+class LessonRecord:
+    """Everything the crawler takes from a lesson page"""
+
+    __slots__ = (
+        "breadcrumbs",
+        "section_title",
+        "lessons",
+        "files",
+        "video",
+        "assessment",
+        "text",
+    )
+
+    def __init__(self):
+        self.breadcrumbs = None
+        self.section_title = None
+        # Links of the lessons of the section, None if there is no listing
+        self.lessons = None
+        self.files = None
+        self.video = None
+        self.assessment = None
+        self.text = ""
+
+    @property
+    def path(self) -> str:
+        return "/".join([s.strip() for s in self.breadcrumbs.split("/")])
+
+    @property
+    def title(self) -> str:
+        return self.breadcrumbs.split("/")[-1].strip()
+
+    @property
+    def project_folder(self) -> str:
+        return self.breadcrumbs.split("/")[0].strip()
+
+    def fingerprint(self) -> dict:
+        """Hash of each part of the lesson we save, to tell what changed
+        since the last time the lesson was crawled"""
+        parts = {
+            "breadcrumbs": " ".join((self.breadcrumbs or "").split()),
+            "body": self.text,
+            "files": json.dumps(self.files),
+            "video": self.video or "",
+            "assessment": self.assessment or "",
+        }
+        return {
+            part: hashlib.sha1(value.encode()).hexdigest()
+            for part, value in parts.items()
+        }
+
+
+def video_url(json_ld: str) -> str | None:
+    return json.loads(json_ld)["contentUrl"] or None
+
+
+def assessment_url(base_url: str, src: str | None) -> str | None:
+    if not src:
+        return None
+    return urljoin(base_url, src.split("?")[0])
+
+
+def normalize_text(texts) -> str:
+    return " ".join(" ".join(texts).split())
+
+
+def last_descendant(element):
+    """Where the walk over the element's children ends"""
+    last = None
+    for last in element.descendants:
+        pass
+    return last
+
+
+def extract_from_soup(soup, base_url: str) -> LessonRecord:
+    """Fills the record in one walk of the body, then of the head for
+    what was not in the body"""
+    record = LessonRecord()
+    texts: list = []
+    # Like soup.find, only the first of each container counts
+    found = set()
+    # Last element of the navigation being walked, its text is skipped
+    navigation_end = None
+    body = soup.body
+    roots = [(body, True), (soup.head, False)] if body else [(soup, True)]
+    for root, in_body in roots:
+        if root is None:
+            continue
+        for element in root.descendants:
+            if isinstance(element, NavigableString):
+                if (
+                    in_body
+                    and navigation_end is None
+                    and element.parent.name not in HIDDEN_TAGS
+                ):
+                    texts.append(element)
+                if element is navigation_end:
+                    navigation_end = None
+                continue
+            if navigation_end is None and NAVIGATION_CLASSES.intersection(
+                element.get("class") or ()
+            ):
+                navigation_end = last_descendant(element)
+            elif element is navigation_end:
+                navigation_end = None
+            if element.name not in ["div", "script"]:
+                continue
+            classes = set(element.get("class") or ()) - found
+            if element.name == "script":
+                if "w-json-ld" in classes:
+                    found.add("w-json-ld")
+                    record.video = video_url(element.text)
+            elif "breadcrumbs" in classes:
+                found.add("breadcrumbs")
+                record.breadcrumbs = element.text
+            elif "category-listing" in classes:
+                found.add("category-listing")
+                title = element.find("h3", {"class": "title"})
+                record.section_title = title.text if title else None
+                record.lessons = [
+                    urljoin(base_url, link["href"])
+                    for link in element.find_all("a")
+                    if link.has_attr("href")
+                ]
+            elif "download_cont" in classes:
+                found.add("download_cont")
+                record.files = [
+                    (link.find("span").text, link["href"])
+                    for link in element.find_all("a")
+                    if link.has_attr("href")
+                ]
+            elif "assessment-wrapper" in classes:
+                found.add("assessment-wrapper")
+                iframe = element.find("iframe")
+                record.assessment = assessment_url(
+                    base_url, iframe.get("src") if iframe else None
+                )
+    record.text = normalize_text(texts)
+    return record
+
+
+def extract_with_selectolax(html: str, base_url: str) -> LessonRecord:
+    """Same record, with the searches done in C by selectolax"""
+    try:
+        # Modest, selectolax.parser, is gone since selectolax 1.0
+        from selectolax.lexbor import LexborHTMLParser as HTMLParser
+    except ImportError:
+        from selectolax.parser import HTMLParser
+
+    tree = HTMLParser(html)
+    record = LessonRecord()
+    breadcrumbs = tree.css_first("div.breadcrumbs")
+    if breadcrumbs:
+        record.breadcrumbs = breadcrumbs.text(deep=True)
+    listing = tree.css_first("div.category-listing")
+    if listing:
+        title = listing.css_first("h3.title")
+        record.section_title = title.text(deep=True) if title else None
+        record.lessons = [
+            urljoin(base_url, link.attributes["href"])
+            for link in listing.css("a")
+            if "href" in link.attributes
+        ]
+    downloads = tree.css_first("div.download_cont")
+    if downloads:
+        record.files = [
+            (link.css_first("span").text(deep=True), link.attributes["href"])
+            for link in downloads.css("a")
+            if "href" in link.attributes
+        ]
+    json_ld = tree.css_first("script.w-json-ld")
+    if json_ld:
+        record.video = video_url(json_ld.text(deep=True))
+    assessment = tree.css_first("div.assessment-wrapper")
+    if assessment:
+        iframe = assessment.css_first("iframe")
+        record.assessment = assessment_url(
+            base_url, iframe.attributes.get("src") if iframe else None
+        )
+    body = tree.body
+    if body:
+        navigation = ", ".join(f".{name}" for name in NAVIGATION_CLASSES)
+        for hidden in body.css(", ".join(HIDDEN_TAGS + [navigation])):
+            hidden.decompose()
+        record.text = normalize_text([body.text(deep=True, separator=" ")])
+    return record
 
 
 class PageParser:
     BASE_URL = "https://cursos.fluencyacademy.io/"
 
-    def __init__(self, fa_html):
+    def __init__(self, fa_html, backend="html.parser"):
         if not fa_html:
             return None
-        self.soup = BeautifulSoup(fa_html, "html.parser")
+        self.html = fa_html
+        self.backend = backend
+        self._soup = None
+        self._record = None
 
-    def find_video(self) -> str:
-        video_link = self.soup.find("script", {"class": "w-json-ld"})
-        if not video_link:
-            return None
-        video_link = json.loads(video_link.text)["contentUrl"]
-        if not video_link:
-            return None
-        return video_link
+    @property
+    def soup(self):
+        """Parsed on first use, extract with selectolax doesn't need it"""
+        if self._soup is None:
+            features = self.backend
+            if features not in ["html.parser", "lxml"]:
+                features = "html.parser"
+            self._soup = BeautifulSoup(self.html, features)
+        return self._soup
 
-    def find_post_downloads(self):
-        post_downloads = self.soup.find("div", {"class": "download_cont"})
-        if not post_downloads:
-            return None
+    def extract(self) -> LessonRecord:
+        """Everything the crawler needs from a lesson, found in one pass
+        and kept, the lesson getters below all read from it"""
+        if self._record is None:
+            # The parse and the walk, whichever backend does them
+            with PARSE_SECONDS.time():
+                if self.backend == "selectolax":
+                    self._record = extract_with_selectolax(
+                        self.html, self.BASE_URL
+                    )
+                else:
+                    self._record = extract_from_soup(self.soup, self.BASE_URL)
+        return self._record
 
-        files = []
-        for link in post_downloads.find_all("a"):
-            if not link.has_attr("href"):
-                continue
+    def has_lesson_elements(self) -> bool:
+        """Whether the markup we need to crawl a lesson is in the page"""
+        record = self.extract()
+        return record.breadcrumbs is not None and record.lessons is not None
+
+    def get_lesson_text(self) -> str:
+        """Visible text of the lesson, without the navigation around it,
+        whitespace normalized"""
+        return self.extract().text
 
-            url = link["href"]
-            name = link.find("span").text
-            files.append((name, url))
-        return files
+    def fingerprint(self) -> dict:
+        return self.extract().fingerprint()
+
+    def find_video(self) -> str:
+        return self.extract().video
+
+    def find_post_downloads(self):
+        return self.extract().files
 
     def get_project_folder(self):
-        course_path_div = self.soup.find("div", {"class": "breadcrumbs"}).text
-        project_folder = course_path_div.split("/")[0].strip()
-        return project_folder
+        return self.extract().project_folder
 
     def get_lesson_path(self):
-        course_path_div = self.soup.find("div", {"class": "breadcrumbs"}).text
-        course_path = "/".join([s.strip() for s in course_path_div.split("/")])
-        return course_path
+        return self.extract().path
 
     def get_lesson_title(self):
-        return (
-            self.soup.find("div", {"class": "breadcrumbs"})
-            .text.split("/")[-1]
-            .strip()
-        )
+        return self.extract().title
 
     def find_section_lessons(self):
-        lessons_div = self.soup.find("div", {"class": "category-listing"})
-        section_title = lessons_div.find("h3", {"class": "title"}).text
-        lesson_links = lessons_div.find_all("a")
-        lesson_links = [
-            urljoin(self.BASE_URL, link["href"]) for link in lesson_links
-        ]
-        return section_title, lesson_links
+        record = self.extract()
+        return record.section_title, record.lessons or []
 
     def get_modules(self):
         modules_dict = OrderedDict()
@@ -104,19 +324,4 @@ class PageParser:
         return modules_dict
 
     def find_assessment(self) -> str | None:
-        assessment_html = self.soup.find(
-            "div", {"class": "assessment-wrapper"}
-        )
-        if not assessment_html:
-            return None
-
-        assessment_html = self.soup.find(
-            "div", {"class": "assessment-wrapper"}
-        )
-        assessment_iframe = assessment_html.find("iframe")
-        if assessment_iframe.has_attr("src"):
-            assess_url = assessment_iframe["src"]
-            assess_url = assess_url.split("?")[0]
-            return urljoin(self.BASE_URL, assess_url)
-
-        return None
+        return self.extract().assessment
@@ -0,0 +1,103 @@
+import hashlib
+import os
+import sqlite3
+import time
+from pathlib import Path
+from threading import Lock
+
+MANIFEST_FILE = ".manifest.db"
+
+
+def file_digest(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ProcessingManifest:
+    """What each post-processing stage already did to the project's pages.
+
+    For every source html a stage records its mtime, size and sha256, the
+    output it produced, the stage's processing version and anything else
+    the output depends on (context). A page is only processed again when
+    one of those changed or its output is gone. The hash is only read when
+    mtime or size changed, so a file that was just touched is not redone.
+    """
+
+    def __init__(self, project_path, stage: str, version: int):
+        self.root = Path(project_path).absolute()
+        self.stage = stage
+        self.version = version
+        self.lock = Lock()
+        self.conn = sqlite3.connect(
+            self.root / MANIFEST_FILE,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS files (
+                stage TEXT,
+                source TEXT,
+                mtime REAL,
+                size INTEGER,
+                digest TEXT,
+                output TEXT,
+                version INTEGER,
+                context TEXT,
+                updated_at REAL,
+                PRIMARY KEY (stage, source)
+            )"""
+        )
+
+    def _key(self, path) -> str:
+        return os.path.relpath(Path(path).absolute(), self.root)
+
+    def is_current(self, source, output, context="") -> bool:
+        """True if source was already processed into output as it is now"""
+        source = Path(source)
+        with self.lock:
+            row = self.conn.execute(
+                """SELECT mtime, size, digest, output, version, context
+                FROM files WHERE stage = ? AND source = ?""",
+                (self.stage, self._key(source)),
+            ).fetchone()
+        if not row:
+            return False
+        mtime, size, digest, recorded_output, version, recorded_context = row
+        if version != self.version or recorded_context != context:
+            return False
+        if recorded_output != self._key(output) or not Path(output).exists():
+            return False
+        stat = source.stat()
+        if stat.st_mtime == mtime and stat.st_size == size:
+            return True
+        if stat.st_size != size or file_digest(source) != digest:
+            return False
+        # Same content, only the mtime changed
+        self.record(source, output, context, digest)
+        return True
+
+    def record(self, source, output, context="", digest=None):
+        source = Path(source)
+        stat = source.stat()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self.stage,
+                    self._key(source),
+                    stat.st_mtime,
+                    stat.st_size,
+                    digest or file_digest(source),
+                    self._key(output),
+                    self.version,
+                    context,
+                    time.time(),
+                ),
+            )
+
+    def close(self):
+        self.conn.close()
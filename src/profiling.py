@@ -0,0 +1,88 @@
+import cProfile
+import re
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+# Allocations listed in the report of every stage
+TOP_ALLOCATIONS = 25
+# Left out of the allocation reports, they are the profiling itself
+OWN_FRAMES = [
+    tracemalloc.Filter(False, cProfile.__file__),
+    tracemalloc.Filter(False, tracemalloc.__file__),
+]
+
+
+def stage_file_name(index: int, name: str) -> str:
+    return f"{index:02}-" + re.sub(r"[^\w.-]+", "_", name).strip("_")[:80]
+
+
+class Profiler:
+    """Profiles the main stages of a run when given a run directory.
+
+    Each stage gets a .prof file from cProfile (open it with pstats or
+    snakeviz) and a text report of the lines that allocated the most
+    memory during it, from tracemalloc. Only the thread that runs the
+    stage is profiled, work done in the Downloader loop or in worker
+    processes shows up as waiting. Without a run directory stage does
+    nothing, so the stages cost nothing extra.
+    """
+
+    def __init__(self, run_dir=None, top=TOP_ALLOCATIONS):
+        self.run_dir = Path(run_dir) if run_dir else None
+        self.top = top
+        self.stages = 0
+        if self.run_dir:
+            self.run_dir.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.run_dir is not None
+
+    def stage(self, name: str):
+        if not self.enabled:
+            return nullcontext()
+        return self._profile(name)
+
+    @contextmanager
+    def _profile(self, name: str):
+        self.stages += 1
+        base = self.run_dir / stage_file_name(self.stages, name)
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot().filter_traces(OWN_FRAMES)
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            seconds = time.perf_counter() - start
+            # Before dump_stats, so its allocations are not in the report
+            self.write_allocations(
+                str(base) + "-alloc.txt", name, seconds, before
+            )
+            profile.dump_stats(str(base) + ".prof")
+            if started_tracing:
+                tracemalloc.stop()
+
+    def write_allocations(self, report_file, name, seconds, before):
+        current, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot().filter_traces(OWN_FRAMES)
+        stats = after.compare_to(before, "lineno")[: self.top]
+        with open(report_file, "w") as f:
+            f.write(f"Stage: {name}\n")
+            f.write(f"Seconds: {seconds:.3f}\n")
+            f.write(f"Traced memory: {current / 1024:.1f} KiB\n")
+            f.write(f"Peak during stage: {peak / 1024:.1f} KiB\n")
+            f.write(f"Top {self.top} allocations since the stage started:\n")
+            for stat in stats:
+                f.write(f"{stat}\n")
+
+
+# Used when profiling is off
+NO_PROFILER = Profiler()
@@ -0,0 +1,38 @@
+# What the crawl browser doesn't load when blocking is on. The crawler
+# only needs the DOM of a lesson, the assets of the page are downloaded
+# later from the saved html. Video players and the scripts that fill the
+# page are left alone, only their media is dropped.
+IMAGE_URLS = [
+    "*.png",
+    "*.jpg",
+    "*.jpeg",
+    "*.gif",
+    "*.webp",
+    "*.svg",
+    "*.ico",
+]
+FONT_URLS = ["*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot"]
+MEDIA_URLS = ["*.mp4", "*.webm", "*.m4s", "*.mp3", "*.bin"]
+TRACKER_URLS = [
+    "*google-analytics.com*",
+    "*googletagmanager.com*",
+    "*doubleclick.net*",
+    "*connect.facebook.net*",
+    "*hotjar.com*",
+    "*clarity.ms*",
+    "*hs-analytics.net*",
+    "*mixpanel.com*",
+    "*segment.com*",
+]
+# For Network.setBlockedURLs
+BLOCKED_URLS = IMAGE_URLS + FONT_URLS + MEDIA_URLS + TRACKER_URLS
+# Failed with Fetch interception in tabs, whatever their url
+BLOCKED_RESOURCE_TYPES = ["Image", "Font", "Media"]
+
+
+def fetch_patterns() -> list:
+    """Fetch.enable patterns that pause the blocked resource types"""
+    return [
+        {"urlPattern": "*", "resourceType": resource_type}
+        for resource_type in BLOCKED_RESOURCE_TYPES
+    ]
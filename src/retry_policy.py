@@ -0,0 +1,214 @@
+import asyncio
+import random
+import time
+from threading import Lock
+from urllib.parse import urlparse
+
+from metrics import CIRCUIT_OPENS
+
+# Failures in a row that open the circuit of a host
+FAILURES_TO_OPEN = 5
+# How long an open circuit pauses the host, doubled every time it opens
+# again without a success in between
+OPEN_SECONDS = 10
+MAX_OPEN_SECONDS = 300
+# A half open circuit lets one request through to test the host, others
+# check again after PROBE_WAIT; a probe nobody reported on expires
+PROBE_WAIT = 1
+PROBE_TIMEOUT = 120
+# Retries allowed per host: RETRY_RESERVE, plus RETRY_RATIO of the
+# requests made, up to MAX_RETRY_TOKENS saved
+RETRY_RESERVE = 10
+RETRY_RATIO = 0.2
+MAX_RETRY_TOKENS = 100
+
+
+def host_of(url: str) -> str:
+    return urlparse(url).netloc
+
+
+def is_host_failure(status: int) -> bool:
+    """Statuses that mean the host is struggling, not that the request
+    was wrong"""
+    return status == 429 or status >= 500
+
+
+def retry_after_seconds(resp) -> float | None:
+    # Only the delta-seconds form, dates are rare for 429 and 503
+    value = resp.headers.get("Retry-After", "")
+    return float(value) if value.isdigit() else None
+
+
+class HostHealth:
+    """Circuit breaker and retry budget of one host.
+
+    The circuit opens after FAILURES_TO_OPEN failures in a row and pauses
+    every request to the host. Once the pause is over a single probe goes
+    through: a success closes the circuit, a failure opens it again for
+    twice as long. Retries are paid from a budget filled by the requests
+    made, so a failing host can't turn every request into several.
+    """
+
+    def __init__(self, host: str):
+        self.host = host
+        self.lock = Lock()
+        self.failures = 0
+        self.open_seconds = OPEN_SECONDS
+        self.open_until = 0.0
+        self.half_open = False
+        self.probe_started = None
+        self.not_before = 0.0
+        self.tokens = float(RETRY_RESERVE)
+        # Times the circuit opened
+        self.opened = 0
+
+    def wait_time(self) -> float:
+        """Seconds to wait before sending a request to the host, 0 when it
+        may go now"""
+        with self.lock:
+            now = time.monotonic()
+            wait = max(self.open_until, self.not_before) - now
+            if wait > 0:
+                return wait
+            if not self.half_open:
+                return 0
+            if self.probe_started and now - self.probe_started < PROBE_TIMEOUT:
+                return PROBE_WAIT
+            self.probe_started = now
+            return 0
+
+    def record_request(self):
+        with self.lock:
+            self.tokens = min(MAX_RETRY_TOKENS, self.tokens + RETRY_RATIO)
+
+    def withdraw_retry(self) -> bool:
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.open_seconds = OPEN_SECONDS
+            self.half_open = False
+            self.probe_started = None
+
+    def record_failure(self, retry_after=None):
+        with self.lock:
+            now = time.monotonic()
+            if retry_after:
+                self.not_before = max(self.not_before, now + retry_after)
+            self.failures += 1
+            if now < self.open_until:
+                # Sent before the pause, it is already paused
+                return
+            if self.half_open:
+                # The probe failed
+                self.open_seconds = min(
+                    MAX_OPEN_SECONDS, self.open_seconds * 2
+                )
+            elif self.failures < FAILURES_TO_OPEN:
+                return
+            self.open_until = now + self.open_seconds
+            self.half_open = True
+            self.probe_started = None
+            self.opened += 1
+        CIRCUIT_OPENS.inc(host=self.host)
+        print(
+            f"Pausing {self.host} for {self.open_seconds}s, it keeps failing"
+        )
+
+
+class RetryPolicy:
+    """How many times and how far apart to try something against a host.
+
+    Tries are spaced by exponential backoff with full jitter, only happen
+    while the host has retry budget left and wait for its circuit to be
+    closed. The health of a host is shared by every policy, so downloads,
+    videos and the crawl all back off from a failing host together.
+
+        async for attempt in DOWNLOAD_RETRY.attempts(host):
+            ...  # continue to try again, break when done
+
+    Call record_success or record_failure with what the host answered,
+    responses that are the request's fault (404) count as a success.
+    """
+
+    hosts: dict = {}
+    _hosts_lock = Lock()
+
+    def __init__(self, tries=3, base_delay=1.0, max_delay=30.0):
+        self.tries = tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @classmethod
+    def reset(cls):
+        """Forgets the health of every host"""
+        with cls._hosts_lock:
+            cls.hosts.clear()
+
+    @classmethod
+    def health(cls, host: str) -> HostHealth:
+        with cls._hosts_lock:
+            if host not in cls.hosts:
+                cls.hosts[host] = HostHealth(host)
+            return cls.hosts[host]
+
+    def delay(self, attempt: int) -> float:
+        """Full jitter, between 0 and the exponential backoff"""
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, backoff)
+
+    def retry_delay(self, host: str, attempt: int) -> float | None:
+        """Seconds to wait before attempt, None when the host is out of
+        retry budget"""
+        if not self.health(host).withdraw_retry():
+            return None
+        return self.delay(attempt)
+
+    async def attempts(self, host: str):
+        health = self.health(host)
+        for attempt in range(self.tries):
+            if attempt:
+                delay = self.retry_delay(host, attempt)
+                if delay is None:
+                    return
+                await asyncio.sleep(delay)
+            opened = health.opened
+            while (wait := health.wait_time()) > 0:
+                await asyncio.sleep(wait)
+                if health.opened != opened:
+                    break
+            if health.opened != opened:
+                # The host failed again while we waited, that was a try
+                continue
+            health.record_request()
+            yield attempt
+
+    def attempts_sync(self, host: str):
+        """attempts for threads, the waits block"""
+        health = self.health(host)
+        for attempt in range(self.tries):
+            if attempt:
+                delay = self.retry_delay(host, attempt)
+                if delay is None:
+                    return
+                time.sleep(delay)
+            opened = health.opened
+            while (wait := health.wait_time()) > 0:
+                time.sleep(wait)
+                if health.opened != opened:
+                    break
+            if health.opened != opened:
+                continue
+            health.record_request()
+            yield attempt
+
+    def record_success(self, host: str):
+        self.health(host).record_success()
+
+    def record_failure(self, host: str, retry_after=None):
+        self.health(host).record_failure(retry_after)
@@ -0,0 +1,202 @@
+import asyncio
+import heapq
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from itertools import count
+
+# Priority lanes, lower goes first. A video holds a VIDEO slot while its
+# segments take SEGMENT slots one at a time, never the same lane, so the
+# videos can't hold every slot their segments need
+ASSET = 0
+ATTACHMENT = 1
+VIDEO = 2
+SEGMENT = 3
+
+# Share of the transfer slots each lane may hold at the same time (there
+# is always at least one slot). On top of that a slot is kept for every
+# lane that has transfers waiting and none running, so assets coming
+# first can't starve attachments and videos
+LANE_SHARE = {ASSET: 1.0, ATTACHMENT: 0.75, VIDEO: 0.125, SEGMENT: 0.5}
+
+# Transfers to one host at the same time: start, floor and ceiling
+HOST_START_LIMIT = 4
+HOST_MIN_LIMIT = 1
+HOST_MAX_LIMIT = 16
+# A response that many times slower than the fastest from the host, and
+# LATENCY_SLACK seconds slower at least, means the host is struggling
+LATENCY_TOLERANCE = 3
+LATENCY_SLACK = 0.1
+# Limit multiplier for slow responses, and for 429, 5xx and stalls
+LATENCY_BACKOFF = 0.9
+OVERLOAD_BACKOFF = 0.5
+
+
+class TokenBucket:
+    """Caps the bytes/sec of everything that consumes from it"""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.tokens = rate or 0
+        self.updated = time.monotonic()
+
+    async def consume(self, amount: int):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self.tokens = min(
+            self.rate, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+        self.tokens -= amount
+        # Went into debt, wait until it is paid back
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class HostLimit:
+    """Transfers allowed to one host at the same time, set by AIMD.
+
+    Grows by about one for every limit transfers that came back fast,
+    halves when the host shows it is overloaded (429, 5xx, a stalled or
+    too slow transfer) and shrinks a bit when responses take much longer
+    than the fastest one seen.
+    """
+
+    def __init__(
+        self,
+        start=HOST_START_LIMIT,
+        minimum=HOST_MIN_LIMIT,
+        maximum=HOST_MAX_LIMIT,
+    ):
+        self.limit = float(start)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.fastest = None
+
+    @property
+    def slots(self) -> int:
+        return int(self.limit)
+
+    def on_response(self, latency: float):
+        if self.fastest is None or latency < self.fastest:
+            self.fastest = latency
+        slow = max(
+            self.fastest * LATENCY_TOLERANCE, self.fastest + LATENCY_SLACK
+        )
+        if latency > slow:
+            self.limit = max(self.minimum, self.limit * LATENCY_BACKOFF)
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_overload(self):
+        self.limit = max(self.minimum, self.limit * OVERLOAD_BACKOFF)
+
+
+class TransferScheduler:
+    """Process wide limit on the transfers running at the same time.
+
+    Transfers wait for a slot in their priority lane: page assets before
+    attachments before videos, first come first served inside a lane, no
+    lane above its LANE_SHARE of the slots, and a slot kept for each lane
+    left waiting with nothing running. Transfers given a host
+    also wait for a slot of the host, whose HostLimit adapts to how the
+    host copes (see record_response and record_overload). All of them
+    share one bytes/sec ceiling. Lives on the Downloader loop.
+    """
+
+    def __init__(self, max_transfers=5, max_bytes_per_sec=None):
+        self.max_transfers = max_transfers
+        self.bucket = TokenBucket(max_bytes_per_sec)
+        self.active: Counter = Counter()
+        self.active_hosts: Counter = Counter()
+        self.hosts: dict = {}
+        self.waiting: list = []
+        self._order = count()
+
+    def lane_limit(self, priority: int) -> int:
+        return max(1, int(self.max_transfers * LANE_SHARE[priority]))
+
+    def host_limit(self, host: str) -> HostLimit:
+        if host not in self.hosts:
+            self.hosts[host] = HostLimit()
+        return self.hosts[host]
+
+    def starved_lanes(self) -> set:
+        """Lanes with transfers waiting and none running"""
+        return {
+            lane
+            for lane, _, granted, _ in self.waiting
+            if not granted.cancelled() and not self.active[lane]
+        }
+
+    def can_start(self, priority: int, host=None, starved=()) -> bool:
+        # Keep a slot for each of the other starved lanes, but never all
+        reserved = min(len(set(starved) - {priority}), self.max_transfers - 1)
+        if sum(self.active.values()) + reserved >= self.max_transfers:
+            return False
+        if self.active[priority] >= self.lane_limit(priority):
+            return False
+        return (
+            host is None
+            or self.active_hosts[host] < self.host_limit(host).slots
+        )
+
+    @asynccontextmanager
+    async def slot(self, priority=ASSET, host=None):
+        granted = asyncio.get_running_loop().create_future()
+        heapq.heappush(
+            self.waiting, (priority, next(self._order), granted, host)
+        )
+        self._dispatch()
+        try:
+            await granted
+        except asyncio.CancelledError:
+            # Cancelled right after getting the slot, give it back
+            if granted.done() and not granted.cancelled():
+                self._release(priority, host)
+            raise
+        try:
+            yield
+        finally:
+            self._release(priority, host)
+
+    def _release(self, priority: int, host=None):
+        self.active[priority] -= 1
+        if host is not None:
+            self.active_hosts[host] -= 1
+        self._dispatch()
+
+    def record_response(self, host: str, latency: float):
+        """Seconds the host took to answer a transfer that went fine"""
+        self.host_limit(host).on_response(latency)
+        self._dispatch()
+
+    def record_overload(self, host: str):
+        """The host answered 429 or 5xx, or a transfer stalled"""
+        self.host_limit(host).on_overload()
+
+    def _dispatch(self):
+        """Hands the free slots to the first waiting transfers allowed to
+        run, in priority order"""
+        still_waiting = []
+        starved = self.starved_lanes()
+        while self.waiting:
+            waiting = heapq.heappop(self.waiting)
+            lane, _, granted, host = waiting
+            if granted.cancelled():
+                continue
+            if self.can_start(lane, host, starved):
+                starved.discard(lane)
+                self.active[lane] += 1
+                if host is not None:
+                    self.active_hosts[host] += 1
+                granted.set_result(None)
+            else:
+                still_waiting.append(waiting)
+        for waiting in still_waiting:
+            heapq.heappush(self.waiting, waiting)
+
+    async def throttle(self, amount: int):
+        """Call with the size of every chunk transferred"""
+        await self.bucket.consume(amount)
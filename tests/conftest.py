@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The modules of src import each other by name, like when main.py runs
+sys.path.insert(0, str(Path(__file__).absolute().parents[1] / "src"))
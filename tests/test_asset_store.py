@@ -0,0 +1,83 @@
+import os
+from concurrent.futures import Future
+
+import pytest
+
+import asset_store
+from asset_store import AssetPlan, AssetStore
+
+LOGO = b"\x89PNG logo"
+
+
+class FakeDownloader:
+    """Serves the urls of files, without any network"""
+
+    files: dict = {}
+
+    def submit_file(self, url, file_path, priority):
+        future = Future()
+        if url in self.files:
+            with open(file_path, "wb") as f:
+                f.write(self.files[url])
+        future.set_result(url in self.files)
+        return future
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = AssetStore(tmp_path)
+    yield store
+    store.close()
+
+
+def ingest(store, url, content):
+    downloaded = store.tmp_path(url)
+    downloaded.write_bytes(content)
+    return store.ingest(url, downloaded)
+
+
+def test_same_content_is_stored_once(store):
+    first = ingest(store, "https://cdn/a/logo.png", LOGO)
+    second = ingest(store, "https://cdn/b/logo.png", LOGO)
+    assert first == second
+    assert len(list(store.objects.rglob("*.png"))) == 1
+    assert not any(store.tmp.iterdir())
+
+
+def test_lessons_get_hardlinks_to_the_blob(store, tmp_path):
+    blob = ingest(store, "https://cdn/logo.png", LOGO)
+    lessons = [
+        tmp_path / "L1" / "img" / "logo.png",
+        tmp_path / "L2" / "logo.png",
+    ]
+    for dest in lessons:
+        assert store.link("https://cdn/logo.png", dest)
+    assert all(os.path.samefile(dest, blob) for dest in lessons)
+    assert blob.stat().st_nlink == 3
+
+
+def test_unknown_url_is_not_linked(store, tmp_path):
+    assert store.lookup("https://cdn/missing.png") is None
+    assert not store.link("https://cdn/missing.png", tmp_path / "x.png")
+
+
+def test_plan_has_all_only_once_every_asset_is_stored(
+    store, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(asset_store, "Downloader", FakeDownloader)
+    monkeypatch.setattr(
+        FakeDownloader, "files", {"https://cdn/logo.png": LOGO}
+    )
+    plan = AssetPlan(store)
+    page = [
+        ("https://cdn/logo.png", tmp_path / "L1" / "logo.png"),
+        ("https://cdn/gone.png", tmp_path / "L1" / "gone.png"),
+    ]
+    for url, dest in page:
+        plan.add(url, dest)
+    assert not plan.has_all(page)
+
+    assert not plan.link_page(page)
+    assert plan.has_all(page[:1])
+    assert not plan.has_all(page)
+    assert (tmp_path / "L1" / "logo.png").read_bytes() == LOGO
@@ -0,0 +1,78 @@
+import asyncio
+import time
+
+from aiohttp import web
+
+from cdp_tabs import fetch_pages
+
+
+async def fake_chrome(on_message):
+    """DevTools endpoint that hands every command to on_message"""
+
+    async def version(request):
+        port = request.url.port
+        return web.json_response(
+            {"webSocketDebuggerUrl": f"ws://127.0.0.1:{port}/devtools"}
+        )
+
+    async def devtools(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for msg in ws:
+            if not await on_message(ws, msg.json()):
+                break
+        await ws.close()
+        return ws
+
+    app = web.Application()
+    app.router.add_get("/json/version", version)
+    app.router.add_get("/devtools", devtools)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"127.0.0.1:{runner.addresses[0][1]}"
+
+
+async def fetch_with(on_message):
+    runner, address = await fake_chrome(on_message)
+    try:
+        start = time.monotonic()
+        pages = await asyncio.wait_for(
+            fetch_pages(address, ["http://lesson/1", "http://lesson/2"], 2),
+            timeout=10,
+        )
+        return pages, time.monotonic() - start
+    finally:
+        await runner.cleanup()
+
+
+def test_closed_socket_fails_the_pages():
+    async def close_after_target(ws, message):
+        if message["method"] == "Target.createTarget":
+            await ws.send_json(
+                {"id": message["id"], "result": {"targetId": "t1"}}
+            )
+            return True
+        # Chrome went away in the middle of the load
+        return False
+
+    pages, seconds = asyncio.run(fetch_with(close_after_target))
+
+    assert pages == [None, None]
+    assert seconds < 5
+
+
+def test_binary_messages_are_ignored():
+    async def answer_once(ws, message):
+        await ws.send_bytes(b"\x00")
+        if message["method"] == "Target.createTarget":
+            await ws.send_json(
+                {"id": message["id"], "result": {"targetId": "t1"}}
+            )
+            return True
+        return False
+
+    pages, _ = asyncio.run(fetch_with(answer_once))
+
+    assert pages == [None, None]
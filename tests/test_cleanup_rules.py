@@ -0,0 +1,82 @@
+import pytest
+from bs4 import BeautifulSoup
+
+from cleanup_rules import CLEANUP_RULES
+
+BLOCK_WORDS = [
+    "user",
+    "analyt",
+    "google",
+    "octa",
+    "chat",
+    "survey",
+    "track",
+    "metric",
+    "token",
+]
+
+
+def baseline_cleanup(soup):
+    """The remove_* passes CLEANUP_RULES replaced, one walk each"""
+    for noscript in soup("noscript"):
+        noscript.extract()
+    for div in soup.select('div[class*="octa"]'):
+        div.extract()
+    for tag in soup(["script", "a", "input", "meta"]):
+        if any(word in str(tag).lower() for word in BLOCK_WORDS):
+            tag.decompose()
+    for name, attrs in [
+        ("div", {"class": "social_area"}),
+        ("div", {"class": "btn_vid_after"}),
+        ("div", {"class": "post-audio"}),
+        ("div", {"class": "sidebar"}),
+        ("div", {"id": "survicate-box"}),
+        ("a", {"class": "add_deck"}),
+    ]:
+        tag = soup.find(name, attrs)
+        if tag:
+            tag.decompose()
+    for tag in soup.find_all("body", {"class": "containEmbed"}):
+        tag.decompose()
+    for tag in soup.find_all("input", {"id": "assessment_result_email"}):
+        tag.decompose()
+
+
+PAGES = [
+    # The block word is only in a noscript, removed before the check
+    '<a href="/lesson"><noscript><img src="https://google.com/p.gif">'
+    "</noscript>Next lesson</a>",
+    '<a href="/lesson"><div class="octa-chat">x</div>Next</a>',
+    '<div class="social_area">1</div><div class="social_area">2</div>',
+    # The first social area is inside the sidebar, removed after it
+    '<div class="sidebar"><div class="social_area">1</div></div>'
+    '<div class="social_area">2</div>',
+    '<div class="social_area"><div class="social_area">in</div></div>'
+    '<div class="social_area">out</div>',
+    '<a class="add_deck" href="/user/deck">deck</a>'
+    '<a class="add_deck" href="/deck">deck</a>',
+    '<script>window.dataLayer = "Analytics"</script>'
+    '<meta name="csrf-token" content="x"><meta charset="utf-8">'
+    '<a href="/lessons/2"><span data-track="1">next</span></a>'
+    '<a href="/lessons/3">Chat &amp; more</a>',
+    '<input id="assessment_result_email"><input name="q">'
+    '<div class="btn_vid_after"><a href="/x">after</a></div>'
+    '<div class="post-audio">a</div><div class="post-audio">b</div>'
+    '<div id="survicate-box">s</div>',
+    '<html><body class="containEmbed"><p>walk</p></body></html>',
+]
+
+
+@pytest.mark.parametrize("html", PAGES)
+def test_same_page_as_the_baseline_passes(html):
+    expected = BeautifulSoup(html, "html.parser")
+    baseline_cleanup(expected)
+    soup = BeautifulSoup(html, "html.parser")
+    CLEANUP_RULES.apply(soup)
+    assert str(soup) == str(expected)
+
+
+def test_counts_the_removed_tags():
+    soup = BeautifulSoup(PAGES[2] + "<noscript></noscript>", "html.parser")
+    hits = CLEANUP_RULES.apply(soup)
+    assert hits == {"user_area": 1, "google_analytics": 1}
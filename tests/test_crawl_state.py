@@ -0,0 +1,19 @@
+from concurrent.futures import Future
+
+from crawl_state import CrawlState
+from crawler import CrawlOptions, save_lesson_state
+
+
+def test_lessons_keep_their_module(tmp_path):
+    crawl_state = CrawlState(str(tmp_path / "crawl_state.db"))
+    video = Future()
+    videos = []
+    for lesson_url, saved in [("/l2", (None, None)), ("/l3", (video, None))]:
+        save_lesson_state(
+            crawl_state, "/m1", lesson_url, {}, saved, videos, CrawlOptions()
+        )
+    # Not done before its video is
+    assert crawl_state.module_lessons("/m1") == ["/l2"]
+    video.set_result(None)
+    assert crawl_state.module_lessons("/m1") == ["/l2", "/l3"]
+    assert crawl_state.module_lessons("/m2") == []
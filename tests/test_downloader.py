@@ -0,0 +1,161 @@
+import asyncio
+import gzip
+from concurrent.futures import Future
+
+import pytest
+from aiohttp import ClientSession, web
+
+import downloader
+from downloader import Downloader, DownloadError, validators_path
+from hls import EncryptedStreamError
+from retry_policy import RetryPolicy
+from transfer_scheduler import TransferScheduler
+
+CSS = b"body { color: red; }\n" * 2000
+
+
+async def serve(handler):
+    app = web.Application()
+    app.router.add_get("/style.css", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}/style.css"
+
+
+async def gzipped(request):
+    body = gzip.compress(CSS)
+    return web.Response(
+        body=body,
+        headers={
+            "Content-Encoding": "gzip",
+            "Content-Type": "text/css",
+            "Content-Length": str(len(body)),
+        },
+    )
+
+
+async def download(handler, file_path) -> bool:
+    runner, url = await serve(handler)
+    try:
+        async with ClientSession() as session:
+            return await Downloader.download_one(url, session, file_path)
+    finally:
+        await runner.cleanup()
+
+
+@pytest.fixture(autouse=True)
+def quick_retries(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        downloader, "VALIDATORS_FOLDER", str(tmp_path / "validators")
+    )
+    monkeypatch.setattr(
+        downloader, "DOWNLOAD_RETRY", RetryPolicy(3, 0.01, 0.01)
+    )
+    monkeypatch.setattr(Downloader, "scheduler", TransferScheduler(4))
+    # Every test starts with a healthy host, and leaves none behind
+    RetryPolicy.reset()
+    yield
+    RetryPolicy.reset()
+
+
+def test_gzipped_download_is_saved(tmp_path):
+    lesson = tmp_path / "lesson"
+    lesson.mkdir()
+    file_path = lesson / "style.css"
+
+    asyncio.run(download(gzipped, file_path))
+
+    assert file_path.read_bytes() == CSS
+    assert not (lesson / "style.css.part").exists()
+    # The headers are kept, but not in the lesson folder
+    assert validators_path(file_path).exists()
+    assert [path.name for path in lesson.iterdir()] == ["style.css"]
+
+
+def test_gzipped_download_is_not_taken_as_unchanged(tmp_path):
+    file_path = tmp_path / "style.css"
+    # Same size as the compressed body, but another file
+    file_path.write_bytes(b"x" * len(gzip.compress(CSS)))
+
+    asyncio.run(download(gzipped, file_path))
+
+    assert file_path.read_bytes() == CSS
+
+
+def test_failing_host_raises_once_out_of_tries(tmp_path):
+    requests = []
+
+    async def unavailable(request):
+        requests.append(request)
+        return web.Response(status=503)
+
+    with pytest.raises(DownloadError):
+        asyncio.run(download(unavailable, tmp_path / "style.css"))
+    assert len(requests) == 3
+
+
+def test_refused_download_is_not_retried(tmp_path):
+    requests = []
+
+    async def not_found(request):
+        requests.append(request)
+        return web.Response(status=404)
+
+    assert not asyncio.run(download(not_found, tmp_path / "style.css"))
+    assert len(requests) == 1
+
+
+def test_failing_video_raises_once_out_of_tries(monkeypatch):
+    tries = []
+
+    async def broken(cls, *args):
+        tries.append(args)
+        raise RuntimeError("connection reset")
+
+    monkeypatch.setattr(downloader, "VIDEO_RETRY", RetryPolicy(2, 0.01, 0.01))
+    monkeypatch.setattr(Downloader, "fetch_video", classmethod(broken))
+
+    with pytest.raises(DownloadError):
+        asyncio.run(
+            Downloader.download_video("http://cdn/v.m3u8", "lesson", "v")
+        )
+    assert len(tries) == 2
+
+
+def test_video_in_flight_is_not_started_again(monkeypatch):
+    started = []
+
+    def submit(self, coro):
+        coro.close()
+        started.append(Future())
+        return started[-1]
+
+    monkeypatch.setattr(Downloader, "submit", submit)
+    monkeypatch.setattr(Downloader, "videos", {})
+    loader = object.__new__(Downloader)
+
+    first = loader.submit_video("http://cdn/v.m3u8", "lesson", "v")
+    assert loader.submit_video("http://cdn/v.m3u8", "lesson", "v") is first
+    first.set_result(None)
+    loader.submit_video("http://cdn/v.m3u8", "lesson", "v")
+    assert len(started) == 2
+
+
+def test_drm_video_fails_without_retrying(monkeypatch):
+    tries = []
+
+    async def protected(cls, video_url, *args):
+        tries.append(video_url)
+        raise EncryptedStreamError(video_url)
+
+    monkeypatch.setattr(downloader, "VIDEO_RETRY", RetryPolicy(2, 0.01, 0.01))
+    monkeypatch.setattr(Downloader, "fetch_video", classmethod(protected))
+
+    with pytest.raises(DownloadError):
+        asyncio.run(
+            Downloader.download_video("http://cdn/v.m3u8", "lesson", "v")
+        )
+    assert len(tries) == 1
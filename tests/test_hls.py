@@ -0,0 +1,180 @@
+import asyncio
+
+import pytest
+from aiohttp import ClientSession, web
+
+from hls import (
+    EncryptedStreamError,
+    HlsDownload,
+    UnsupportedPlaylistError,
+    parse_playlist,
+)
+from retry_policy import RetryPolicy
+from transfer_scheduler import HostLimit, TransferScheduler
+
+BASE = "https://cdn.example.com/video/playlist.m3u8"
+
+MASTER = """#EXTM3U
+#EXT-X-STREAM-INF:BANDWIDTH=800000,CODECS="avc1.4d401f,mp4a.40.2"
+low/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=2500000,RESOLUTION=1280x720
+high/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=1200000
+https://other.example.com/mid.m3u8
+"""
+
+MEDIA = """#EXTM3U
+#EXT-X-TARGETDURATION:10
+#EXT-X-MAP:URI="init.mp4"
+#EXTINF:10.0,
+seg-0.ts
+#EXTINF:10.0,
+/abs/seg-1.ts
+#EXT-X-ENDLIST
+"""
+
+
+@pytest.fixture(autouse=True)
+def healthy_hosts():
+    RetryPolicy.reset()
+    yield
+    RetryPolicy.reset()
+
+
+def test_master_playlist_lists_the_variants():
+    playlist = parse_playlist(MASTER, BASE)
+
+    assert playlist["segments"] == []
+    assert playlist["variants"] == [
+        (800000, "https://cdn.example.com/video/low/index.m3u8"),
+        (2500000, "https://cdn.example.com/video/high/index.m3u8"),
+        (1200000, "https://other.example.com/mid.m3u8"),
+    ]
+
+
+def test_media_playlist_resolves_segments_and_init():
+    playlist = parse_playlist(MEDIA, BASE)
+
+    assert playlist["init"] == "https://cdn.example.com/video/init.mp4"
+    assert playlist["segments"] == [
+        "https://cdn.example.com/video/seg-0.ts",
+        "https://cdn.example.com/abs/seg-1.ts",
+    ]
+
+
+@pytest.mark.parametrize(
+    "key",
+    [
+        '#EXT-X-KEY:METHOD=SAMPLE-AES,URI="skd://key",KEYFORMAT="com.apple"',
+        '#EXT-X-KEY:METHOD=SAMPLE-AES,URI="key.bin"',
+        '#EXT-X-KEY:METHOD=AES-128,URI="skd://key",KEYFORMAT="com.apple"',
+    ],
+)
+def test_drm_streams_are_refused(key):
+    with pytest.raises(EncryptedStreamError):
+        parse_playlist(
+            MEDIA.replace("#EXT-X-TARGETDURATION", key + "\n#"), BASE
+        )
+
+
+@pytest.mark.parametrize(
+    "key",
+    [
+        '#EXT-X-KEY:METHOD=AES-128,URI="key.bin"',
+        '#EXT-X-KEY:METHOD=AES-128,URI="key.bin",KEYFORMAT="identity"',
+        '#EXT-X-SESSION-KEY:METHOD=AES-128,URI="key.bin"',
+    ],
+)
+def test_aes_streams_are_left_to_m3u8_to_mp4(key):
+    with pytest.raises(UnsupportedPlaylistError):
+        parse_playlist(
+            MEDIA.replace("#EXT-X-TARGETDURATION", key + "\n#"), BASE
+        )
+
+
+def test_key_method_none_is_not_encrypted():
+    text = MEDIA.replace("#EXTINF", "#EXT-X-KEY:METHOD=NONE\n#EXTINF", 1)
+    assert len(parse_playlist(text, BASE)["segments"]) == 2
+
+
+def test_byte_ranges_are_unsupported():
+    text = MEDIA.replace("seg-0.ts", "#EXT-X-BYTERANGE:1000@0\nseg-0.ts")
+    with pytest.raises(UnsupportedPlaylistError):
+        parse_playlist(text, BASE)
+
+
+async def serve(routes: dict):
+    app = web.Application()
+    for path, handler in routes.items():
+        app.router.add_get(path, handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+
+def text_response(body: str):
+    async def handler(request):
+        return web.Response(text=body)
+
+    return handler
+
+
+def test_best_variant_is_downloaded():
+    async def fetch():
+        runner, url = await serve(
+            {
+                "/master.m3u8": text_response(MASTER),
+                "/high/index.m3u8": text_response("seg-high.ts\n"),
+                "/low/index.m3u8": text_response("seg-low.ts\n"),
+            }
+        )
+        try:
+            async with ClientSession() as session:
+                download = HlsDownload(
+                    session, TransferScheduler(4), f"{url}/master.m3u8", "v"
+                )
+                return await download.fetch_playlist(download.playlist_url)
+        finally:
+            await runner.cleanup()
+
+    playlist = asyncio.run(fetch())
+
+    assert [url.rsplit("/", 2)[1:] for url in playlist["segments"]] == [
+        ["high", "seg-high.ts"]
+    ]
+
+
+def test_segments_wait_for_the_host_limit():
+    in_flight = 0
+    most = 0
+
+    async def segment(request):
+        nonlocal in_flight, most
+        in_flight += 1
+        most = max(most, in_flight)
+        await asyncio.sleep(0.02)
+        in_flight -= 1
+        return web.Response(body=b"ts")
+
+    async def fetch_all():
+        runner, url = await serve({"/seg-{index}.ts": segment})
+        scheduler = TransferScheduler(max_transfers=16)
+        # Fixed at 2, fast answers would raise an adaptive one
+        host = url.split("//")[1]
+        scheduler.hosts[host] = HostLimit(start=2, maximum=2)
+        try:
+            async with ClientSession() as session:
+                download = HlsDownload(session, scheduler, url, "v")
+                return await asyncio.gather(
+                    *[
+                        download.fetch_segment(f"{url}/seg-{index}.ts")
+                        for index in range(8)
+                    ]
+                )
+        finally:
+            await runner.cleanup()
+
+    assert asyncio.run(fetch_all()) == [b"ts"] * 8
+    assert most == 2
@@ -0,0 +1,72 @@
+import time
+
+import pytest
+
+import asset_store
+import lesson_pipeline
+from clean_page import CLEAN_VERSION
+from lesson_pipeline import LessonPipeline
+from make_page_local import LOCALIZE_VERSION, custom_html_path, page_context
+from processing_manifest import ProcessingManifest
+
+PAGE = """<html><body><div class="lesson"><p>Lesson</p></div>
+<script>console.log("tracking")</script></body></html>"""
+
+
+class NoDownloads:
+    def submit_file(self, url, file_path, priority):
+        raise AssertionError(f"{url} should not be downloaded")
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    monkeypatch.setattr(asset_store, "Downloader", NoDownloads)
+    lessons = []
+    for name in ["Lesson 1", "Lesson 2", "Lesson 3"]:
+        lesson = tmp_path / "Course" / name
+        lesson.mkdir(parents=True)
+        (lesson / f"{name}.html").write_text(PAGE)
+        lessons.append(lesson)
+    return tmp_path, lessons
+
+
+def slow_localize(localize_page):
+    def localize(html_path, parser):
+        # The crawl is still adding lessons while this runs
+        time.sleep(0.05)
+        return localize_page(html_path, parser)
+
+    return localize
+
+
+def test_close_finishes_the_lessons_already_added(project, monkeypatch):
+    project_path, lessons = project
+    monkeypatch.setattr(
+        lesson_pipeline,
+        "localize_page",
+        slow_localize(lesson_pipeline.localize_page),
+    )
+    pipeline = LessonPipeline(project_path)
+    for lesson in lessons:
+        pipeline.add(lesson)
+    pipeline.close()
+
+    localized = ProcessingManifest(project_path, "localize", LOCALIZE_VERSION)
+    cleaned = ProcessingManifest(project_path, "clean", CLEAN_VERSION)
+    for lesson in lessons:
+        (page,) = lesson_pipeline.lesson_pages(lesson)
+        custom_html = custom_html_path(page)
+        assert localized.is_current(page, custom_html, page_context(page))
+        assert cleaned.is_current(custom_html, custom_html)
+        assert "<script" not in custom_html.read_text()
+    localized.close()
+    cleaned.close()
+
+
+def test_lessons_added_after_close_are_left_for_the_tree_pass(project):
+    project_path, lessons = project
+    pipeline = LessonPipeline(project_path)
+    pipeline.close()
+    pipeline.add(lessons[0])
+    assert pipeline.lessons.empty()
+    assert not custom_html_path(lessons[0] / "Lesson 1.html").exists()
@@ -0,0 +1,53 @@
+from collections import Counter
+
+import make_page_local
+from make_page_local import (
+    LOCALIZE_VERSION,
+    custom_html_path,
+    download_assets_and_edit_htmls,
+    page_context,
+)
+from processing_manifest import ProcessingManifest
+
+
+class NoDownloads:
+    def __init__(self, asset_store):
+        pass
+
+    def add(self, url, dest):
+        pass
+
+    def execute(self):
+        pass
+
+    def has_all(self, assets) -> bool:
+        return True
+
+
+def test_broken_page_does_not_stop_the_others(tmp_path, monkeypatch):
+    lesson = tmp_path / "Course" / "Lesson"
+    lesson.mkdir(parents=True)
+    pages = [lesson / "broken.html", lesson / "fine.html"]
+    for page in pages:
+        page.write_text("<html><body></body></html>")
+
+    def localize_page(html_path, parser):
+        if html_path.name == "broken.html":
+            raise ValueError("malformed page")
+        custom_html_path(html_path).write_text("<html></html>")
+        return [], Counter(), 0.0
+
+    monkeypatch.setattr(make_page_local, "AssetPlan", NoDownloads)
+    monkeypatch.setattr(make_page_local, "localize_page", localize_page)
+
+    download_assets_and_edit_htmls(tmp_path, workers=1)
+
+    manifest = ProcessingManifest(tmp_path, "localize", LOCALIZE_VERSION)
+    broken, fine = pages
+    assert manifest.is_current(
+        fine, custom_html_path(fine), page_context(fine)
+    )
+    assert not manifest.is_current(
+        broken, custom_html_path(broken), page_context(broken)
+    )
+    manifest.close()
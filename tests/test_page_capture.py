@@ -0,0 +1,23 @@
+from page_capture import with_base_url
+
+
+def test_base_url_goes_first_in_head():
+    page = '<html><HEAD lang="pt"><link href="//cdn.x/a.css"></HEAD></html>'
+    assert with_base_url(page, "https://site/lesson?a=1&b=2") == (
+        '<html><HEAD lang="pt"><base href="https://site/lesson?a=1&amp;b=2">'
+        '<link href="//cdn.x/a.css"></HEAD></html>'
+    )
+
+
+def test_base_url_without_head():
+    page = "<p>No head</p>"
+    assert with_base_url(page, "https://site/") == (
+        '<base href="https://site/"><p>No head</p>'
+    )
+
+
+def test_header_is_not_head():
+    page = "<html><header>x</header><head></head></html>"
+    assert with_base_url(page, "https://site/").endswith(
+        '<head><base href="https://site/"></head></html>'
+    )
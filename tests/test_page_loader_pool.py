@@ -0,0 +1,49 @@
+from threading import Thread
+
+from page_loader import PageLoaderPool
+
+
+class FakeLoader:
+    def __init__(self, cookie_file, recycle_policy, load_strategy):
+        self.quit_called = False
+
+    def quit(self):
+        self.quit_called = True
+
+
+class RecycleAll:
+    def should_recycle(self, page_loader) -> bool:
+        return True
+
+
+class RecycleNone:
+    def should_recycle(self, page_loader) -> bool:
+        return False
+
+
+def test_waiter_starts_a_loader_when_one_is_recycled():
+    pool = PageLoaderPool(
+        size=1, recycle_policy=RecycleAll(), loader_factory=FakeLoader
+    )
+    first = pool.acquire()
+    acquired = []
+    waiter = Thread(target=lambda: acquired.append(pool.acquire()))
+    waiter.start()
+    waiter.join(0.1)
+    assert waiter.is_alive()
+
+    pool.release(first)
+    waiter.join(5)
+
+    assert first.quit_called
+    assert acquired and acquired[0] is not first
+
+
+def test_released_loader_is_reused():
+    pool = PageLoaderPool(
+        size=1, recycle_policy=RecycleNone(), loader_factory=FakeLoader
+    )
+    with pool.loader() as first:
+        pass
+    assert pool.acquire() is first
+    assert not first.quit_called
@@ -0,0 +1,78 @@
+import pytest
+
+from page_parser import PageParser
+
+BASE = "https://cursos.example.com"
+
+
+def lesson_page(lessons=3, text="Text of the lesson."):
+    listing = "".join(
+        f'<a href="{BASE}/m/1/l/{lesson}">Lesson {lesson}</a>'
+        for lesson in range(1, lessons + 1)
+    )
+    return f"""<html><head><title>Lesson</title></head><body>
+    <ul><li class="cat_menu"><a href="{BASE}/m/1/">Module 1</a></li></ul>
+    <div class="breadcrumbs">Course / Module 1 / Lesson 2</div>
+    <div class="category-listing"><h3 class="title">Module 1</h3>
+    {listing}</div>
+    <div class="lesson"><p>{text}</p></div>
+    <script>console.log("tracking")</script>
+    </body></html>"""
+
+
+def test_listing_is_not_part_of_the_lesson_text():
+    parser = PageParser(lesson_page())
+    assert parser.get_lesson_text() == "Text of the lesson."
+
+
+def test_new_lesson_in_the_module_keeps_the_fingerprint():
+    before = PageParser(lesson_page(lessons=3)).fingerprint()
+    after = PageParser(lesson_page(lessons=4)).fingerprint()
+    assert after == before
+
+
+def test_changed_text_changes_the_body():
+    before = PageParser(lesson_page()).fingerprint()
+    after = PageParser(lesson_page(text="New text.")).fingerprint()
+    assert after["body"] != before["body"]
+    assert after["breadcrumbs"] == before["breadcrumbs"]
+
+
+FULL_PAGE = f"""<!DOCTYPE html><html><head><title>Lesson 2</title>
+<style>body {{ color: red; }}</style>
+<script class="w-json-ld">{{"contentUrl": "{BASE}/video/2/index.m3u8"}}</script>
+</head><body>
+<ul><li class="cat_menu"><a href="{BASE}/m/1/">Module 1</a></li></ul>
+<div class="breadcrumbs">Course / Module 1 / Lesson &amp; Review</div>
+<div class="category-listing"><h3 class="title">Module 1</h3>
+<a href="/m/1/">Lesson 1</a><a href="/m/1/l/2">Lesson 2</a><a>Soon</a></div>
+<div class="lesson"><h1>Lesson   2</h1><p>Read <b>this</b> first.</p>
+<noscript>Enable JavaScript</noscript></div>
+<div class="download_cont"><a href="{BASE}/files/2.pdf"><span>Workbook</span>
+</a></div>
+<div class="sidebar"><p>Unit downloads</p></div>
+<div class="assessment-wrapper"><iframe src="/assessment/2?embed=1"></iframe>
+</div>
+<script>console.log("tracking")</script>
+</body></html>"""
+
+
+def record_fields(record) -> dict:
+    return {name: getattr(record, name) for name in record.__slots__}
+
+
+@pytest.mark.parametrize("backend", ["lxml", "selectolax"])
+def test_backends_extract_the_same_record(backend):
+    if backend == "selectolax":
+        pytest.importorskip("selectolax")
+    expected = PageParser(FULL_PAGE, "html.parser").extract()
+    record = PageParser(FULL_PAGE, backend).extract()
+    assert record_fields(record) == record_fields(expected)
+    assert record.fingerprint() == expected.fingerprint()
+
+
+def test_full_page_record():
+    record = PageParser(FULL_PAGE).extract()
+    assert record.video == f"{BASE}/video/2/index.m3u8"
+    assert record.files == [("Workbook", f"{BASE}/files/2.pdf")]
+    assert record.text == "Lesson 2 Read this first. Workbook"
@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+import processing_manifest
+from processing_manifest import ProcessingManifest
+
+
+@pytest.fixture
+def page(tmp_path):
+    source = tmp_path / "lesson.html"
+    source.write_text("<p>lesson</p>")
+    output = tmp_path / "lesson-giow.html"
+    output.write_text("<p>local</p>")
+    manifest = ProcessingManifest(tmp_path, "localize", 1)
+    manifest.record(source, output, "video=None")
+    yield manifest, source, output
+    manifest.close()
+
+
+def test_unrecorded_page_is_not_current(tmp_path):
+    manifest = ProcessingManifest(tmp_path, "localize", 1)
+    source = tmp_path / "new.html"
+    source.write_text("<p>new</p>")
+    assert not manifest.is_current(source, tmp_path / "new-giow.html")
+    manifest.close()
+
+
+def test_unchanged_page_is_not_hashed_again(page, monkeypatch):
+    manifest, source, output = page
+
+    def no_hashing(path):
+        raise AssertionError(f"{path} was hashed")
+
+    monkeypatch.setattr(processing_manifest, "file_digest", no_hashing)
+    assert manifest.is_current(source, output, "video=None")
+
+
+def test_touched_page_is_current_by_its_hash(page, monkeypatch):
+    manifest, source, output = page
+    stat = source.stat()
+    os.utime(source, (stat.st_atime, stat.st_mtime + 10))
+    assert manifest.is_current(source, output, "video=None")
+
+    # The new mtime was recorded, no hashing the next time
+    def no_hashing(path):
+        raise AssertionError(f"{path} was hashed")
+
+    monkeypatch.setattr(processing_manifest, "file_digest", no_hashing)
+    assert manifest.is_current(source, output, "video=None")
+
+
+def test_same_size_new_content_is_not_current(page):
+    manifest, source, output = page
+    stat = source.stat()
+    source.write_text("<p>LESSON</p>")
+    os.utime(source, (stat.st_atime, stat.st_mtime + 10))
+    assert not manifest.is_current(source, output, "video=None")
+
+
+def test_new_version_or_context_is_not_current(page, tmp_path):
+    manifest, source, output = page
+    assert not manifest.is_current(source, output, "video=lesson.mp4")
+    newer = ProcessingManifest(tmp_path, "localize", 2)
+    assert not newer.is_current(source, output, "video=None")
+    other_stage = ProcessingManifest(tmp_path, "clean", 1)
+    assert not other_stage.is_current(source, output, "video=None")
+    newer.close()
+    other_stage.close()
+
+
+def test_missing_output_is_not_current(page):
+    manifest, source, output = page
+    output.unlink()
+    assert not manifest.is_current(source, output, "video=None")
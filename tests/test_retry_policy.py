@@ -0,0 +1,125 @@
+import pytest
+
+import retry_policy
+from retry_policy import (
+    FAILURES_TO_OPEN,
+    OPEN_SECONDS,
+    PROBE_WAIT,
+    RETRY_RATIO,
+    RETRY_RESERVE,
+    HostHealth,
+    RetryPolicy,
+    retry_after_seconds,
+)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+class Response:
+    def __init__(self, headers):
+        self.headers = headers
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(retry_policy, "time", clock)
+    RetryPolicy.reset()
+    yield clock
+    RetryPolicy.reset()
+
+
+def open_circuit(health: HostHealth):
+    for _ in range(FAILURES_TO_OPEN):
+        health.record_failure()
+
+
+@pytest.mark.parametrize("attempt", [1, 2, 3, 6, 10])
+def test_delay_is_full_jitter_up_to_the_backoff(attempt):
+    policy = RetryPolicy(tries=10, base_delay=1, max_delay=20)
+    backoff = min(20, 2 ** (attempt - 1))
+    delays = [policy.delay(attempt) for _ in range(200)]
+    assert all(0 <= delay <= backoff for delay in delays)
+    assert max(delays) > backoff / 2
+
+
+def test_circuit_opens_after_failures_in_a_row():
+    health = HostHealth("cdn")
+    for _ in range(FAILURES_TO_OPEN - 1):
+        health.record_failure()
+    assert health.wait_time() == 0
+    health.record_failure()
+    assert health.wait_time() == OPEN_SECONDS
+    assert health.opened == 1
+
+
+def test_half_open_circuit_lets_one_probe_through(clock):
+    health = HostHealth("cdn")
+    open_circuit(health)
+    clock.now += OPEN_SECONDS
+    assert health.wait_time() == 0
+    # The probe is out, the others wait for it
+    assert health.wait_time() == PROBE_WAIT
+    health.record_success()
+    assert health.wait_time() == 0
+    assert not health.half_open
+
+
+def test_failed_probe_opens_the_circuit_for_longer(clock):
+    health = HostHealth("cdn")
+    open_circuit(health)
+    clock.now += OPEN_SECONDS
+    assert health.wait_time() == 0
+    health.record_failure()
+    assert health.wait_time() == 2 * OPEN_SECONDS
+    assert health.opened == 2
+
+
+def test_retry_after_delays_the_host():
+    health = HostHealth("cdn")
+    health.record_failure(retry_after=30)
+    assert health.wait_time() == 30
+
+
+def test_retry_budget_is_the_reserve_plus_a_share_of_requests():
+    health = HostHealth("cdn")
+    assert all(health.withdraw_retry() for _ in range(RETRY_RESERVE))
+    assert not health.withdraw_retry()
+    for _ in range(round(1 / RETRY_RATIO)):
+        health.record_request()
+    assert health.withdraw_retry()
+    assert not health.withdraw_retry()
+
+
+def test_attempts_stop_when_the_budget_is_used_up():
+    RetryPolicy.health("cdn").tokens = 1
+    policy = RetryPolicy(tries=5, base_delay=0.01, max_delay=0.01)
+    assert list(policy.attempts_sync("cdn")) == [0, 1]
+
+
+@pytest.mark.parametrize(
+    "headers, seconds",
+    [
+        ({"Retry-After": "120"}, 120),
+        ({"Retry-After": "Wed, 21 Oct 2026 07:28:00 GMT"}, None),
+        ({"Retry-After": ""}, None),
+        ({}, None),
+    ],
+)
+def test_retry_after_seconds(headers, seconds):
+    assert retry_after_seconds(Response(headers)) == seconds
+
+
+def test_reset_forgets_the_hosts():
+    open_circuit(RetryPolicy.health("cdn"))
+    RetryPolicy.reset()
+    assert RetryPolicy.health("cdn").wait_time() == 0
@@ -0,0 +1,98 @@
+import asyncio
+
+from transfer_scheduler import (
+    ASSET,
+    ATTACHMENT,
+    HOST_START_LIMIT,
+    VIDEO,
+    HostLimit,
+    TransferScheduler,
+)
+
+
+async def start_order(scheduler, lanes, finished: int) -> list:
+    """Lanes in the order their transfers got a slot, when the first
+    finished transfers to start are done and the others keep theirs"""
+    started = []
+    done = [asyncio.Event() for _ in lanes]
+
+    async def transfer(index, lane):
+        async with scheduler.slot(lane):
+            started.append(index)
+            await done[index].wait()
+
+    tasks = [
+        asyncio.create_task(transfer(index, lane))
+        for index, lane in enumerate(lanes)
+    ]
+    await asyncio.sleep(0.01)
+    for index in list(started[:finished]):
+        done[index].set()
+        await asyncio.sleep(0.01)
+    order = [lanes[index] for index in started]
+    for event in done:
+        event.set()
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_asset_burst_does_not_starve_the_other_lanes():
+    scheduler = TransferScheduler(max_transfers=8)
+    lanes = [ASSET] * 20 + [ATTACHMENT] * 2 + [VIDEO] * 2
+
+    order = asyncio.run(start_order(scheduler, lanes, finished=2))
+
+    # The burst took every slot, the first two freed go to the lanes that
+    # were left waiting
+    assert order[:8] == [ASSET] * 8
+    assert sorted(order[8:10]) == [ATTACHMENT, VIDEO]
+
+
+def test_one_slot_is_never_reserved_away():
+    scheduler = TransferScheduler(max_transfers=1)
+
+    order = asyncio.run(start_order(scheduler, [VIDEO, ASSET], finished=0))
+
+    assert order == [VIDEO]
+
+
+def test_host_limit_grows_by_one_per_limit_fast_responses():
+    limit = HostLimit(start=4, maximum=16)
+    for _ in range(4):
+        limit.on_response(0.1)
+    assert limit.slots == 4
+    assert 4.9 < limit.limit < 5
+
+
+def test_host_limit_stops_at_its_maximum():
+    limit = HostLimit(start=2, maximum=3)
+    for _ in range(100):
+        limit.on_response(0.1)
+    assert limit.limit == 3
+
+
+def test_host_limit_shrinks_on_slow_responses():
+    limit = HostLimit(start=10)
+    limit.on_response(0.1)
+    before = limit.limit
+    # Three times the fastest is still tolerated
+    limit.on_response(0.3)
+    assert limit.limit > before
+    limit.on_response(1.0)
+    assert limit.limit < before
+
+
+def test_host_limit_halves_on_overload_down_to_its_minimum():
+    limit = HostLimit(start=8, minimum=1)
+    limit.on_overload()
+    assert limit.slots == 4
+    for _ in range(10):
+        limit.on_overload()
+    assert limit.slots == 1
+
+
+def test_scheduler_adapts_the_limit_of_the_host():
+    scheduler = TransferScheduler(8)
+    scheduler.record_overload("cdn")
+    assert scheduler.host_limit("cdn").slots == HOST_START_LIMIT // 2
+    assert scheduler.host_limit("other").slots == HOST_START_LIMIT
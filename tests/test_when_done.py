@@ -0,0 +1,29 @@
+from concurrent.futures import Future
+
+from crawler import when_done
+
+
+def test_returned_future_finishes_after_the_callback():
+    calls = []
+    video = Future()
+    done = when_done([video], calls.append, "lesson")
+    assert not done.done()
+    video.set_result(None)
+    assert done.done() and calls == ["lesson"]
+
+
+def test_failing_callback_still_finishes():
+    def fail():
+        raise ValueError("boom")
+
+    assert when_done([], fail).done()
+
+
+def test_failed_future_skips_the_callback():
+    calls = []
+    video = Future()
+    lesson = when_done([video], calls.append, "lesson")
+    module = when_done([lesson], calls.append, "module")
+    video.set_exception(RuntimeError("out of tries"))
+    assert calls == []
+    assert isinstance(module.exception(), RuntimeError)